@@ -132,6 +132,8 @@ CREATE TABLE billing_plans (
     currency TEXT DEFAULT 'ZAR',
     billing_cycle TEXT DEFAULT 'MONTHLY', -- MONTHLY, QUARTERLY, ANNUAL
     fno_provider TEXT, -- Openserve, Vumatel, etc.
+    data_cap_gb DECIMAL(12, 2) CHECK (data_cap_gb >= 0), -- NULL = uncapped; usage above it is out of bundle
+    overage_tiers JSONB, -- [{"from_gb": 0, "rate_per_gb": 15.00}, ...] GB above the cap; NULL = default tiers
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
@@ -144,9 +146,13 @@ CREATE TABLE subscriptions (
     start_date DATE NOT NULL,
     next_billing_date DATE,
     cancel_date DATE,
+    suspension_reason TEXT, -- DUNNING when suspended for non-payment; lifted by the dunning sweep once settled
     paystack_customer_token TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+-- Keyset walk of a tenant's active subscriptions in bill runs; the due date is checked from the index
+CREATE INDEX idx_subscriptions_billing ON subscriptions(tenant_id, id) INCLUDE (next_billing_date) WHERE status = 'ACTIVE';
+CREATE INDEX idx_subscriptions_dunning ON subscriptions(id) WHERE suspension_reason = 'DUNNING';
 
 CREATE TABLE invoices (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -160,8 +166,53 @@ CREATE TABLE invoices (
     status TEXT DEFAULT 'DRAFT', -- DRAFT, SENT, PAID, OVERDUE, REFUNDED
     due_date DATE,
     paid_at TIMESTAMP WITH TIME ZONE,
+    bill_run_id UUID, -- Set for invoices raised by a bill run
+    billing_period_start DATE,
+    billing_period_end DATE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+-- One invoice per subscription per billing period: bill runs can be re-run safely
+CREATE UNIQUE INDEX idx_invoices_subscription_period ON invoices(subscription_id, billing_period_start);
+-- Dunning only ever looks at unpaid invoices by due date; paid and refunded history stays out of the index
+CREATE INDEX idx_invoices_dunning ON invoices(status, due_date) INCLUDE (subscription_id)
+    WHERE status IN ('DRAFT', 'SENT', 'OVERDUE');
+CREATE SEQUENCE invoice_number_seq;
+
+-- Usage charges rated against a billing period; invoice_id marks items an invoice has picked up
+-- (the bill run does not attach them yet, so for now every item stays unbilled)
+CREATE TABLE invoice_line_items (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    tenant_id UUID REFERENCES tenants(id) ON DELETE CASCADE,
+    invoice_id UUID REFERENCES invoices(id),
+    subscription_id UUID REFERENCES subscriptions(id),
+    billing_period_start DATE NOT NULL,
+    billing_period_end DATE NOT NULL,
+    item_type TEXT NOT NULL, -- OUT_OF_BUNDLE
+    tier SMALLINT NOT NULL DEFAULT 0,
+    description TEXT,
+    quantity DECIMAL(14, 3) NOT NULL, -- GB
+    unit_price DECIMAL(12, 2) NOT NULL,
+    amount DECIMAL(12, 2) NOT NULL,
+    rated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX idx_invoice_line_items_rating ON invoice_line_items(subscription_id, billing_period_start, item_type, tier);
+CREATE INDEX idx_invoice_line_items_unbilled ON invoice_line_items(tenant_id, billing_period_start) WHERE invoice_id IS NULL;
+
+CREATE TABLE bill_runs (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    tenant_id UUID REFERENCES tenants(id) ON DELETE CASCADE,
+    run_date DATE NOT NULL, -- Bills every subscription due on or before this date
+    status TEXT DEFAULT 'RUNNING', -- RUNNING, COMPLETED, FAILED
+    chunk_size INTEGER,
+    checkpoint_id UUID, -- Every due subscription with a lower id has been billed
+    subscriptions_billed INTEGER DEFAULT 0,
+    invoices_created INTEGER DEFAULT 0,
+    invoiced_total DECIMAL(14, 2) DEFAULT 0,
+    error TEXT,
+    started_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX idx_bill_runs_tenant_date ON bill_runs(tenant_id, run_date);
 
 CREATE TABLE payments (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -225,6 +276,26 @@ CREATE TABLE radius_accounts (
     status TEXT DEFAULT 'ACTIVE', -- ACTIVE, SUSPENDED
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
+CREATE INDEX idx_radius_accounts_profile ON radius_accounts(profile_name);
+CREATE INDEX idx_radius_accounts_subscription ON radius_accounts(subscription_id);
+
+-- Profile moves requested by other services (e.g. dunning), applied in id order by the network service
+CREATE TABLE radius_profile_changes (
+    id BIGSERIAL PRIMARY KEY,
+    tenant_id UUID REFERENCES tenants(id) ON DELETE CASCADE,
+    subscription_id UUID REFERENCES subscriptions(id),
+    username TEXT NOT NULL,
+    from_profile TEXT,
+    to_profile TEXT NOT NULL,
+    reason TEXT NOT NULL, -- DUNNING_SUSPEND, DUNNING_RESTORE
+    status TEXT NOT NULL DEFAULT 'PENDING', -- PENDING, APPLIED, SUPERSEDED, FAILED
+    error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    applied_at TIMESTAMP WITH TIME ZONE
+);
+CREATE INDEX idx_radius_profile_changes_pending ON radius_profile_changes(id) WHERE status = 'PENDING';
+CREATE INDEX idx_radius_profile_changes_username ON radius_profile_changes(username, id);
+
 CREATE TABLE radcheck (
     id SERIAL PRIMARY KEY,
     username TEXT NOT NULL DEFAULT '',
@@ -258,6 +329,7 @@ CREATE TABLE radgroupreply (
     op VARCHAR(2) NOT NULL DEFAULT '=',
     value TEXT NOT NULL DEFAULT ''
 );
+CREATE INDEX idx_radgroupreply_groupname ON radgroupreply(groupname);
 
 CREATE TABLE radusergroup (
     id SERIAL PRIMARY KEY,
@@ -266,6 +338,7 @@ CREATE TABLE radusergroup (
     priority INTEGER NOT NULL DEFAULT 1
 );
 CREATE INDEX idx_radusergroup_username ON radusergroup(username);
+CREATE INDEX idx_radusergroup_groupname ON radusergroup(groupname); -- Whole-tier re-profiling
 
 CREATE TABLE radacct (
     radacctid BIGSERIAL PRIMARY KEY,
@@ -293,9 +366,22 @@ CREATE TABLE radacct (
     servicetype TEXT DEFAULT NULL,
     framedprotocol TEXT DEFAULT NULL,
     framedipaddress INET DEFAULT NULL
-);
+) WITH (fillfactor = 80); -- Free space per page so interim updates stay HOT (no index churn)
+CREATE UNIQUE INDEX idx_radacct_acctuniqueid ON radacct(acctuniqueid); -- Upsert target for accounting ingestion
 CREATE INDEX idx_radacct_username ON radacct(username);
-CREATE INDEX idx_radacct_active ON radacct(acctstoptime) WHERE acctstoptime IS NULL;
+-- Only open sessions are indexed, keyed for the live-session lookups (by user, by NAS)
+CREATE INDEX idx_radacct_active ON radacct(username, nasipaddress) WHERE acctstoptime IS NULL;
+
+-- Daily per-username usage, grown by the accounting upsert with each session's counter deltas
+CREATE TABLE usage_daily (
+    username TEXT NOT NULL,
+    usage_date DATE NOT NULL,
+    input_octets BIGINT NOT NULL DEFAULT 0,
+    output_octets BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (username, usage_date)
+);
+CREATE INDEX idx_usage_daily_date ON usage_daily(usage_date);
 
 CREATE TABLE radpostauth (
     id BIGSERIAL PRIMARY KEY,
@@ -324,10 +410,22 @@ CREATE TABLE automation_jobs (
     status TEXT DEFAULT 'PENDING', -- PENDING, IN_PROGRESS, COMPLETED, FAILED
     payload JSONB, -- Input data
     result JSONB, -- Automation output
-    error_log TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    error_log TEXT, -- Last error, kept across retries
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 5,
+    run_after TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP, -- Retry backoff
+    locked_by TEXT, -- host:pid of the worker holding the job
+    locked_at TIMESTAMP WITH TIME ZONE,
+    started_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Queue claims only ever look at due PENDING rows per FNO
+CREATE INDEX idx_automation_jobs_claim ON automation_jobs(fno_name, run_after) WHERE status = 'PENDING';
+CREATE INDEX idx_automation_jobs_lease ON automation_jobs(locked_at) WHERE status = 'IN_PROGRESS';
+
 -- 9. IOT & SMART HOME MANAGEMENT
 CREATE TABLE iot_devices (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -344,18 +442,37 @@ CREATE TABLE iot_devices (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Raw samples are range-partitioned by day (ont_signal_history_pYYYYMMDD, created ahead by the IoT
+-- service) so expired days are dropped as whole partitions instead of deleted row by row. There is
+-- deliberately no DEFAULT partition: a row parked there would block creating its day's partition,
+-- so the IoT service rejects readings outside the days it keeps partitions for.
 CREATE TABLE ont_signal_history (
-    id BIGSERIAL PRIMARY KEY,
+    id BIGSERIAL,
     device_id UUID REFERENCES iot_devices(id) ON DELETE CASCADE,
     rx_power_dbm DECIMAL(5,2) NOT NULL, -- Received Optical Power (standard: -8 to -28 dBm)
     tx_power_dbm DECIMAL(5,2), -- Transmit Optical Power
     voltage_v DECIMAL(5,2),
     bias_current_ma DECIMAL(5,2),
     temperature_c DECIMAL(5,2),
-    measured_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    measured_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, measured_at)
+) PARTITION BY RANGE (measured_at);
 CREATE INDEX idx_ont_signal_device_time ON ont_signal_history(device_id, measured_at DESC);
 
+-- Downsampled signal tiers (1 minute / 1 hour / 1 day) for long-range history charts
+CREATE TABLE ont_signal_rollup_1m (
+    device_id UUID NOT NULL,
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    samples INTEGER NOT NULL,
+    rx_min DECIMAL(5,2), rx_max DECIMAL(5,2), rx_avg DECIMAL(6,3),
+    tx_min DECIMAL(5,2), tx_max DECIMAL(5,2), tx_avg DECIMAL(6,3),
+    temp_min DECIMAL(5,2), temp_max DECIMAL(5,2), temp_avg DECIMAL(6,3),
+    PRIMARY KEY (device_id, bucket_start)
+);
+CREATE INDEX idx_ont_rollup_1m_bucket ON ont_signal_rollup_1m(bucket_start);
+CREATE TABLE ont_signal_rollup_1h (LIKE ont_signal_rollup_1m INCLUDING ALL);
+CREATE TABLE ont_signal_rollup_1d (LIKE ont_signal_rollup_1m INCLUDING ALL);
+
 CREATE TABLE fiber_health_alerts (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
     tenant_id UUID REFERENCES tenants(id) ON DELETE CASCADE,
@@ -371,14 +488,20 @@ CREATE TABLE fiber_health_alerts (
 
 CREATE TABLE iot_commands (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+    batch_id UUID, -- Bulk command the row belongs to
     device_id UUID REFERENCES iot_devices(id) ON DELETE CASCADE,
     command_type TEXT NOT NULL, -- REBOOT, FIRMWARE_UPDATE, TOGGLE_POWER
     payload JSONB,
     status TEXT DEFAULT 'PENDING', -- PENDING, SENT, EXECUTED, FAILED
+    attempts INTEGER DEFAULT 0,
+    error TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX idx_iot_commands_batch ON iot_commands(batch_id, status);
+CREATE INDEX idx_iot_commands_unfinished ON iot_commands(created_at) WHERE status IN ('PENDING', 'SENT');
+
 -- 10. STOCK & INVENTORY MANAGEMENT
 CREATE TABLE product_categories (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
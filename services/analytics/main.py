@@ -1,10 +1,13 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, Query
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import uuid
-from datetime import datetime
+from datetime import datetime, date
+import asyncio
 import logging
 
+from .usage import UsageReports, period_bounds
+
 app = FastAPI(title="CoreConnect AI Analytics Service", version="0.1.0")
 
 # --- Models ---
@@ -18,6 +21,8 @@ class ExecutiveInsight(BaseModel):
 async def get_current_tenant_id():
     return uuid.UUID("00000000-0000-0000-0000-000000000000")
 
+usage_reports = UsageReports()
+
 # --- Routes ---
 @app.get("/")
 async def root():
@@ -43,13 +48,50 @@ async def get_summary(tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
     }
 
 @app.get("/reports/usage-billing-sync")
-async def get_billing_sync_stats():
-    """Report on usage data matched to subscriptions for billing accuracy"""
-    return {
-        "accounts_synced": 450,
-        "usage_variance_detected": "2.5%",
-        "orphaned_radius_accounts": 3 # Accounts with RADIUS but no CRM subscription
-    }
+async def get_billing_sync_stats(
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    """Report on usage data matched to subscriptions for billing accuracy (current month by default)"""
+    start, end = period_bounds(start, end)
+    report = await asyncio.to_thread(usage_reports.billing_sync, tenant_id, start, end)
+    if report is None:
+        # Mock figures when no database is configured
+        return {
+            "accounts_synced": 450,
+            "usage_variance_detected": "2.5%",
+            "orphaned_radius_accounts": 3 # Accounts with RADIUS but no CRM subscription
+        }
+    return report
+
+@app.get("/reports/out-of-bundle")
+async def get_out_of_bundle_accounts(
+    threshold: float = Query(1.0, gt=0, description="Fraction of the plan's data cap, e.g. 0.8 for early warnings"),
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    """Capped subscriptions at or over `threshold` of their bundle, for Out-of-Bundle notifications"""
+    start, end = period_bounds(start, end)
+    accounts = await asyncio.to_thread(usage_reports.out_of_bundle, tenant_id, start, end, threshold, limit)
+    return {"period": {"start": start, "end": end}, "threshold": threshold, "accounts": accounts or []}
+
+@app.get("/usage/{username}/daily")
+async def get_daily_usage(
+    username: str,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    start, end = period_bounds(start, end)
+    days = await asyncio.to_thread(usage_reports.daily, tenant_id, username, start, end)
+    return {"username": username, "days": days or []}
+
+@app.on_event("shutdown")
+async def close_usage_reports():
+    usage_reports.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,131 @@
+"""
+Usage reports for the Analytics Service, read from the usage_daily rollups.
+
+The network service's accounting upsert adds every session's counter
+growth to usage_daily (one row per username per day), so a billing
+period is a sum over at most one row per user per day instead of a
+scan of radacct.
+"""
+
+from datetime import date
+from decimal import Decimal
+from typing import List, Optional
+import os
+import threading
+
+GIGABYTE = 10 ** 9
+
+# Usage per username over the period, matched to its RADIUS account and subscription
+PERIOD_USAGE = (
+    "WITH usage AS (SELECT username, SUM(input_octets) AS input_octets, SUM(output_octets) AS output_octets "
+    "FROM usage_daily WHERE usage_date BETWEEN %s AND %s GROUP BY username) "
+)
+
+BILLING_SYNC = PERIOD_USAGE + (
+    "SELECT count(*) FILTER (WHERE s.status <> 'CANCELLED'), "
+    "count(*) FILTER (WHERE s.id IS NULL OR s.status = 'CANCELLED'), "
+    "COALESCE(SUM(u.input_octets + u.output_octets), 0), "
+    "COALESCE(SUM(u.input_octets + u.output_octets) FILTER (WHERE s.id IS NULL OR s.status = 'CANCELLED'), 0) "
+    "FROM usage u JOIN radius_accounts ra ON ra.username = u.username AND ra.tenant_id = %s "
+    "LEFT JOIN subscriptions s ON s.id = ra.subscription_id"
+)
+
+ORPHANED_ACCOUNTS = (
+    "SELECT count(*) FROM radius_accounts ra LEFT JOIN subscriptions s ON s.id = ra.subscription_id "
+    "WHERE ra.tenant_id = %s AND (s.id IS NULL OR s.status = 'CANCELLED')"
+)
+
+OUT_OF_BUNDLE = PERIOD_USAGE + (
+    "SELECT ra.username, s.id, s.contact_id, p.name, p.data_cap_gb, u.input_octets + u.output_octets "
+    "FROM usage u JOIN radius_accounts ra ON ra.username = u.username AND ra.tenant_id = %s "
+    "JOIN subscriptions s ON s.id = ra.subscription_id AND s.status = 'ACTIVE' "
+    "JOIN billing_plans p ON p.id = s.plan_id "
+    "WHERE p.data_cap_gb IS NOT NULL AND u.input_octets + u.output_octets >= p.data_cap_gb * %s * %s "
+    "AND (p.data_cap_gb > 0 OR u.input_octets + u.output_octets > 0) "
+    # A zero cap has no share to rank by; any usage on it is fully out of bundle, so it sorts first
+    "ORDER BY (u.input_octets + u.output_octets) / NULLIF(p.data_cap_gb * %s, 0) DESC NULLS FIRST LIMIT %s"
+)
+
+DAILY_USAGE = (
+    "SELECT d.usage_date, d.input_octets, d.output_octets FROM usage_daily d "
+    "JOIN radius_accounts ra ON ra.username = d.username AND ra.tenant_id = %s "
+    "WHERE d.username = %s AND d.usage_date BETWEEN %s AND %s ORDER BY d.usage_date"
+)
+
+
+def period_bounds(start: Optional[date], end: Optional[date]) -> tuple:
+    """Defaults to the current month to date"""
+    end = end or date.today()
+    return start or end.replace(day=1), end
+
+
+def gigabytes(octets) -> float:
+    return round(float(Decimal(octets) / GIGABYTE), 3)
+
+
+class UsageReports:
+    """Reads usage_daily; returns None without DATABASE_URL so callers can fall back."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _query(self, sql: str, params: tuple) -> List[tuple]:
+        with self._lock:
+            if self._conn is None or self._conn.closed:
+                import psycopg2
+                self._conn = psycopg2.connect(self.dsn)
+                self._conn.set_session(readonly=True, autocommit=True)
+            with self._conn.cursor() as cur:
+                cur.execute(sql, params)
+                return cur.fetchall()
+
+    def billing_sync(self, tenant_id, start: date, end: date) -> Optional[dict]:
+        if not self.dsn:
+            return None
+        tenant_id = str(tenant_id)
+        synced, orphaned_with_usage, total, orphaned_octets = self._query(BILLING_SYNC, (start, end, tenant_id))[0]
+        orphaned = self._query(ORPHANED_ACCOUNTS, (tenant_id,))[0][0]
+        variance = orphaned_octets / total * 100 if total else 0
+        return {
+            "period": {"start": start, "end": end},
+            "accounts_synced": synced,
+            "usage_variance_detected": f"{variance:.1f}%",  # Usage with no live subscription to bill it to
+            "orphaned_radius_accounts": orphaned,
+            "orphaned_accounts_with_usage": orphaned_with_usage,
+            "total_usage_gb": gigabytes(total),
+            "unbilled_usage_gb": gigabytes(orphaned_octets)
+        }
+
+    def out_of_bundle(self, tenant_id, start: date, end: date, threshold: float, limit: int) -> Optional[List[dict]]:
+        """Active subscriptions whose usage has reached `threshold` of their plan's data cap"""
+        if not self.dsn:
+            return None
+        rows = self._query(OUT_OF_BUNDLE, (start, end, str(tenant_id), GIGABYTE, threshold, GIGABYTE, limit))
+        return [
+            {
+                "username": username,
+                "subscription_id": subscription_id,
+                "contact_id": contact_id,
+                "plan": plan,
+                "data_cap_gb": float(cap),
+                "used_gb": gigabytes(used),
+                # A zero cap has no percentage; any usage on it is out of bundle, as in billing's rating
+                "percent_of_cap": round(float(Decimal(used) / (cap * GIGABYTE) * 100), 1) if cap else None,
+                "out_of_bundle": used >= cap * GIGABYTE if cap else used > 0
+            }
+            for username, subscription_id, contact_id, plan, cap, used in rows
+        ]
+
+    def daily(self, tenant_id, username: str, start: date, end: date) -> Optional[List[dict]]:
+        if not self.dsn:
+            return None
+        return [
+            {"date": usage_date, "input_gb": gigabytes(rx), "output_gb": gigabytes(tx), "total_gb": gigabytes(rx + tx)}
+            for usage_date, rx, tx in self._query(DAILY_USAGE, (str(tenant_id), username, start, end))
+        ]
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
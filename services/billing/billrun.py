@@ -0,0 +1,319 @@
+"""
+Bill-run engine: turns due subscriptions into invoices.
+
+A run walks a tenant's active subscriptions in id order. The coordinator
+only finds chunk boundaries (a keyset step of `chunk_size` ids); the
+chunks themselves go to a pool of worker threads, each with its own
+connection. A chunk pass is one statement in one transaction: it locks
+the due subscriptions in its id range (waiting for any other writer
+holding one, never skipping it), prices them (amount, 15% VAT,
+total) in SQL, inserts the invoices and moves next_billing_date on by one
+billing cycle. A chunk repeats its pass until nothing in the range is due
+on the run date, so a subscription that missed cycles gets one invoice
+per missed period in the same run.
+
+Re-running is safe. Once a run for a date has finished nothing is due on
+it any more, and invoices are unique per (subscription, billing period),
+so nothing is billed twice. Progress is checkpointed in bill_runs as the highest id below
+which every chunk has committed, and a resumed run starts from there.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Optional, Tuple
+import logging
+import os
+import threading
+import uuid
+
+VAT_RATE = Decimal("0.15")
+PAYMENT_TERMS_DAYS = int(os.getenv("INVOICE_PAYMENT_TERMS_DAYS", 7))
+MIN_ID = "00000000-0000-0000-0000-000000000000"
+
+RUN_RUNNING = "RUNNING"
+RUN_COMPLETED = "COMPLETED"
+RUN_FAILED = "FAILED"
+
+# Upper bound and size of the next chunk of active subscriptions after a given id
+NEXT_CHUNK = (
+    "SELECT count(*), max(id::text) FROM (SELECT id FROM subscriptions WHERE tenant_id = %s AND status = 'ACTIVE' "
+    "AND next_billing_date <= %s AND id > %s::uuid ORDER BY id LIMIT %s) c"
+)
+
+# One chunk: lock, price, invoice and advance, in a single round trip. Chunk ranges never overlap, so
+# the lock only waits on other writers; skipping their rows would leave them unbilled behind the checkpoint
+BILL_CHUNK = (
+    "WITH due AS ("
+    "SELECT s.id, s.tenant_id, s.contact_id, s.next_billing_date AS period_start, ROUND(p.price, 2) AS amount, "
+    "(s.next_billing_date + CASE p.billing_cycle WHEN 'QUARTERLY' THEN INTERVAL '3 months' "
+    "WHEN 'ANNUAL' THEN INTERVAL '1 year' ELSE INTERVAL '1 month' END)::date AS period_end "
+    "FROM subscriptions s JOIN billing_plans p ON p.id = s.plan_id "
+    "WHERE s.tenant_id = %(tenant_id)s AND s.status = 'ACTIVE' AND s.next_billing_date <= %(run_date)s "
+    "AND s.id > %(lower)s::uuid AND s.id <= %(upper)s::uuid "
+    "ORDER BY s.id FOR UPDATE OF s), "
+    "inserted AS ("
+    "INSERT INTO invoices (tenant_id, contact_id, subscription_id, bill_run_id, invoice_number, "
+    "billing_period_start, billing_period_end, amount, tax_amount, total_amount, status, due_date) "
+    "SELECT tenant_id, contact_id, id, %(run_id)s, "
+    "'INV-' || to_char(period_start, 'YYYYMM') || '-' || lpad(nextval('invoice_number_seq')::text, 9, '0'), "
+    "period_start, period_end, amount, ROUND(amount * %(vat)s, 2), amount + ROUND(amount * %(vat)s, 2), "
+    "'DRAFT', %(due_date)s FROM due "
+    "ON CONFLICT (subscription_id, billing_period_start) DO NOTHING "
+    "RETURNING total_amount), "
+    "advanced AS ("
+    "UPDATE subscriptions s SET next_billing_date = due.period_end FROM due WHERE s.id = due.id RETURNING s.id) "
+    "SELECT (SELECT count(*) FROM advanced), (SELECT count(*) FROM inserted), "
+    "(SELECT COALESCE(SUM(total_amount), 0) FROM inserted)"
+)
+
+# Held for the whole run, so a second request for the same tenant and date cannot start alongside it
+LOCK_RUN = "SELECT pg_try_advisory_lock(hashtext(%s))"
+INSERT_RUN = (
+    "INSERT INTO bill_runs (id, tenant_id, run_date, status, chunk_size) VALUES (%s, %s, %s, 'RUNNING', %s)"
+)
+FIND_UNFINISHED_RUN = (
+    "SELECT id, checkpoint_id::text, subscriptions_billed, invoices_created, invoiced_total FROM bill_runs "
+    "WHERE tenant_id = %s AND run_date = %s AND status <> 'COMPLETED' ORDER BY started_at DESC LIMIT 1"
+)
+MARK_RUN_RESUMED = "UPDATE bill_runs SET status = 'RUNNING', error = NULL, finished_at = NULL WHERE id = %s"
+CHECKPOINT_RUN = (
+    "UPDATE bill_runs SET checkpoint_id = %s::uuid, subscriptions_billed = %s, invoices_created = %s, "
+    "invoiced_total = %s WHERE id = %s"
+)
+FINISH_RUN = "UPDATE bill_runs SET status = %s, error = %s, finished_at = CURRENT_TIMESTAMP WHERE id = %s"
+SELECT_RUN = (
+    "SELECT id, run_date, status, subscriptions_billed, invoices_created, invoiced_total, checkpoint_id, "
+    "error, started_at, finished_at FROM bill_runs WHERE id = %s AND tenant_id = %s"
+)
+
+
+class BillRunInProgress(Exception):
+    pass
+
+
+class BillRun:
+    """Progress of one bill run; the in-memory view of its bill_runs row."""
+
+    def __init__(self, run_id: str, tenant_id: str, run_date: date, chunk_size: int, workers: int):
+        self.id = run_id
+        self.tenant_id = tenant_id
+        self.run_date = run_date
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.status = RUN_RUNNING
+        self.checkpoint_id: Optional[str] = None
+        self.subscriptions_billed = 0
+        self.invoices_created = 0
+        self.invoiced_total = Decimal("0")
+        self.chunks_done = 0
+        self.chunks_failed = 0
+        self.error: Optional[str] = None
+        self.resumed = False
+        self._conn = None
+        self.started_at = datetime.now()
+        self.finished_at: Optional[datetime] = None
+
+    def as_dict(self) -> dict:
+        elapsed = ((self.finished_at or datetime.now()) - self.started_at).total_seconds()
+        return {
+            "id": self.id,
+            "run_date": self.run_date,
+            "status": self.status,
+            "resumed": self.resumed,
+            "chunk_size": self.chunk_size,
+            "workers": self.workers,
+            "chunks_done": self.chunks_done,
+            "chunks_failed": self.chunks_failed,
+            "subscriptions_billed": self.subscriptions_billed,
+            "invoices_created": self.invoices_created,
+            "invoiced_total": float(self.invoiced_total),
+            "checkpoint_id": self.checkpoint_id,
+            "subscriptions_per_second": round(self.subscriptions_billed / elapsed, 1) if elapsed else None,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class Chunk:
+    __slots__ = ("upper", "future", "collected")
+
+    def __init__(self, upper: str, future: Future):
+        self.upper = upper
+        self.future = future
+        self.collected = False
+
+
+class BillRunEngine:
+    """Runs bill runs; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None, chunk_size: int = 2000, workers: int = 4):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.runs: Dict[str, BillRun] = {}
+        # Long-lived threads, so each keeps its connection from one run to the next
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bill-run")
+        self._local = threading.local()
+        self._connections: List = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        """One connection per thread; chunks run concurrently"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            import psycopg2
+            conn = self._local.conn = psycopg2.connect(self.dsn)
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _execute(self, sql: str, params, fetch: bool = False, conn=None):
+        conn = conn or self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                rows = cur.fetchall() if fetch else None
+            conn.commit()
+            return rows
+        except Exception:
+            conn.rollback()
+            raise
+
+    def begin(self, tenant_id, run_date: date) -> BillRun:
+        """Claim the run for (tenant, date): a new run, or the unfinished one resumed from its checkpoint"""
+        tenant_id = str(tenant_id)
+        if not self.dsn:
+            run = BillRun(str(uuid.uuid4()), tenant_id, run_date, self.chunk_size, self.workers)
+            logging.info(f"bill run (mock): {run_date} for tenant {tenant_id}")
+            run.status, run.finished_at = RUN_COMPLETED, datetime.now()
+            self.runs[run.id] = run
+            return run
+
+        import psycopg2
+        # The coordinator's own connection holds the run's advisory lock until execute() closes it
+        conn = psycopg2.connect(self.dsn)
+        try:
+            if not self._execute(LOCK_RUN, (f"bill-run:{tenant_id}:{run_date}",), fetch=True, conn=conn)[0][0]:
+                raise BillRunInProgress(f"A bill run for {run_date} is already in progress")
+            unfinished = self._execute(FIND_UNFINISHED_RUN, (tenant_id, run_date), fetch=True, conn=conn)
+            if unfinished:
+                run_id, checkpoint_id, billed, created, total = unfinished[0]
+                run = BillRun(str(run_id), tenant_id, run_date, self.chunk_size, self.workers)
+                run.resumed = True
+                run.checkpoint_id = checkpoint_id
+                run.subscriptions_billed, run.invoices_created, run.invoiced_total = billed, created, total
+                self._execute(MARK_RUN_RESUMED, (run.id,), conn=conn)
+                logging.info(f"Resuming bill run {run.id} for {run_date} after {checkpoint_id or 'the start'}")
+            else:
+                run = BillRun(str(uuid.uuid4()), tenant_id, run_date, self.chunk_size, self.workers)
+                self._execute(INSERT_RUN, (run.id, tenant_id, run_date, self.chunk_size), conn=conn)
+        except Exception:
+            conn.close()
+            raise
+        run._conn = conn
+        self.runs[run.id] = run
+        return run
+
+    def _bill_chunk(self, run: BillRun, lower: str, upper: str) -> Tuple[int, int, Decimal]:
+        """Bill the range one cycle per pass until it is caught up; returns summed (billed, created, total)"""
+        params = {
+            "tenant_id": run.tenant_id, "run_date": run.run_date, "lower": lower, "upper": upper,
+            "run_id": run.id, "vat": VAT_RATE, "due_date": run.run_date + timedelta(days=PAYMENT_TERMS_DAYS)
+        }
+        billed, created, total = 0, 0, Decimal("0")
+        while True:
+            advanced, inserted, amount = self._execute(BILL_CHUNK, params, fetch=True)[0]
+            if not advanced:
+                return billed, created, total
+            # subscriptions_billed counts billing periods, matching invoices_created
+            billed, created, total = billed + advanced, created + inserted, total + amount
+
+    def execute(self, run: BillRun) -> BillRun:
+        """Bill every subscription due on or before the run date; blocking, call from a worker thread"""
+        conn = run._conn
+        if conn is None:
+            return run
+        after = run.checkpoint_id or MIN_ID
+        chunks: List[Chunk] = []
+        try:
+            while True:
+                count, upper = self._execute(NEXT_CHUNK, (run.tenant_id, run.run_date, after, self.chunk_size),
+                                             fetch=True, conn=conn)[0]
+                if not count:
+                    break
+                chunks.append(Chunk(upper, self._pool.submit(self._bill_chunk, run, after, upper)))
+                after = upper
+                # Keep the boundary scan at most a couple of chunks per worker ahead
+                running = [chunk.future for chunk in chunks if not chunk.future.done()]
+                if len(running) >= self.workers * 2:
+                    wait(running, return_when=FIRST_COMPLETED)
+                self._collect(run, chunks)
+                if count < self.chunk_size:
+                    break
+            wait([chunk.future for chunk in chunks])
+            self._collect(run, chunks)
+            run.status = RUN_FAILED if run.chunks_failed else RUN_COMPLETED
+            if run.chunks_failed:
+                run.error = f"{run.chunks_failed} chunks failed; run again for the same date to resume"
+        except Exception as exc:
+            run.status, run.error = RUN_FAILED, str(exc)
+            logging.error(f"Bill run {run.id} stopped: {exc}")
+        run.finished_at = datetime.now()
+        try:
+            self._execute(FINISH_RUN, (run.status, run.error, run.id), conn=conn)
+        finally:
+            conn.close()
+            run._conn = None
+        logging.info(f"Bill run {run.id}: {run.invoices_created} invoices, R{run.invoiced_total} ({run.status})")
+        return run
+
+    def run(self, tenant_id, run_date: date) -> BillRun:
+        return self.execute(self.begin(tenant_id, run_date))
+
+    def _collect(self, run: BillRun, chunks: List["Chunk"]) -> None:
+        """Fold finished chunks into the run totals and persist progress
+
+        The checkpoint only moves over the front of the list while every chunk there committed, so
+        a failed range is always billed again on resume.
+        """
+        collected = False
+        for chunk in chunks:
+            if chunk.collected or not chunk.future.done():
+                continue
+            chunk.collected = collected = True
+            if chunk.future.exception() is not None:
+                run.chunks_failed += 1
+                logging.error(f"Bill run {run.id} chunk ending {chunk.upper} failed: {chunk.future.exception()}")
+                continue
+            billed, created, total = chunk.future.result()
+            run.subscriptions_billed += billed
+            run.invoices_created += created
+            run.invoiced_total += total
+            run.chunks_done += 1
+        while chunks and chunks[0].collected and chunks[0].future.exception() is None:
+            run.checkpoint_id = chunks.pop(0).upper
+        if collected:
+            self._execute(CHECKPOINT_RUN, (run.checkpoint_id, run.subscriptions_billed, run.invoices_created,
+                                           run.invoiced_total, run.id), conn=run._conn)
+
+    def get(self, tenant_id, run_id: str) -> Optional[dict]:
+        run = self.runs.get(run_id)
+        if run is not None and run.tenant_id == str(tenant_id):
+            return run.as_dict()
+        if not self.dsn:
+            return None
+        rows = self._execute(SELECT_RUN, (run_id, str(tenant_id)), fetch=True)
+        if not rows:
+            return None
+        keys = ("id", "run_date", "status", "subscriptions_billed", "invoices_created", "invoiced_total",
+                "checkpoint_id", "error", "started_at", "finished_at")
+        return dict(zip(keys, rows[0]))
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -1,19 +1,33 @@
-from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks
-from pydantic import BaseModel
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from pydantic import BaseModel, Field
 from typing import List, Optional
 import uuid
 from datetime import datetime, date
+import asyncio
+import json
 import logging
+import os
+
+from .billrun import BillRunEngine, BillRunInProgress
+from .dunning import DunningEngine
+from .rating import RatingEngine
+from .webhooks import PaymentApplier, PaymentConsumer, WebhookQueue, event_key, is_event, verify_signature
 
 app = FastAPI(title="CoreConnect Billing Service", version="0.1.0")
 
 # --- Models ---
+class OverageTier(BaseModel):
+    from_gb: float # GB above the data cap where this tier starts
+    rate_per_gb: float
+
 class PlanBase(BaseModel):
     name: str
     description: str
     price: float
     currency: str = "ZAR"
     billing_cycle: str = "MONTHLY"
+    data_cap_gb: Optional[float] = Field(None, ge=0) # None = uncapped
+    overage_tiers: Optional[List[OverageTier]] = None # None = default out-of-bundle tiers
 
 class Plan(PlanBase):
     id: uuid.UUID
@@ -45,6 +59,16 @@ class Invoice(BaseModel):
     status: str
     due_date: date
 
+class BillRunCreate(BaseModel):
+    run_date: Optional[date] = None # Defaults to today
+
+class DunningSweepCreate(BaseModel):
+    as_of: Optional[date] = None # Defaults to today
+
+class RatingRunCreate(BaseModel):
+    period_start: Optional[date] = None # Defaults to the first of the month
+    period_end: Optional[date] = None # Defaults to today
+
 # --- IAM Middleware (Stub) ---
 async def get_current_tenant_id():
     return uuid.UUID("00000000-0000-0000-0000-000000000000")
@@ -75,11 +99,171 @@ async def subscribe_customer(sub: SubscriptionCreate, tenant_id: uuid.UUID = Dep
         **sub.dict()
     }
 
+# --- Bill Runs ---
+bill_run_engine = BillRunEngine(
+    chunk_size=int(os.getenv("BILL_RUN_CHUNK_SIZE", 2000)),
+    workers=int(os.getenv("BILL_RUN_WORKERS", 4))
+)
+_bill_run_tasks = set()
+
+@app.post("/bill-runs", status_code=status.HTTP_202_ACCEPTED)
+async def start_bill_run(request: BillRunCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Invoice every subscription due on or before run_date; resumes an unfinished run for the same date"""
+    run_date = request.run_date or date.today()
+    try:
+        run = await asyncio.to_thread(bill_run_engine.begin, tenant_id, run_date)
+    except BillRunInProgress as exc:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc))
+    task = asyncio.create_task(asyncio.to_thread(bill_run_engine.execute, run))
+    _bill_run_tasks.add(task)
+    task.add_done_callback(_bill_run_tasks.discard)
+    return run.as_dict()
+
+@app.get("/bill-runs/{run_id}")
+async def get_bill_run(run_id: uuid.UUID, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    run = await asyncio.to_thread(bill_run_engine.get, tenant_id, str(run_id))
+    if run is None:
+        raise HTTPException(status_code=404, detail="Bill run not found")
+    return run
+
+@app.on_event("shutdown")
+async def stop_bill_runs():
+    # Runs interrupted here stay unfinished in bill_runs and resume from their checkpoint
+    await asyncio.to_thread(bill_run_engine.close)
+
+# --- Dunning ---
+dunning_engine = DunningEngine(
+    batch_size=int(os.getenv("DUNNING_BATCH_SIZE", 5000)),
+    grace_days=int(os.getenv("DUNNING_GRACE_DAYS", 14)),
+    suspended_profile=os.getenv("DUNNING_SUSPENDED_PROFILE", "SUSPENDED")
+)
+DUNNING_INTERVAL_SECONDS = int(os.getenv("DUNNING_INTERVAL_SECONDS", 86400)) # 0 disables the daily sweep
+_dunning_task: Optional[asyncio.Task] = None
+
+async def _sweep_daily():
+    while True:
+        try:
+            await asyncio.to_thread(dunning_engine.sweep)
+        except Exception as exc:
+            logging.error(f"Dunning sweep failed: {exc}")
+        await asyncio.sleep(DUNNING_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_dunning_schedule():
+    global _dunning_task
+    if DUNNING_INTERVAL_SECONDS > 0 and dunning_engine.dsn:
+        _dunning_task = asyncio.create_task(_sweep_daily())
+
+@app.on_event("shutdown")
+async def stop_dunning_schedule():
+    if _dunning_task is not None:
+        _dunning_task.cancel()
+    await asyncio.to_thread(dunning_engine.close)
+
+@app.post("/dunning/sweeps")
+async def run_dunning_sweep(request: DunningSweepCreate):
+    """Mark overdue invoices, suspend accounts past grace and queue their RADIUS downgrades"""
+    # Sweeps every tenant: overdue is a property of the invoice, not of who asks
+    return await asyncio.to_thread(dunning_engine.sweep, request.as_of)
+
+# --- Usage Rating ---
+rating_engine = RatingEngine(mock_subscribers=int(os.getenv("RATING_MOCK_SUBSCRIBERS", 50000)))
+RATING_INTERVAL_SECONDS = int(os.getenv("RATING_INTERVAL_SECONDS", 3600)) # 0 disables the scheduled rating
+_latest_ratings = {}
+_rating_task: Optional[asyncio.Task] = None
+
+async def rate_tenant(tenant_id, period_start: Optional[date] = None, period_end: Optional[date] = None):
+    period_end = period_end or date.today()
+    period_start = period_start or period_end.replace(day=1)
+    result = await asyncio.to_thread(rating_engine.run, tenant_id, period_start, period_end)
+    _latest_ratings[str(tenant_id)] = result
+    return result
+
+async def _rate_hourly():
+    # Keeps line items and bill shock alerts close to live usage between bill runs
+    while True:
+        await asyncio.sleep(RATING_INTERVAL_SECONDS)
+        try:
+            tenants = await asyncio.to_thread(rating_engine.tenants)
+            for tenant_id in tenants:
+                result = await rate_tenant(tenant_id)
+                logging.info(f"Rated {len(result.usage)} subscriptions for tenant {tenant_id} "
+                             f"in {result.seconds * 1000:.1f}ms")
+        except Exception as exc:
+            logging.error(f"Scheduled usage rating failed: {exc}")
+
+@app.on_event("startup")
+async def start_rating_schedule():
+    global _rating_task
+    if RATING_INTERVAL_SECONDS > 0 and rating_engine.dsn:
+        _rating_task = asyncio.create_task(_rate_hourly())
+
+@app.on_event("shutdown")
+async def stop_rating_schedule():
+    if _rating_task is not None:
+        _rating_task.cancel()
+    await asyncio.to_thread(rating_engine.close)
+
+@app.post("/rating/runs")
+async def run_rating(request: RatingRunCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Rate out-of-bundle usage for the period and refresh its unbilled invoice line items"""
+    result = await rate_tenant(tenant_id, request.period_start, request.period_end)
+    return {**result.summary(), "alerts": result.alerts(limit=20)}
+
+@app.get("/rating/alerts")
+async def bill_shock_alerts(limit: int = 100, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Subscriptions approaching or past their data cap as of the latest rating"""
+    result = _latest_ratings.get(str(tenant_id)) or await rate_tenant(tenant_id)
+    return {"period": {"start": result.start, "end": result.end}, "alerts": result.alerts(limit)}
+
+# --- Paystack Webhooks ---
+PAYSTACK_SECRET_KEY = os.getenv("PAYSTACK_SECRET_KEY", "")
+payment_consumer: Optional[PaymentConsumer] = None
+
+@app.on_event("startup")
+async def start_payment_consumer():
+    global payment_consumer
+    queue = WebhookQueue(os.getenv("PAYSTACK_QUEUE_PATH", "paystack_webhooks.db"))
+    payment_consumer = PaymentConsumer(
+        queue,
+        PaymentApplier(),
+        batch_size=int(os.getenv("PAYSTACK_BATCH_SIZE", 500))
+    )
+    payment_consumer.start()
+
+@app.on_event("shutdown")
+async def stop_payment_consumer():
+    # Anything not yet applied stays in the local queue for the next start
+    if payment_consumer is not None:
+        await payment_consumer.stop()
+
 @app.post("/payments/webhook")
-async def paystack_webhook(payload: dict, background_tasks: BackgroundTasks):
-    # Process Paystack webhook (payment.success, subscription.create)
-    logging.info(f"Received Paystack webhook: {payload.get('event')}")
-    return {"status": "accepted"}
+async def paystack_webhook(request: Request):
+    """Verify, persist to the local queue and ack; payments are applied in batches by the consumer"""
+    body = await request.body()
+    if not verify_signature(PAYSTACK_SECRET_KEY, body, request.headers.get("x-paystack-signature")):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid signature")
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid JSON")
+    if not is_event(payload):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Expected an event object")
+    key = event_key(payload)
+    if key is None:
+        # subscription.create and the like carry nothing to post against an invoice
+        logging.info(f"Received Paystack webhook: {payload.get('event')}")
+        return {"status": "accepted"}
+    payment_consumer.received += 1
+    if await asyncio.to_thread(payment_consumer.queue.append, key, payload["event"], body.decode()):
+        payment_consumer.notify()
+        return {"status": "accepted"}
+    payment_consumer.duplicates += 1
+    return {"status": "duplicate"}
+
+@app.get("/payments/webhook/stats")
+async def paystack_webhook_stats():
+    return await asyncio.to_thread(payment_consumer.stats)
 
 @app.post("/refunds/{invoice_id}")
 async def process_refund(invoice_id: uuid.UUID, reason: str, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
@@ -0,0 +1,287 @@
+"""
+Usage rating engine: prices out-of-bundle data for the whole subscriber base.
+
+Usage is held column-wise (one row per capped subscription) and each
+plan's overage tiers are packed into (n_plans, n_tiers) arrays of tier
+starts and per-GB rates, so the GB falling into every tier of every
+subscription, and its charge, come out of one vectorised pass. Only
+the rows that actually owe something are turned into line items.
+
+Rating is repeatable: usage only grows within a period, and line items
+are upserted per (subscription, period, tier) for as long as their
+invoice_id is unset, so the hourly run doubles as the bill shock feed.
+Nothing sets invoice_id yet: the bill run invoices plan fees only, and
+putting rated line items on invoices is still to be built.
+"""
+
+from datetime import date
+from typing import List, Optional, Sequence
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+GIGABYTE = 10 ** 9
+OUT_OF_BUNDLE = "OUT_OF_BUNDLE"
+
+# GB above the cap where each tier starts, and its rate per GB (ZAR, excl. VAT), for plans without their own
+DEFAULT_OVERAGE_TIERS = ((0, 15.00), (10, 12.50), (50, 9.90))
+
+# Share of the cap at which subscribers are warned; index i is reached at SHOCK_THRESHOLDS[i]
+SHOCK_LEVELS = ("none", "approaching", "out_of_bundle")
+SHOCK_THRESHOLDS = np.array([0.8, 1.0])
+
+TENANTS_WITH_CAPS = "SELECT DISTINCT tenant_id::text FROM billing_plans WHERE data_cap_gb IS NOT NULL"
+CAPPED_PLANS = (
+    "SELECT id, name, data_cap_gb, overage_tiers FROM billing_plans "
+    "WHERE tenant_id = %s AND data_cap_gb IS NOT NULL"
+)
+
+# Period usage of every active subscription on a capped plan, summed over its RADIUS accounts
+SUBSCRIPTION_USAGE = (
+    "WITH usage AS (SELECT username, SUM(input_octets + output_octets) AS octets "
+    "FROM usage_daily WHERE usage_date BETWEEN %s AND %s GROUP BY username) "
+    "SELECT s.id::text, s.plan_id::text, COALESCE(SUM(u.octets), 0) "
+    "FROM subscriptions s JOIN billing_plans p ON p.id = s.plan_id AND p.data_cap_gb IS NOT NULL "
+    "JOIN radius_accounts ra ON ra.subscription_id = s.id LEFT JOIN usage u ON u.username = ra.username "
+    "WHERE s.tenant_id = %s AND s.status = 'ACTIVE' GROUP BY s.id, s.plan_id"
+)
+
+# Billed line items are left alone; unbilled ones follow the latest rating
+UPSERT_LINE_ITEMS = (
+    "INSERT INTO invoice_line_items (tenant_id, subscription_id, billing_period_start, billing_period_end, "
+    "item_type, tier, description, quantity, unit_price, amount) VALUES %s "
+    "ON CONFLICT (subscription_id, billing_period_start, item_type, tier) DO UPDATE SET "
+    "billing_period_end = EXCLUDED.billing_period_end, quantity = EXCLUDED.quantity, "
+    "amount = EXCLUDED.amount, rated_at = CURRENT_TIMESTAMP "
+    "WHERE invoice_line_items.invoice_id IS NULL"
+)
+LINE_ITEM_TEMPLATE = "(%s, %s::uuid, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+
+def tier_tables(plans: Sequence[Sequence[tuple]]):
+    """Pack per-plan [(start_gb, rate)] schedules into (n_plans, n_tiers) start and rate arrays.
+
+    Plans with fewer tiers are padded with tiers starting at infinity, which never fill.
+    """
+    width = max([len(tiers) for tiers in plans] or [1])
+    starts = np.full((len(plans), width), np.inf)
+    rates = np.zeros((len(plans), width))
+    for i, tiers in enumerate(plans):
+        tiers = sorted(tiers)
+        starts[i, :len(tiers)] = [start for start, _ in tiers]
+        rates[i, :len(tiers)] = [rate for _, rate in tiers]
+    return starts, rates
+
+
+def cap_share(used_gb: np.ndarray, cap_gb: np.ndarray) -> np.ndarray:
+    """Usage as a share of the cap; a zero cap puts any usage out of bundle rather than dividing by zero"""
+    return np.divide(used_gb, cap_gb, out=np.where(used_gb > 0, np.inf, 0.0), where=cap_gb > 0)
+
+
+def rate_matrix(used_gb: np.ndarray, cap_gb: np.ndarray, plan_code: np.ndarray,
+                tier_start: np.ndarray, tier_rate: np.ndarray):
+    """Rate every subscription in one vectorised pass.
+
+    Returns (quantity, charge, shock_code): GB billed and its charge per tier,
+    both (n_subscriptions, n_tiers), and the bill shock level per subscription.
+    """
+    used_gb = np.asarray(used_gb, dtype=np.float64)
+    cap_gb = np.asarray(cap_gb, dtype=np.float64)
+    overage = np.clip(used_gb - cap_gb, 0.0, None)[:, None]
+
+    starts = tier_start[plan_code]
+    ends = np.concatenate([starts[:, 1:], np.full((len(starts), 1), np.inf)], axis=1)
+    # GB above each tier's start, less what spills over into the next tier
+    quantity = np.clip(overage - starts, 0.0, None) - np.clip(overage - ends, 0.0, None)
+    quantity = np.round(quantity, 3)
+    charge = np.round(quantity * tier_rate[plan_code], 2)
+
+    shock_code = np.searchsorted(SHOCK_THRESHOLDS, cap_share(used_gb, cap_gb), side="right").astype(np.int8)
+    return quantity, charge, shock_code
+
+
+class PlanTiers:
+    """Overage schedules of a tenant's capped plans, indexed by plan code."""
+
+    def __init__(self, plan_ids: List[str], names: List[str], cap_gb: np.ndarray, schedules: List[List[tuple]]):
+        self.plan_ids = plan_ids
+        self.names = names
+        self.cap_gb = cap_gb
+        self.schedules = schedules
+        self.tier_start, self.tier_rate = tier_tables(schedules)
+        self.code = {plan_id: i for i, plan_id in enumerate(plan_ids)}
+
+    @classmethod
+    def from_rows(cls, rows) -> "PlanTiers":
+        schedules = []
+        for _, _, _, tiers in rows:
+            if isinstance(tiers, str):
+                tiers = json.loads(tiers)
+            schedules.append([(float(t["from_gb"]), float(t["rate_per_gb"])) for t in tiers]
+                             if tiers else list(DEFAULT_OVERAGE_TIERS))
+        return cls([str(r[0]) for r in rows], [r[1] for r in rows],
+                   np.array([float(r[2]) for r in rows]), schedules)
+
+    def tier_label(self, plan_code: int, tier: int) -> str:
+        start = self.tier_start[plan_code, tier]
+        end = self.tier_start[plan_code, tier + 1] if tier + 1 < self.tier_start.shape[1] else np.inf
+        band = f"{start:g}+ GB" if np.isinf(end) else f"{start:g}-{end:g} GB"
+        return f"Out-of-bundle data, {self.names[plan_code]} ({band} over cap)"
+
+
+class UsageTable:
+    """Column store of per-subscription period usage on capped plans."""
+
+    def __init__(self, subscription_id: np.ndarray, plan_code: np.ndarray, used_gb: np.ndarray):
+        self.subscription_id = subscription_id
+        self.plan_code = plan_code
+        self.used_gb = used_gb
+
+    def __len__(self) -> int:
+        return len(self.subscription_id)
+
+    @classmethod
+    def from_rows(cls, rows, plans: PlanTiers) -> "UsageTable":
+        rows = [r for r in rows if r[1] in plans.code]
+        return cls(
+            subscription_id=np.array([r[0] for r in rows], dtype=object),
+            plan_code=np.fromiter((plans.code[r[1]] for r in rows), dtype=np.intp, count=len(rows)),
+            used_gb=np.fromiter((int(r[2]) / GIGABYTE for r in rows), dtype=np.float64, count=len(rows)),
+        )
+
+    @classmethod
+    def synthetic(cls, count: int, plans: PlanTiers, seed: Optional[int] = None) -> "UsageTable":
+        """A plausible month of usage until DATABASE_URL is configured"""
+        rng = np.random.default_rng(seed)
+        plan_code = rng.integers(0, len(plans.plan_ids), count).astype(np.intp)
+        used_gb = plans.cap_gb[plan_code] * rng.lognormal(-0.4, 0.45, count)
+        return cls(np.array([str(uuid.uuid4()) for _ in range(count)], dtype=object), plan_code, used_gb)
+
+
+class RatingResult:
+    """Columnar rating output, aligned with the rows of the usage table."""
+
+    def __init__(self, usage: UsageTable, plans: PlanTiers, start: date, end: date,
+                 quantity: np.ndarray, charge: np.ndarray, shock_code: np.ndarray, seconds: float):
+        self.usage = usage
+        self.plans = plans
+        self.start = start
+        self.end = end
+        self.quantity = quantity
+        self.charge = charge
+        self.total = charge.sum(axis=1)
+        self.shock_code = shock_code
+        self.seconds = seconds
+
+    def line_items(self, tenant_id) -> List[tuple]:
+        """Invoice line items for every charged (subscription, tier), as UPSERT_LINE_ITEMS rows"""
+        rows, tiers = np.nonzero(self.charge > 0)
+        plan_code = self.usage.plan_code[rows]
+        columns = zip(self.usage.subscription_id[rows], tiers.tolist(), plan_code.tolist(),
+                      self.quantity[rows, tiers].tolist(), self.plans.tier_rate[plan_code, tiers].tolist(),
+                      self.charge[rows, tiers].tolist())
+        labels = {}
+        items = []
+        for subscription_id, tier, code, quantity, rate, amount in columns:
+            label = labels.get((code, tier))
+            if label is None:
+                label = labels[(code, tier)] = self.plans.tier_label(code, tier)
+            items.append((str(tenant_id), subscription_id, self.start, self.end, OUT_OF_BUNDLE,
+                          tier, label, quantity, rate, amount))
+        return items
+
+    def alerts(self, limit: int) -> List[dict]:
+        """Subscriptions at or past a bill shock threshold, most over their cap first"""
+        rows = np.flatnonzero(self.shock_code > 0)
+        used = self.usage.used_gb[rows]
+        cap = self.plans.cap_gb[self.usage.plan_code[rows]]
+        rows = rows[np.argsort(-cap_share(used, cap), kind="stable")][:limit]
+        return [
+            {
+                "subscription_id": self.usage.subscription_id[i],
+                "plan": self.plans.names[self.usage.plan_code[i]],
+                "data_cap_gb": float(self.plans.cap_gb[self.usage.plan_code[i]]),
+                "used_gb": round(float(self.usage.used_gb[i]), 3),
+                "level": SHOCK_LEVELS[self.shock_code[i]],
+                "out_of_bundle_charge": round(float(self.total[i]), 2)
+            }
+            for i in rows.tolist()
+        ]
+
+    def summary(self) -> dict:
+        counts = np.bincount(self.shock_code, minlength=len(SHOCK_LEVELS))
+        return {
+            "period": {"start": self.start, "end": self.end},
+            "subscriptions_rated": len(self.usage),
+            "subscriptions_charged": int(np.count_nonzero(self.total)),
+            "out_of_bundle_gb": round(float(self.quantity.sum()), 3),
+            "out_of_bundle_total": round(float(self.total.sum()), 2),
+            "shock_levels": {SHOCK_LEVELS[i]: int(counts[i]) for i in range(len(SHOCK_LEVELS))},
+            "rating_ms": round(self.seconds * 1000, 2)
+        }
+
+
+class RatingEngine:
+    """Loads usage and tiers, rates them and stores the line items; synthetic data without DATABASE_URL."""
+
+    def __init__(self, dsn: Optional[str] = None, mock_subscribers: int = 50000):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self.mock_subscribers = mock_subscribers
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn
+
+    def tenants(self) -> List[str]:
+        with self._lock:
+            conn = self._connect()
+            with conn.cursor() as cur:
+                cur.execute(TENANTS_WITH_CAPS)
+                tenants = [row[0] for row in cur.fetchall()]
+            conn.commit()
+        return tenants
+
+    def rate(self, plans: PlanTiers, usage: UsageTable, start: date, end: date) -> RatingResult:
+        started = time.perf_counter()
+        quantity, charge, shock_code = rate_matrix(
+            usage.used_gb, plans.cap_gb[usage.plan_code], usage.plan_code, plans.tier_start, plans.tier_rate)
+        return RatingResult(usage, plans, start, end, quantity, charge, shock_code, time.perf_counter() - started)
+
+    def run(self, tenant_id, start: date, end: date) -> RatingResult:
+        """Rate a tenant's period to date and upsert its out-of-bundle line items"""
+        if not self.dsn:
+            plans = PlanTiers([str(uuid.uuid4()) for _ in range(3)], ["Fibre 50GB", "Fibre 200GB", "LTE 30GB"],
+                              np.array([50.0, 200.0, 30.0]), [list(DEFAULT_OVERAGE_TIERS)] * 3)
+            return self.rate(plans, UsageTable.synthetic(self.mock_subscribers, plans, seed=start.toordinal()),
+                             start, end)
+
+        from psycopg2.extras import execute_values
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(CAPPED_PLANS, (str(tenant_id),))
+                    plans = PlanTiers.from_rows(cur.fetchall())
+                    cur.execute(SUBSCRIPTION_USAGE, (start, end, str(tenant_id)))
+                    usage = UsageTable.from_rows(cur.fetchall(), plans)
+                result = self.rate(plans, usage, start, end)
+                with conn.cursor() as cur:
+                    execute_values(cur, UPSERT_LINE_ITEMS, result.line_items(tenant_id),
+                                   template=LINE_ITEM_TEMPLATE, page_size=5000)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return result
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
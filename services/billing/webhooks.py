@@ -0,0 +1,350 @@
+"""
+Paystack webhook ingestion for the Billing Service.
+
+The webhook handler only verifies the signature and appends the event to
+a local SQLite queue (WAL, fsync on commit), then acks. Deliveries are
+deduplicated there on (event, reference), so Paystack's retries during a
+burst cost one indexed insert each and never reach Postgres. A consumer
+drains the queue in batches: one statement per batch records the payments
+(ON CONFLICT on payments.reference, the final guard against double
+posting) and marks invoices PAID once their payments cover the total.
+Events stay queued until that transaction commits, so a crash or a
+database outage delays payments but never loses them. If a batch fails
+for any other reason its rows are retried one by one, and an event that
+keeps failing on its own is set aside (kept, with its error) after
+MAX_APPLY_ATTEMPTS, so it cannot hold up everyone else's payments.
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import List, Optional, Sequence, Tuple
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+
+PAYMENT_EVENTS = ("charge.success", "payment.success")
+# Applied events are remembered this long so late retries are still recognised as duplicates
+DEDUP_RETENTION = timedelta(days=7)
+# Failed applies before an event is set aside (kept, with its error, out of the pending queue)
+MAX_APPLY_ATTEMPTS = 5
+
+QUEUE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS webhook_events ("
+    "id INTEGER PRIMARY KEY AUTOINCREMENT, event_key TEXT NOT NULL UNIQUE, event TEXT NOT NULL, "
+    "body TEXT NOT NULL, received_at TEXT NOT NULL, applied_at TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+    "error TEXT)",
+    "CREATE INDEX IF NOT EXISTS idx_webhook_events_pending ON webhook_events(id) WHERE applied_at IS NULL",
+)
+
+APPLY_PAYMENTS = (
+    "WITH incoming (reference, invoice_id, invoice_number, amount, paid_at, meta) AS (VALUES %s), "
+    "matched AS (SELECT v.*, i.id AS matched_invoice_id, i.tenant_id FROM incoming v "
+    "LEFT JOIN invoices i ON i.id = COALESCE(v.invoice_id, "
+    "(SELECT id FROM invoices WHERE invoice_number = v.invoice_number))), "
+    "inserted AS (INSERT INTO payments (tenant_id, invoice_id, amount, gateway, reference, status, meta) "
+    "SELECT tenant_id, matched_invoice_id, amount, 'PAYSTACK', reference, 'SUCCESS', meta FROM matched "
+    "ON CONFLICT (reference) DO NOTHING RETURNING invoice_id, reference, amount), "
+    "new_totals AS (SELECT ins.invoice_id, SUM(ins.amount) AS amount, MAX(m.paid_at) AS paid_at "
+    "FROM inserted ins JOIN matched m USING (reference) WHERE ins.invoice_id IS NOT NULL GROUP BY 1), "
+    "paid AS (UPDATE invoices inv SET status = 'PAID', paid_at = n.paid_at FROM new_totals n "
+    "WHERE inv.id = n.invoice_id AND inv.status NOT IN ('PAID', 'REFUNDED') AND n.amount + COALESCE(("
+    "SELECT SUM(p.amount) FROM payments p WHERE p.invoice_id = inv.id AND p.status = 'SUCCESS'), 0) "
+    ">= inv.total_amount RETURNING inv.id) "
+    "SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM inserted WHERE invoice_id IS NULL), "
+    "(SELECT count(*) FROM paid)"
+)
+APPLY_TEMPLATE = "(%s, %s::uuid, %s, %s::numeric, %s::timestamptz, %s::jsonb)"
+
+
+def verify_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """Paystack signs the raw body with HMAC-SHA512 of the secret key (x-paystack-signature)"""
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha512).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def is_event(payload) -> bool:
+    """A JSON object whose data, when present, is an object too"""
+    return isinstance(payload, dict) and isinstance(payload.get("data") or {}, dict)
+
+
+def event_key(event: dict) -> Optional[str]:
+    """Payments are keyed on their reference alone, whichever event name announced them"""
+    data = event.get("data") or {}
+    reference = data.get("reference")
+    if event.get("event") not in PAYMENT_EVENTS or not reference:
+        return None
+    return f"payment:{reference}"
+
+
+def parse_paid_at(value) -> str:
+    """ISO 8601 timestamp as Paystack sends it (e.g. 2026-10-01T08:15:00.000Z); ValueError otherwise"""
+    if not isinstance(value, str):
+        raise ValueError(f"paid_at is not a timestamp: {value!r}")
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).isoformat()
+
+
+def payment_row(event: dict) -> tuple:
+    """(reference, invoice_id, invoice_number, amount, paid_at, meta) for APPLY_PAYMENTS"""
+    data = event["data"]
+    metadata = data.get("metadata") or {}
+    if not isinstance(metadata, dict):
+        metadata = {}
+    # Checked here so one malformed event is set aside on its own instead of failing a whole batch's casts
+    invoice_id = metadata.get("invoice_id")
+    if invoice_id is not None:
+        invoice_id = str(uuid.UUID(str(invoice_id)))
+    invoice_number = metadata.get("invoice_number")
+    paid_at = data.get("paid_at") or data.get("paidAt")
+    return (
+        str(data["reference"]),
+        invoice_id,
+        None if invoice_number is None else str(invoice_number),
+        Decimal(str(data["amount"])) / 100,  # Paystack amounts are in cents
+        parse_paid_at(paid_at) if paid_at else datetime.now().isoformat(),
+        json.dumps({"currency": data.get("currency"), "channel": data.get("channel"),
+                    "customer": (data.get("customer") or {}).get("email"), "gateway_id": data.get("id")}),
+    )
+
+
+class WebhookQueue:
+    """Durable local queue of verified webhook events, unique on event key."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        for statement in QUEUE_SCHEMA:
+            self._conn.execute(statement)
+
+    def append(self, key: str, event: str, body: str) -> bool:
+        """False when the event was already queued or applied (a retried delivery)"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO webhook_events (event_key, event, body, received_at) VALUES (?, ?, ?, ?)",
+                (key, event, body, datetime.now().isoformat()))
+            return cursor.rowcount == 1
+
+    def pending(self, limit: int) -> List[Tuple[int, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, body FROM webhook_events WHERE applied_at IS NULL ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+
+    def mark_applied(self, ids: Sequence[int]) -> None:
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("UPDATE webhook_events SET applied_at = ?, error = NULL WHERE id = ?",
+                                   [(now, event_id) for event_id in ids])
+            self._conn.execute("COMMIT")
+
+    def mark_failed(self, ids: Sequence[int], error: str, max_attempts: int = MAX_APPLY_ATTEMPTS) -> int:
+        """Count a failed apply; events reaching max_attempts are set aside. Returns how many were"""
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("UPDATE webhook_events SET attempts = attempts + 1, error = ? WHERE id = ?",
+                                   [(error, event_id) for event_id in ids])
+            set_aside = 0
+            for event_id in ids:
+                set_aside += self._conn.execute(
+                    "UPDATE webhook_events SET applied_at = ? WHERE id = ? AND attempts >= ?",
+                    (now, event_id, max_attempts)).rowcount
+            self._conn.execute("COMMIT")
+            return set_aside
+
+    def prune(self) -> int:
+        """Forget applied events past the dedup window; set-aside events stay for inspection"""
+        cutoff = (datetime.now() - DEDUP_RETENTION).isoformat()
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM webhook_events WHERE applied_at IS NOT NULL AND applied_at < ? AND error IS NULL",
+                (cutoff,)).rowcount
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT count(*) FROM webhook_events WHERE applied_at IS NULL").fetchone()[0]
+
+    def set_aside_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT count(*) FROM webhook_events WHERE applied_at IS NOT NULL AND error IS NOT NULL").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class PaymentApplier:
+    """Writes batches of payment events to payments/invoices; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+
+    def apply(self, rows: Sequence[tuple]) -> Tuple[int, int, int]:
+        """(payments recorded, of which unmatched to an invoice, invoices paid); duplicates are skipped"""
+        if not self.dsn:
+            logging.info(f"payments (mock): {len(rows)} Paystack payments applied")
+            return len(rows), 0, 0
+        from psycopg2.extras import execute_values
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        # References in order, so concurrent batches take payment locks in the same sequence
+        rows = sorted(rows, key=lambda row: row[0])
+        try:
+            with self._conn.cursor() as cur:
+                result = execute_values(cur, APPLY_PAYMENTS, rows, template=APPLY_TEMPLATE,
+                                        page_size=len(rows), fetch=True)[0]
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        return result
+
+    @staticmethod
+    def is_transient(exc: Exception) -> bool:
+        """Connection trouble, as opposed to something wrong with the rows themselves"""
+        try:
+            import psycopg2
+        except ImportError:
+            return False
+        return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+class PaymentConsumer:
+    """Drains the webhook queue into Postgres in batches."""
+
+    def __init__(self, queue: WebhookQueue, applier: PaymentApplier, batch_size: int = 500,
+                 idle_seconds: float = 1.0, retry_seconds: float = 5.0):
+        self.queue = queue
+        self.applier = applier
+        self.batch_size = batch_size
+        self.idle_seconds = idle_seconds
+        self.retry_seconds = retry_seconds
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.received = 0
+        self.duplicates = 0
+        self.applied = 0
+        self.unmatched = 0
+        self.invoices_paid = 0
+        self.failures = 0
+        self.last_batch_ms = 0.0
+
+    def notify(self) -> None:
+        self._wake.set()
+
+    async def drain(self) -> int:
+        """Apply one batch; returns how many events it took off the queue"""
+        events = await asyncio.to_thread(self.queue.pending, self.batch_size)
+        if not events:
+            return 0
+        rows, ids = {}, {}
+        for event_id, body in events:
+            try:
+                row = payment_row(json.loads(body))
+            except (KeyError, TypeError, ValueError, ArithmeticError) as exc:
+                logging.error(f"Unusable Paystack event {event_id}: {exc!r}")
+                # Will never apply; set aside on the first attempt but kept on record
+                await asyncio.to_thread(self.queue.mark_failed, [event_id], f"Malformed payment event: {exc!r}", 1)
+                continue
+            rows.setdefault(row[0], row)
+            ids.setdefault(row[0], []).append(event_id)
+        if rows:
+            started = datetime.now()
+            try:
+                totals = await asyncio.to_thread(self.applier.apply, list(rows.values()))
+                await asyncio.to_thread(self.queue.mark_applied, [i for group in ids.values() for i in group])
+                self._count(len(rows), sum(len(group) for group in ids.values()), totals)
+            except Exception as exc:
+                if PaymentApplier.is_transient(exc):
+                    raise
+                logging.warning(f"Batch of {len(rows)} Paystack payments failed ({exc}); applying one by one")
+                await self._apply_each(rows, ids)
+            self.last_batch_ms = (datetime.now() - started).total_seconds() * 1000
+        return len(events)
+
+    async def _apply_each(self, rows: dict, ids: dict) -> None:
+        """Isolate the rows that broke a batch; only they are charged an attempt"""
+        for reference, row in rows.items():
+            try:
+                totals = await asyncio.to_thread(self.applier.apply, [row])
+            except Exception as exc:
+                if PaymentApplier.is_transient(exc):
+                    raise
+                error = str(exc).strip().splitlines()[0] if str(exc).strip() else repr(exc)
+                set_aside = await asyncio.to_thread(self.queue.mark_failed, ids[reference], error)
+                logging.error(f"Paystack payment {reference} failed: {error}"
+                              + (" (set aside)" if set_aside else ""))
+                continue
+            await asyncio.to_thread(self.queue.mark_applied, ids[reference])
+            self._count(1, len(ids[reference]), totals)
+
+    def _count(self, rows: int, events: int, totals: tuple) -> None:
+        recorded, unmatched, paid = totals
+        self.applied += recorded
+        self.duplicates += events - recorded
+        self.unmatched += unmatched
+        self.invoices_paid += paid
+        if unmatched:
+            logging.warning(f"{unmatched} Paystack payments did not match an invoice")
+
+    async def _run(self) -> None:
+        pruned_at = datetime.min
+        while True:
+            try:
+                if await self.drain() == self.batch_size:
+                    continue
+                if datetime.now() - pruned_at > timedelta(hours=1):
+                    await asyncio.to_thread(self.queue.prune)
+                    pruned_at = datetime.now()
+            except Exception as exc:
+                self.failures += 1
+                logging.error(f"Applying Paystack payments failed, will retry: {exc}")
+                await asyncio.sleep(self.retry_seconds)
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.idle_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.applier.close()
+        self.queue.close()
+
+    def stats(self) -> dict:
+        return {
+            "received": self.received,
+            "duplicate_deliveries": self.duplicates,
+            "queued": self.queue.depth(),
+            "payments_applied": self.applied,
+            "unmatched_payments": self.unmatched,
+            "invoices_paid": self.invoices_paid,
+            "apply_failures": self.failures,
+            "set_aside": self.queue.set_aside_count(),
+            "last_batch_ms": round(self.last_batch_ms, 2)
+        }
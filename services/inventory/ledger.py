@@ -0,0 +1,397 @@
+"""
+In-memory stock ledger for the Inventory Service.
+
+Every (warehouse, product) pair has one set of counters (soh, sit,
+allocated) held in memory and warmed from inventory_levels at startup,
+so stock-on-hand reads are a dict lookup. A move checks and updates its
+counters without awaiting in between, which makes it atomic on the event
+loop: concurrent moves on the same SKU serialise there instead of on a
+Postgres row lock per request.
+
+That only holds with a single writer, so the ledger takes an advisory
+lock on startup and a second instance refuses to start. Warehouses and
+products are resolved (and checked against the caller's tenant) before a
+move is accepted, so a move cannot reference rows Postgres would reject.
+
+Applied moves are buffered and flushed together, on size or age, in one
+transaction: the counter deltas are added onto inventory_levels and the
+moves are appended to stock_movements. A flush that fails on the
+connection is retried as it is; one that fails on its rows is replayed
+move by move, and moves Postgres still refuses are quarantined and taken
+back out of the counters so memory keeps matching the database.
+"""
+
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import asyncio
+import logging
+import os
+import time
+import uuid
+
+COUNTERS = ("soh", "sit", "allocated")
+
+# movement_type -> counter change per unit at the source and at the destination warehouse.
+# warehouse_id is the source when there is one, otherwise the destination; TRANSFER also needs to_warehouse_id.
+MOVEMENTS = {
+    "PURCHASE": (None, {"soh": 1}),
+    "RETURN_FROM_CUSTOMER": (None, {"soh": 1}),
+    "RECEIVE": (None, {"sit": -1, "soh": 1}), # Transfer arriving at its destination
+    "TRANSFER": ({"soh": -1}, {"sit": 1}),
+    "SALE": ({"soh": -1}, None),
+    "WRITE_OFF": ({"soh": -1}, None),
+    "ALLOCATE": ({"allocated": 1}, None),
+    "RELEASE": ({"allocated": -1}, None),
+    "FULFIL": ({"soh": -1, "allocated": -1}, None), # Allocated stock leaving for the customer
+}
+
+# Held for the writer connection's lifetime: one process owns the counters
+LOCK_LEDGER = "SELECT pg_try_advisory_lock(hashtext('inventory-stock-ledger'))"
+LOAD_LEVELS = (
+    "SELECT warehouse_id::text, product_id::text, tenant_id::text, soh, sit, allocated, min_threshold "
+    "FROM inventory_levels"
+)
+FIND_WAREHOUSES = "SELECT id::text, tenant_id::text FROM warehouses WHERE id = ANY(%s::uuid[])"
+FIND_PRODUCTS = "SELECT id::text, tenant_id::text FROM products WHERE id = ANY(%s::uuid[])"
+APPLY_LEVEL_DELTAS = (
+    "INSERT INTO inventory_levels (tenant_id, warehouse_id, product_id, soh, sit, allocated) VALUES %s "
+    "ON CONFLICT (warehouse_id, product_id) DO UPDATE SET soh = inventory_levels.soh + EXCLUDED.soh, "
+    "sit = inventory_levels.sit + EXCLUDED.sit, allocated = inventory_levels.allocated + EXCLUDED.allocated, "
+    "updated_at = CURRENT_TIMESTAMP"
+)
+LEVEL_TEMPLATE = "(%s::uuid, %s::uuid, %s::uuid, %s, %s, %s)"
+INSERT_MOVEMENTS = (
+    "INSERT INTO stock_movements (id, tenant_id, product_id, from_warehouse_id, to_warehouse_id, quantity, "
+    "movement_type, reference_id, created_at) VALUES %s"
+)
+MOVEMENT_TEMPLATE = "(%s::uuid, %s::uuid, %s::uuid, %s::uuid, %s::uuid, %s, %s, %s::uuid, %s)"
+
+# Moves kept for inspection after Postgres refused them
+MAX_QUARANTINED = 1000
+
+Key = Tuple[str, str]
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+class LedgerBusy(Exception):
+    """Too many moves waiting to be written; the caller should back off"""
+
+
+class LedgerLocked(Exception):
+    """Another instance holds the stock ledger"""
+
+
+class StockLevel:
+    __slots__ = ("tenant_id", "soh", "sit", "allocated", "min_threshold")
+
+    def __init__(self, tenant_id: str, soh: int = 0, sit: int = 0, allocated: int = 0, min_threshold: int = 10):
+        self.tenant_id = tenant_id
+        self.soh = soh
+        self.sit = sit
+        self.allocated = allocated
+        self.min_threshold = min_threshold
+
+    def as_dict(self) -> dict:
+        return {"soh": self.soh, "sit": self.sit, "allocated": self.allocated,
+                "available": self.soh - self.allocated, "min_threshold": self.min_threshold}
+
+
+def movement_deltas(movements: Iterable[tuple]) -> Dict[Key, List]:
+    """Summed counter changes per (warehouse, product) as [tenant_id, soh, sit, allocated]"""
+    deltas: Dict[Key, List] = {}
+    for _, tenant_id, product_id, source, destination, quantity, movement_type, _, _ in movements:
+        for warehouse, changes in zip((source, destination), MOVEMENTS[movement_type]):
+            if warehouse is None:
+                continue
+            pending = deltas.get((warehouse, product_id))
+            if pending is None:
+                pending = deltas[(warehouse, product_id)] = [tenant_id, 0, 0, 0]
+            for i, name in enumerate(COUNTERS, start=1):
+                pending[i] += changes.get(name, 0) * quantity
+    return deltas
+
+
+class LedgerWriter:
+    """Persists flushed deltas and moves; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            conn = psycopg2.connect(self.dsn)
+            with conn.cursor() as cur:
+                cur.execute(LOCK_LEDGER)
+                locked = cur.fetchone()[0]
+            conn.commit()
+            if not locked:
+                conn.close()
+                raise LedgerLocked("Another inventory instance holds the stock ledger")
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def is_transient(exc: Exception) -> bool:
+        """Worth retrying as is: the connection or the ledger lock, not the rows"""
+        if isinstance(exc, LedgerLocked):
+            return True
+        try:
+            import psycopg2
+        except ImportError:
+            return False
+        return isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+    def load(self) -> List[tuple]:
+        if not self.dsn:
+            return []
+        conn = self._connect()
+        with conn.cursor() as cur:
+            cur.execute(LOAD_LEVELS)
+            rows = cur.fetchall()
+        conn.commit()
+        return rows
+
+    def owners(self, warehouse_ids: Sequence[str], product_ids: Sequence[str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+        """Tenant of each warehouse and product that exists; missing ids are left out"""
+        conn = self._connect()
+        with conn.cursor() as cur:
+            cur.execute(FIND_WAREHOUSES, (list(warehouse_ids),))
+            warehouses = dict(cur.fetchall())
+            cur.execute(FIND_PRODUCTS, (list(product_ids),))
+            products = dict(cur.fetchall())
+        conn.commit()
+        return warehouses, products
+
+    def write(self, movements: Sequence[tuple]) -> None:
+        if not self.dsn:
+            logging.debug(f"stock ledger (mock): {len(movements)} movements")
+            return
+        from psycopg2.extras import execute_values
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                # Sorted keys keep row lock order stable against other writers of inventory_levels
+                rows = [(tenant_id, warehouse_id, product_id, *counts)
+                        for (warehouse_id, product_id), (tenant_id, *counts) in sorted(movement_deltas(movements).items())]
+                execute_values(cur, APPLY_LEVEL_DELTAS, rows, template=LEVEL_TEMPLATE, page_size=1000)
+                execute_values(cur, INSERT_MOVEMENTS, movements, template=MOVEMENT_TEMPLATE, page_size=1000)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+class StockLedger:
+    """Per-(warehouse, product) counters with batched write-behind to Postgres."""
+
+    def __init__(self, writer: LedgerWriter, max_movements: int = 2000, max_delay: float = 1.0,
+                 max_pending: int = 100000):
+        self.writer = writer
+        self.max_movements = max_movements
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._levels: Dict[Key, StockLevel] = {}
+        # Tenant of every warehouse and product a move has been checked against
+        self._warehouses: Dict[str, str] = {}
+        self._products: Dict[str, str] = {}
+        self._movements: List[tuple] = []
+        self.quarantined: List[dict] = []
+        self._opened: Optional[float] = None
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.moves_applied = 0
+        self.moves_rejected = 0
+        self.movements_flushed = 0
+        self.movements_quarantined = 0
+        self.flushes = 0
+        self.flush_failures = 0
+        self.last_flush_ms = 0.0
+
+    def load(self) -> int:
+        for warehouse_id, product_id, tenant_id, soh, sit, allocated, min_threshold in self.writer.load():
+            self._levels[(warehouse_id, product_id)] = StockLevel(tenant_id, soh, sit, allocated, min_threshold or 0)
+            self._warehouses[warehouse_id] = tenant_id
+            self._products[product_id] = tenant_id
+        return len(self._levels)
+
+    async def resolve(self, tenant_id, warehouse_ids: Iterable, product_ids: Iterable) -> None:
+        """Learn the owners of ids not seen yet, so move() can check them without awaiting"""
+        warehouse_ids = {str(w) for w in warehouse_ids if w is not None} - self._warehouses.keys()
+        product_ids = {str(p) for p in product_ids} - self._products.keys()
+        if not warehouse_ids and not product_ids:
+            return
+        if not self.writer.dsn:
+            # No catalogue to check against: ids belong to whoever uses them first
+            owners = ({w: str(tenant_id) for w in warehouse_ids}, {p: str(tenant_id) for p in product_ids})
+        else:
+            owners = await asyncio.to_thread(self.writer.owners, sorted(warehouse_ids), sorted(product_ids))
+        self._warehouses.update(owners[0])
+        self._products.update(owners[1])
+
+    def level(self, tenant_id, warehouse_id, product_id) -> Optional[StockLevel]:
+        level = self._levels.get((str(warehouse_id), str(product_id)))
+        if level is None or level.tenant_id != str(tenant_id):
+            return None
+        return level
+
+    def move(self, tenant_id, movement_type: str, product_id, warehouse_id, quantity: int,
+             to_warehouse_id=None, reference_id=None) -> dict:
+        """Apply one move to the counters and buffer it; raises ValueError, InsufficientStock or LedgerBusy.
+
+        Warehouses and products must have been passed through resolve() first.
+        """
+        if movement_type not in MOVEMENTS:
+            raise ValueError(f"movement_type must be one of {', '.join(MOVEMENTS)}")
+        if quantity <= 0:
+            raise ValueError("quantity must be positive")
+        if len(self._movements) >= self.max_pending:
+            raise LedgerBusy(f"{len(self._movements)} stock movements are waiting to be written")
+        source_deltas, destination_deltas = MOVEMENTS[movement_type]
+        if source_deltas is None:
+            source, destination = None, warehouse_id
+        elif destination_deltas is None:
+            source, destination = warehouse_id, None
+        else:
+            if to_warehouse_id is None or to_warehouse_id == warehouse_id:
+                raise ValueError(f"{movement_type} needs a different to_warehouse_id")
+            source, destination = warehouse_id, to_warehouse_id
+
+        tenant_id, product_id = str(tenant_id), str(product_id)
+        source = None if source is None else str(source)
+        destination = None if destination is None else str(destination)
+        # Another tenant's rows are reported exactly like missing ones
+        if self._products.get(product_id) != tenant_id:
+            raise ValueError(f"Unknown product {product_id}")
+        for warehouse in (source, destination):
+            if warehouse is not None and self._warehouses.get(warehouse) != tenant_id:
+                raise ValueError(f"Unknown warehouse {warehouse}")
+
+        changes = []
+        for warehouse, deltas in ((source, source_deltas), (destination, destination_deltas)):
+            if warehouse is None:
+                continue
+            key = (warehouse, product_id)
+            level = self._levels.get(key) or StockLevel(tenant_id)
+            if level.tenant_id != tenant_id:
+                raise ValueError(f"Unknown warehouse {warehouse}")
+            counts = {name: getattr(level, name) + deltas.get(name, 0) * quantity for name in COUNTERS}
+            if min(counts.values()) < 0 or counts["allocated"] > counts["soh"]:
+                self.moves_rejected += 1
+                raise InsufficientStock(
+                    f"{movement_type} of {quantity} would leave warehouse {warehouse} with "
+                    f"soh={counts['soh']}, sit={counts['sit']}, allocated={counts['allocated']}")
+            changes.append((key, level, counts))
+
+        # Both sides checked; nothing above awaited, so no other move has touched these counters
+        for key, level, counts in changes:
+            self._levels.setdefault(key, level)
+            for name in COUNTERS:
+                setattr(level, name, counts[name])
+
+        movement_id = str(uuid.uuid4())
+        self._movements.append((movement_id, tenant_id, product_id, source, destination, quantity, movement_type,
+                                reference_id and str(reference_id), datetime.now()))
+        self.moves_applied += 1
+        if self._opened is None:
+            self._opened = time.monotonic()
+        return {"movement_id": movement_id,
+                "levels": {key[0]: level.as_dict() for key, level, _ in changes}}
+
+    @property
+    def should_flush(self) -> bool:
+        return len(self._movements) >= self.max_movements
+
+    def _revert(self, movement: tuple) -> None:
+        """Take a refused move back out of the counters"""
+        for key, (_, *counts) in movement_deltas([movement]).items():
+            level = self._levels.get(key)
+            if level is not None:
+                for name, count in zip(COUNTERS, counts):
+                    setattr(level, name, getattr(level, name) - count)
+
+    async def _write_each(self, movements: List[tuple]) -> None:
+        """Replay a refused batch move by move; quarantine the moves Postgres still refuses"""
+        for index, movement in enumerate(movements):
+            try:
+                await asyncio.to_thread(self.writer.write, [movement])
+            except Exception as exc:
+                if self.writer.is_transient(exc):
+                    # Unwritten remainder goes back for the next flush
+                    self._movements[:0] = movements[index:]
+                    raise
+                self._revert(movement)
+                self.movements_quarantined += 1
+                self.quarantined.append({"movement_id": movement[0], "movement_type": movement[6],
+                                         "product_id": movement[2], "quantity": movement[5],
+                                         "error": str(exc).strip() or repr(exc)})
+                del self.quarantined[:-MAX_QUARANTINED]
+                logging.error(f"Stock movement {movement[0]} refused by the database and quarantined: {exc}")
+                continue
+            self.movements_flushed += 1
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._movements:
+                return
+            movements, self._movements = self._movements, []
+            self._opened = None
+            started = time.perf_counter()
+            try:
+                try:
+                    await asyncio.to_thread(self.writer.write, movements)
+                    self.movements_flushed += len(movements)
+                except Exception as exc:
+                    if self.writer.is_transient(exc):
+                        # Put the batch back in front of whatever arrived meanwhile
+                        self._movements[:0] = movements
+                        raise
+                    logging.warning(f"Stock ledger flush of {len(movements)} movements refused ({exc}); "
+                                    f"writing them one by one")
+                    await self._write_each(movements)
+            except Exception as exc:
+                self._opened = self._opened or time.monotonic()
+                self.flush_failures += 1
+                logging.error(f"Stock ledger flush failed, will retry: {exc}")
+                return
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay / 2)
+            if self._opened is not None and time.monotonic() - self._opened >= self.max_delay:
+                await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "levels": len(self._levels),
+            "moves_applied": self.moves_applied,
+            "moves_rejected": self.moves_rejected,
+            "movements_pending": len(self._movements),
+            "movements_flushed": self.movements_flushed,
+            "movements_quarantined": self.movements_quarantined,
+            "flushes": self.flushes,
+            "flush_failures": self.flush_failures,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "recent_quarantined": self.quarantined[-10:]
+        }
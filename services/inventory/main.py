@@ -1,9 +1,11 @@
 from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks
 from pydantic import BaseModel
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, date
+import asyncio
 import logging
+import os
 
 app = FastAPI(title="CoreConnect Inventory Service", version="0.1.0")
 
@@ -36,9 +38,11 @@ class ShipmentCreate(BaseModel):
 
 class StockUpdate(BaseModel):
     product_id: uuid.UUID
-    warehouse_id: uuid.UUID
+    warehouse_id: uuid.UUID # Source warehouse, or the receiving one for inbound moves
     quantity: int
-    movement_type: str # PURCHASE, TRANSFER, SALE, RETURN_FROM_CUSTOMER
+    movement_type: str # PURCHASE, RETURN_FROM_CUSTOMER, RECEIVE, TRANSFER, SALE, WRITE_OFF, ALLOCATE, RELEASE, FULFIL
+    to_warehouse_id: Optional[uuid.UUID] = None # TRANSFER destination
+    reference_id: Optional[uuid.UUID] = None # Order, return or shipment
 
 class SalesPlan(BaseModel):
     product_id: uuid.UUID
@@ -49,6 +53,24 @@ class SalesPlan(BaseModel):
 async def get_current_tenant_id():
     return uuid.UUID("00000000-0000-0000-0000-000000000000")
 
+from .ledger import InsufficientStock, LedgerBusy, LedgerWriter, StockLedger
+
+MAX_BULK_MOVES = 10000
+stock_ledger = StockLedger(
+    LedgerWriter(),
+    max_movements=int(os.getenv("STOCK_FLUSH_MOVEMENTS", 2000)),
+    max_delay=float(os.getenv("STOCK_FLUSH_SECONDS", 1.0)),
+    max_pending=int(os.getenv("STOCK_MAX_PENDING", 100000))
+)
+
+async def resolve_moves(moves: List[StockUpdate], tenant_id: uuid.UUID) -> None:
+    warehouse_ids = [m.warehouse_id for m in moves] + [m.to_warehouse_id for m in moves]
+    await stock_ledger.resolve(tenant_id, warehouse_ids, [m.product_id for m in moves])
+
+def apply_move(move: StockUpdate, tenant_id: uuid.UUID) -> dict:
+    return stock_ledger.move(tenant_id, move.movement_type, move.product_id, move.warehouse_id, move.quantity,
+                             move.to_warehouse_id, move.reference_id)
+
 # --- Routes ---
 @app.get("/")
 async def root():
@@ -67,8 +89,54 @@ async def create_product(product: ProductBase, tenant_id: uuid.UUID = Depends(ge
 @app.post("/stock/move", status_code=status.HTTP_202_ACCEPTED)
 async def move_stock(move: StockUpdate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
     """Handle stock movements including reverse logistics (returns)"""
+    await resolve_moves([move], tenant_id)
+    try:
+        result = apply_move(move, tenant_id)
+    except InsufficientStock as exc:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(exc))
+    except LedgerBusy as exc:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(exc))
     logging.info(f"Stock Movement: {move.movement_type} for {move.product_id} x {move.quantity}")
-    return {"status": "MOVING", "job_id": uuid.uuid4()}
+    if stock_ledger.should_flush:
+        await stock_ledger.flush()
+    return {"status": "APPLIED", **result}
+
+@app.post("/stock/move/bulk", status_code=status.HTTP_202_ACCEPTED)
+async def move_stock_bulk(moves: List[StockUpdate], tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Apply a warehouse scan's moves in order; one result per row, rejected rows leave stock untouched"""
+    if len(moves) > MAX_BULK_MOVES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BULK_MOVES} moves per request")
+    await resolve_moves(moves, tenant_id)
+    results = []
+    for index, move in enumerate(moves):
+        try:
+            results.append({"index": index, "status": "APPLIED", **apply_move(move, tenant_id)})
+        except InsufficientStock as exc:
+            results.append({"index": index, "status": "INSUFFICIENT_STOCK", "error": str(exc)})
+        except LedgerBusy as exc:
+            results.append({"index": index, "status": "BUSY", "error": str(exc)})
+        except ValueError as exc:
+            results.append({"index": index, "status": "INVALID", "error": str(exc)})
+    if stock_ledger.should_flush:
+        await stock_ledger.flush()
+    succeeded = sum(1 for r in results if r["status"] == "APPLIED")
+    return {"total": len(results), "succeeded": succeeded, "failed": len(results) - succeeded, "results": results}
+
+@app.get("/stock/levels/{warehouse_id}/{product_id}")
+async def get_stock_level(warehouse_id: uuid.UUID, product_id: uuid.UUID, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Current SOH, in-transit and allocated stock, straight from the ledger"""
+    level = stock_ledger.level(tenant_id, warehouse_id, product_id)
+    if level is None:
+        raise HTTPException(status_code=404, detail="No stock recorded for this product in this warehouse")
+    return {"warehouse_id": warehouse_id, "product_id": product_id, **level.as_dict()}
+
+@app.get("/stock/ledger")
+async def get_stock_ledger_stats():
+    """Moves applied and how far the write-behind to inventory_levels/stock_movements has got"""
+    return stock_ledger.stats()
 
 @app.post("/warehouses", status_code=status.HTTP_201_CREATED)
 async def create_warehouse(wh: WarehouseCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
@@ -120,6 +188,16 @@ async def startup_event():
     # In a real app, use a task scheduler like Celery or APScheduler
     # For demo, we just log the startup
     logging.info("Inventory Service Started. Auto-Replenishment engine active.")
+    # Counters start from the persisted levels; a ledger that cannot warm (or is held by another
+    # instance) must not take moves
+    levels = await asyncio.to_thread(stock_ledger.load)
+    logging.info(f"Stock ledger warmed with {levels} inventory levels")
+    stock_ledger.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Flush buffered moves before exiting
+    await stock_ledger.stop()
 
 @app.post("/stock/monitor", status_code=status.HTTP_200_OK)
 async def trigger_manual_scan(background_tasks: BackgroundTasks):
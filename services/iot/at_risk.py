@@ -0,0 +1,117 @@
+"""
+Incrementally maintained index of devices with an active signal alert.
+
+The index changes only when a device's alert severity changes, so the
+at-risk report reads the alerting devices in order (most severe first,
+longest-alerting first within a severity) without touching the rest of
+the fleet. Each device is joined to its customer, region and FNO through
+the device directory.
+"""
+
+from bisect import bisect_right, insort
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+import base64
+
+from .directory import DeviceDirectory, DeviceInfo
+from .signal_state import SEVERITY_RANK
+
+# (-severity rank, alert start timestamp, device id): severest and oldest alerts sort first
+RankKey = Tuple[int, float, str]
+
+
+def encode_cursor(key: RankKey) -> str:
+    raw = f"{key[0]}:{key[1]!r}:{key[2]}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> RankKey:
+    """Raises ValueError for a malformed cursor"""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    rank, since, device_id = base64.urlsafe_b64decode(padded.encode()).decode().split(":", 2)
+    return int(rank), float(since), device_id
+
+
+class AtRiskIndex:
+    """Sorted alerting devices, with per-region and per-FNO sublists for filtered reads."""
+
+    def __init__(self, directory: DeviceDirectory):
+        self.directory = directory
+        self._keys: Dict[str, RankKey] = {}
+        self._ranked: List[RankKey] = []
+        self._by_region: Dict[str, List[RankKey]] = {}
+        self._by_fno: Dict[str, List[RankKey]] = {}
+
+    def __len__(self) -> int:
+        return len(self._ranked)
+
+    def severity_counts(self) -> Dict[str, int]:
+        counts = {severity: 0 for severity in SEVERITY_RANK if severity}
+        rank_to_severity = {rank: severity for severity, rank in SEVERITY_RANK.items()}
+        for rank, _, _ in self._keys.values():
+            counts[rank_to_severity[-rank]] += 1
+        return counts
+
+    def _lists_for(self, device_id: str) -> List[List[RankKey]]:
+        lists = [self._ranked]
+        info = self.directory.get(device_id)
+        if info is not None:
+            if info.region:
+                lists.append(self._by_region.setdefault(info.region, []))
+            if info.fno:
+                lists.append(self._by_fno.setdefault(info.fno, []))
+        return lists
+
+    def _insert(self, key: RankKey) -> None:
+        self._keys[key[2]] = key
+        for keys in self._lists_for(key[2]):
+            insort(keys, key)
+
+    def _remove(self, device_id: str) -> None:
+        key = self._keys.pop(device_id, None)
+        if key is None:
+            return
+        for keys in self._lists_for(device_id):
+            position = bisect_right(keys, key) - 1
+            if position >= 0 and keys[position] == key:
+                del keys[position]
+
+    def apply(self, device_id: str, severity: Optional[str], since: Optional[datetime]) -> None:
+        """Move a device to its new severity; called on severity transitions only"""
+        self._remove(device_id)
+        if severity is not None:
+            self._insert((-SEVERITY_RANK[severity], (since or datetime.now()).timestamp(), device_id))
+
+    def update_directory(self, device_id: str, info: DeviceInfo) -> None:
+        """Change a device's customer/region/FNO, re-filing it if it is currently alerting"""
+        key = self._keys.get(device_id)
+        if key is not None:
+            self._remove(device_id)
+        self.directory.put(device_id, info)
+        if key is not None:
+            self._insert(key)
+
+    def scan(self, region: Optional[str] = None, fno: Optional[str] = None,
+             after: Optional[RankKey] = None) -> Iterator[RankKey]:
+        """Alerting devices in report order, resuming after a cursor key"""
+        if region is not None and fno is not None:
+            by_region = self._by_region.get(region, [])
+            by_fno = self._by_fno.get(fno, [])
+            keys = by_region if len(by_region) <= len(by_fno) else by_fno
+        elif region is not None:
+            keys = self._by_region.get(region, [])
+        elif fno is not None:
+            keys = self._by_fno.get(fno, [])
+        else:
+            keys = self._ranked
+
+        start = bisect_right(keys, after) if after is not None else 0
+        for position in range(start, len(keys)):
+            key = keys[position]
+            if region is not None or fno is not None:
+                info = self.directory.get(key[2])
+                if region is not None and info.region != region:
+                    continue
+                if fno is not None and info.fno != fno:
+                    continue
+            yield key
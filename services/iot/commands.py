@@ -0,0 +1,338 @@
+"""
+Bulk command fan-out for the IoT Service.
+
+A bulk request is written to iot_commands in one multi-row insert and
+queued per dispatch target (the OLT a device hangs off, falling back to
+its FNO). A fixed pool of asyncio workers takes work from targets that
+still have a free slot, so no single OLT sees more than
+`per_target_limit` commands in flight and a large outage on one OLT
+does not starve commands for the rest of the fleet. Terminal statuses
+are written back in batches. Progress of a finished batch is kept for
+BATCH_RETENTION_SECONDS (and at most MAX_BATCHES batches), after which
+only iot_commands has it.
+"""
+
+from collections import deque
+from datetime import datetime
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import uuid
+
+COMMAND_TYPES = ("REBOOT", "TOGGLE_POWER", "FIRMWARE_UPDATE")
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 2.0
+MAX_RECORDED_FAILURES = 100
+BATCH_RETENTION_SECONDS = 3600
+MAX_BATCHES = 10000
+
+# send(device_id, command_type, payload) raises on failure
+SendCommand = Callable[[str, str, dict], Awaitable[None]]
+
+INSERT_COMMANDS = (
+    "INSERT INTO iot_commands (id, batch_id, device_id, command_type, payload, status) VALUES %s"
+)
+UPDATE_COMMAND_STATUS = (
+    "UPDATE iot_commands c SET status = v.status, attempts = v.attempts, error = v.error, "
+    "updated_at = CURRENT_TIMESTAMP FROM (VALUES %s) AS v(id, status, attempts, error) "
+    "WHERE c.id = v.id::uuid"
+)
+SELECT_PENDING = (
+    "SELECT id, batch_id, device_id, command_type, payload FROM iot_commands "
+    "WHERE status IN ('PENDING', 'SENT') ORDER BY created_at"
+)
+
+
+class CommandJob:
+    __slots__ = ("id", "batch_id", "device_id", "command_type", "payload", "target", "attempts")
+
+    def __init__(self, batch_id: str, device_id: str, command_type: str, payload: dict, target: str,
+                 command_id: Optional[str] = None):
+        self.id = command_id or str(uuid.uuid4())
+        self.batch_id = batch_id
+        self.device_id = device_id
+        self.command_type = command_type
+        self.payload = payload
+        self.target = target
+        self.attempts = 0
+
+
+class CommandBatch:
+    """Progress counters for one bulk command."""
+
+    def __init__(self, batch_id: str, command_type: str, total: int, selector: dict):
+        self.id = batch_id
+        self.command_type = command_type
+        self.selector = selector
+        self.total = total
+        self.sent = 0
+        self.executed = 0
+        self.failed = 0
+        self.retried = 0
+        self.created_at = datetime.now()
+        self.completed_at: Optional[datetime] = None
+        self.failures: Deque[dict] = deque(maxlen=MAX_RECORDED_FAILURES)
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.sent - self.executed - self.failed
+
+    def progress(self) -> dict:
+        done = self.executed + self.failed
+        return {
+            "batch_id": self.id,
+            "command_type": self.command_type,
+            "selector": self.selector,
+            "total": self.total,
+            "pending": self.pending,
+            "in_flight": self.sent,
+            "executed": self.executed,
+            "failed": self.failed,
+            "retries": self.retried,
+            "percent_complete": round(done / self.total * 100, 1) if self.total else 100.0,
+            "created_at": self.created_at,
+            "completed_at": self.completed_at,
+            "recent_failures": list(self.failures)
+        }
+
+
+class CommandStore:
+    """iot_commands persistence; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+        # insert, update_statuses and load_unfinished run on to_thread workers and share the connection
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn
+
+    def _execute_values(self, sql: str, rows: Sequence[tuple]) -> None:
+        from psycopg2.extras import execute_values
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn.cursor() as cur:
+                    execute_values(cur, sql, rows, page_size=1000)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def insert(self, jobs: Sequence[CommandJob]) -> None:
+        if not self.dsn:
+            logging.debug(f"iot_commands (mock): {len(jobs)} commands queued")
+            return
+        self._execute_values(INSERT_COMMANDS, [
+            (job.id, job.batch_id, job.device_id, job.command_type, json.dumps(job.payload), "PENDING")
+            for job in jobs
+        ])
+
+    def update_statuses(self, updates: Sequence[Tuple[str, str, int, Optional[str]]]) -> None:
+        if not self.dsn or not updates:
+            return
+        self._execute_values(UPDATE_COMMAND_STATUS, updates)
+
+    def load_unfinished(self) -> List[tuple]:
+        """Commands left PENDING or SENT by a previous run, to be dispatched again"""
+        if not self.dsn:
+            return []
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(SELECT_PENDING)
+                    rows = cur.fetchall()
+                # End the read transaction so the connection is not left idle in transaction
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return rows
+
+
+class CommandDispatcher:
+    """Worker pool with a per-target in-flight limit and round-robin across targets."""
+
+    def __init__(self, send: SendCommand, store: CommandStore, workers: int = 64,
+                 per_target_limit: int = 8, timeout: float = 30.0):
+        self.send = send
+        self.store = store
+        self.workers = workers
+        self.per_target_limit = per_target_limit
+        self.timeout = timeout
+        self.batches: Dict[str, CommandBatch] = {}
+        self._pending: Dict[str, Deque[CommandJob]] = {}
+        # Slots per target that are queued in _ready or running; at most per_target_limit
+        self._slots: Dict[str, int] = {}
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._updates: List[Tuple[str, str, int, Optional[str]]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    async def submit(self, command_type: str, devices: Sequence[Tuple[str, str]], payload: dict,
+                     selector: dict) -> CommandBatch:
+        """Persist and queue one command per (device id, target) pair"""
+        batch = CommandBatch(str(uuid.uuid4()), command_type, len(devices), selector)
+        jobs = [CommandJob(batch.id, device_id, command_type, payload, target) for device_id, target in devices]
+        await asyncio.to_thread(self.store.insert, jobs)
+        self._evict_batches()
+        self.batches[batch.id] = batch
+        self._enqueue(jobs)
+        if not jobs:
+            batch.completed_at = datetime.now()
+        return batch
+
+    def _evict_batches(self) -> None:
+        """Forget finished batches past retention, then the oldest finished ones beyond MAX_BATCHES"""
+        now = datetime.now()
+        finished = sorted((batch for batch in self.batches.values() if batch.completed_at is not None),
+                          key=lambda batch: batch.completed_at)
+        excess = len(self.batches) - MAX_BATCHES + 1
+        for batch in finished:
+            if (now - batch.completed_at).total_seconds() < BATCH_RETENTION_SECONDS and excess <= 0:
+                break
+            del self.batches[batch.id]
+            excess -= 1
+
+    def _enqueue(self, jobs: Sequence[CommandJob]) -> None:
+        for job in jobs:
+            self._pending.setdefault(job.target, deque()).append(job)
+            if self._slots.get(job.target, 0) < self.per_target_limit:
+                self._slots[job.target] = self._slots.get(job.target, 0) + 1
+                self._ready.put_nowait(job.target)
+
+    def _release(self, target: str) -> None:
+        """Hand the slot to the target's next command, or give it back"""
+        if self._pending.get(target):
+            self._ready.put_nowait(target)
+            return
+        self._slots[target] -= 1
+        if not self._slots[target]:
+            del self._slots[target]
+            self._pending.pop(target, None)
+
+    async def _worker(self) -> None:
+        while True:
+            target = await self._ready.get()
+            queue = self._pending.get(target)
+            if not queue:
+                self._release(target)
+                continue
+            job = queue.popleft()
+            await self._run(job)
+            self._release(target)
+
+    async def _run(self, job: CommandJob) -> None:
+        batch = self.batches.get(job.batch_id)
+        if batch is not None and job.attempts == 0:
+            batch.sent += 1
+        job.attempts += 1
+        try:
+            await asyncio.wait_for(self.send(job.device_id, job.command_type, job.payload), self.timeout)
+        except Exception as exc:
+            error = str(exc) or type(exc).__name__
+            if job.attempts < MAX_ATTEMPTS:
+                if batch is not None:
+                    batch.retried += 1
+                asyncio.get_running_loop().call_later(
+                    RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1), self._enqueue, [job])
+                return
+            self._finish(job, batch, "FAILED", error)
+            return
+        self._finish(job, batch, "EXECUTED", None)
+
+    def _finish(self, job: CommandJob, batch: Optional[CommandBatch], status: str, error: Optional[str]) -> None:
+        self._updates.append((job.id, status, job.attempts, error))
+        if batch is None:
+            return
+        batch.sent -= 1
+        if status == "EXECUTED":
+            batch.executed += 1
+        else:
+            batch.failed += 1
+            batch.failures.append({"device_id": job.device_id, "attempts": job.attempts, "error": error})
+        if not batch.pending and not batch.sent:
+            batch.completed_at = datetime.now()
+            logging.info(f"Bulk {batch.command_type} {batch.id}: {batch.executed} executed, {batch.failed} failed")
+
+    async def flush_statuses(self) -> None:
+        updates, self._updates = self._updates, []
+        if not updates:
+            return
+        try:
+            await asyncio.to_thread(self.store.update_statuses, updates)
+        except Exception as exc:
+            logging.error(f"Writing {len(updates)} command statuses failed: {exc}")
+            self._updates = updates + self._updates
+
+    async def _flush_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush_statuses()
+
+    async def resume(self, target_for: Callable[[str], str]) -> int:
+        """Re-queue commands a previous run did not finish"""
+        rows = await asyncio.to_thread(self.store.load_unfinished)
+        jobs = []
+        for command_id, batch_id, device_id, command_type, payload in rows:
+            batch_id = str(batch_id) if batch_id else str(command_id)
+            if batch_id not in self.batches:
+                self.batches[batch_id] = CommandBatch(batch_id, command_type, 0, {"resumed": True})
+            self.batches[batch_id].total += 1
+            jobs.append(CommandJob(batch_id, str(device_id), command_type, payload or {},
+                                   target_for(str(device_id)), str(command_id)))
+        self._enqueue(jobs)
+        return len(jobs)
+
+    def queue_depth(self) -> Dict[str, int]:
+        return {target: len(queue) for target, queue in self._pending.items() if queue}
+
+    def start(self, flush_interval: float = 1.0) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._flush_periodically(flush_interval)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.flush_statuses()
+
+
+class DeviceSimulator:
+    """Local stand-in for the device management plane (TR-069 ACS / MQTT) until it is wired in.
+
+    Each command takes a random latency and fails with `failure_rate`; devices listed in
+    `unreachable` always time out.
+    """
+
+    def __init__(self, latency: Tuple[float, float] = (0.05, 0.3), failure_rate: float = 0.02,
+                 unreachable: Optional[set] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.unreachable = unreachable or set()
+        self._random = random.Random(seed)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.received: Dict[str, int] = {}
+
+    async def send(self, device_id: str, command_type: str, payload: dict) -> None:
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if device_id in self.unreachable:
+                await asyncio.sleep(3600)
+            await asyncio.sleep(self._random.uniform(*self.latency))
+            if self._random.random() < self.failure_rate:
+                raise ConnectionError(f"{command_type} not acknowledged by {device_id}")
+            self.received[device_id] = self.received.get(device_id, 0) + 1
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,84 @@
+"""
+Device directory for the IoT Service.
+
+Maps each ONT to its customer, region, FNO and the OLT it hangs off, with
+per-region and per-FNO device sets so reports and bulk commands can
+select a slice of the fleet without scanning it. The OLT is only looked
+up per device, to pick a command's dispatch target.
+"""
+
+from typing import Dict, Iterable, Optional, Set
+import logging
+import os
+
+DIRECTORY_QUERY = (
+    "SELECT d.id, c.first_name || ' ' || c.last_name, d.metadata->>'region', "
+    "COALESCE(d.metadata->>'fno', p.fno_type), d.metadata->>'olt' "
+    "FROM iot_devices d LEFT JOIN contacts c ON c.id = d.contact_id "
+    "LEFT JOIN LATERAL (SELECT pr.fno_type FROM services s JOIN products pr ON pr.id = s.product_id "
+    "WHERE s.contact_id = d.contact_id AND s.status = 'ACTIVE' LIMIT 1) p ON TRUE "
+    "WHERE d.device_type = 'ONT'"
+)
+
+
+class DeviceInfo:
+    __slots__ = ("customer_name", "region", "fno", "olt")
+
+    def __init__(self, customer_name: Optional[str], region: Optional[str], fno: Optional[str],
+                 olt: Optional[str] = None):
+        self.customer_name = customer_name
+        self.region = region
+        self.fno = fno
+        self.olt = olt
+
+
+class DeviceDirectory:
+    """Device id -> customer, region, FNO and OLT."""
+
+    def __init__(self):
+        self._devices: Dict[str, DeviceInfo] = {}
+        self._by_region: Dict[str, Set[str]] = {}
+        self._by_fno: Dict[str, Set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def get(self, device_id: str) -> Optional[DeviceInfo]:
+        return self._devices.get(device_id)
+
+    def put(self, device_id: str, info: DeviceInfo) -> Optional[DeviceInfo]:
+        previous = self._devices.get(device_id)
+        if previous is not None:
+            self._by_region.get(previous.region, set()).discard(device_id)
+            self._by_fno.get(previous.fno, set()).discard(device_id)
+        self._devices[device_id] = info
+        if info.region:
+            self._by_region.setdefault(info.region, set()).add(device_id)
+        if info.fno:
+            self._by_fno.setdefault(info.fno, set()).add(device_id)
+        return previous
+
+    def select(self, region: Optional[str] = None, fno: Optional[str] = None) -> Iterable[str]:
+        """Device ids in a region and/or behind an FNO"""
+        if region is not None and fno is not None:
+            in_region = self._by_region.get(region, set())
+            with_fno = self._by_fno.get(fno, set())
+            return in_region & with_fno
+        if region is not None:
+            return set(self._by_region.get(region, set()))
+        if fno is not None:
+            return set(self._by_fno.get(fno, set()))
+        return []
+
+    def load(self, dsn: Optional[str] = None) -> int:
+        """Bulk load ONTs with their customer, FNO and OLT; no-op without DATABASE_URL"""
+        dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        if not dsn:
+            return 0
+        import psycopg2
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+            cur.execute(DIRECTORY_QUERY)
+            for device_id, customer_name, region, fno, olt in cur:
+                self.put(str(device_id), DeviceInfo(customer_name, region, fno, olt))
+        logging.info(f"Loaded {len(self._devices)} devices into the device directory")
+        return len(self._devices)
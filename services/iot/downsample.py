@@ -0,0 +1,235 @@
+"""
+Downsampling of ONT signal readings into 1 minute, 1 hour and 1 day tiers.
+
+Each tier accumulates min/max/avg of rx, tx and temperature per device
+and bucket. Buckets are written to their rollup table once the bucket
+has ended (plus a grace period for late readings); later stragglers are
+merged in by the upsert. History queries pick the coarsest tier that
+still gives a useful number of points for the requested range.
+"""
+
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+import asyncio
+import logging
+
+import numpy as np
+
+from .ingest import SignalHistoryWriter, SignalRow
+
+
+class RollupTier:
+    __slots__ = ("name", "seconds", "table", "retention", "recent_buckets")
+
+    def __init__(self, name: str, seconds: int, table: str, retention: Optional[timedelta], recent_buckets: int):
+        self.name = name
+        self.seconds = seconds
+        self.table = table
+        self.retention = retention
+        # Closed buckets kept in memory per device so history works without a database
+        self.recent_buckets = recent_buckets
+
+
+TIERS = (
+    RollupTier("1m", 60, "ont_signal_rollup_1m", timedelta(days=30), 180),
+    RollupTier("1h", 3600, "ont_signal_rollup_1h", timedelta(days=400), 168),
+    RollupTier("1d", 86400, "ont_signal_rollup_1d", None, 365),
+)
+
+# Longest range served from each source; anything longer falls through to the next tier
+RAW_MAX_RANGE = timedelta(hours=2)
+TIER_MAX_RANGE = {"1m": timedelta(days=2), "1h": timedelta(days=60), "1d": None}
+
+CLOSE_GRACE_SECONDS = 30
+
+
+class RollupBucket:
+    """Running min/max/sum for one device and bucket."""
+
+    __slots__ = ("samples", "rx_min", "rx_max", "rx_sum",
+                 "tx_n", "tx_min", "tx_max", "tx_sum",
+                 "temp_n", "temp_min", "temp_max", "temp_sum")
+
+    def __init__(self):
+        self.samples = 0
+        self.rx_min = self.tx_min = self.temp_min = float("inf")
+        self.rx_max = self.tx_max = self.temp_max = float("-inf")
+        self.rx_sum = self.tx_sum = self.temp_sum = 0.0
+        self.tx_n = self.temp_n = 0
+
+    def add(self, rx: float, tx: Optional[float], temp: Optional[float]) -> None:
+        self.samples += 1
+        self.rx_sum += rx
+        self.rx_min = min(self.rx_min, rx)
+        self.rx_max = max(self.rx_max, rx)
+        if tx is not None:
+            self.tx_n += 1
+            self.tx_sum += tx
+            self.tx_min = min(self.tx_min, tx)
+            self.tx_max = max(self.tx_max, tx)
+        if temp is not None:
+            self.temp_n += 1
+            self.temp_sum += temp
+            self.temp_min = min(self.temp_min, temp)
+            self.temp_max = max(self.temp_max, temp)
+
+    def merge(self, samples: int, rx_min: float, rx_max: float, rx_sum: float,
+              tx_n: int, tx_min: float, tx_max: float, tx_sum: float,
+              temp_n: int, temp_min: float, temp_max: float, temp_sum: float) -> None:
+        """Fold in partial aggregates computed elsewhere (e.g. per batch with NumPy)"""
+        self.samples += samples
+        self.rx_sum += rx_sum
+        self.rx_min = min(self.rx_min, rx_min)
+        self.rx_max = max(self.rx_max, rx_max)
+        self.tx_n += tx_n
+        self.tx_sum += tx_sum
+        self.tx_min = min(self.tx_min, tx_min)
+        self.tx_max = max(self.tx_max, tx_max)
+        self.temp_n += temp_n
+        self.temp_sum += temp_sum
+        self.temp_min = min(self.temp_min, temp_min)
+        self.temp_max = max(self.temp_max, temp_max)
+
+    def as_row(self, device_id: str, bucket_start: datetime) -> tuple:
+        def stats(n, low, high, total):
+            return (low, high, round(total / n, 3)) if n else (None, None, None)
+        return (
+            device_id, bucket_start, self.samples,
+            *stats(self.samples, self.rx_min, self.rx_max, self.rx_sum),
+            *stats(self.tx_n, self.tx_min, self.tx_max, self.tx_sum),
+            *stats(self.temp_n, self.temp_min, self.temp_max, self.temp_sum),
+        )
+
+
+class SignalDownsampler:
+    """Open rollup buckets for every tier, closed into the rollup tables as time passes."""
+
+    def __init__(self, writer: SignalHistoryWriter, tiers: Sequence[RollupTier] = TIERS):
+        self.writer = writer
+        self.tiers = tiers
+        # tier -> bucket start (epoch seconds) -> device id -> bucket, so closing pops whole buckets
+        self._open: Dict[str, Dict[int, Dict[str, RollupBucket]]] = {tier.name: {} for tier in tiers}
+        self._recent: Dict[str, Dict[str, Deque[tuple]]] = {tier.name: {} for tier in tiers}
+        self.buckets_written = 0
+
+    def add(self, rows: Sequence[SignalRow]) -> None:
+        for tier in self.tiers:
+            open_buckets = self._open[tier.name]
+            width = tier.seconds
+            for device_id, rx, tx, temp, measured_at in rows:
+                start = int(measured_at.timestamp()) // width * width
+                devices = open_buckets.get(start)
+                if devices is None:
+                    devices = open_buckets[start] = {}
+                bucket = devices.get(device_id)
+                if bucket is None:
+                    bucket = devices[device_id] = RollupBucket()
+                bucket.add(rx, tx, temp)
+
+    def add_columns(self, device_ids: Sequence[str], codes: np.ndarray, rx: np.ndarray,
+                    tx: np.ndarray, temp: np.ndarray, epoch_seconds: np.ndarray) -> None:
+        """Columnar add: readings are grouped per device and bucket with NumPy first, so the
+        Python work is one merge per (device, bucket) rather than one add per reading.
+
+        codes[i] indexes device_ids for reading i; missing tx/temp values are NaN.
+        """
+        if not len(codes):
+            return
+        rx = rx.astype(np.float64)
+        columns = [rx, rx, rx]
+        for values in (tx.astype(np.float64), temp.astype(np.float64)):
+            missing = np.isnan(values)
+            columns += [(~missing).astype(np.int64), np.where(missing, np.inf, values),
+                        np.where(missing, -np.inf, values), np.where(missing, 0.0, values)]
+        reducers = [np.minimum, np.maximum, np.add] + [np.add, np.minimum, np.maximum, np.add] * 2
+        seconds = np.floor(epoch_seconds).astype(np.int64)
+
+        for tier in self.tiers:
+            starts = seconds // tier.seconds * tier.seconds
+            order = np.lexsort((starts, codes))
+            sorted_codes, sorted_starts = codes[order], starts[order]
+            boundaries = np.flatnonzero(np.r_[True, (sorted_codes[1:] != sorted_codes[:-1]) |
+                                                    (sorted_starts[1:] != sorted_starts[:-1])])
+            samples = np.diff(np.r_[boundaries, len(order)])
+            partials = [reducer.reduceat(column[order], boundaries).tolist()
+                        for reducer, column in zip(reducers, columns)]
+
+            open_buckets = self._open[tier.name]
+            for code, start, *aggregates in zip(sorted_codes[boundaries].tolist(), sorted_starts[boundaries].tolist(),
+                                                 samples.tolist(), *partials):
+                devices = open_buckets.get(start)
+                if devices is None:
+                    devices = open_buckets[start] = {}
+                device_id = device_ids[code]
+                bucket = devices.get(device_id)
+                if bucket is None:
+                    bucket = devices[device_id] = RollupBucket()
+                bucket.merge(*aggregates)
+
+    def close_due(self, now: datetime) -> Dict[str, List[tuple]]:
+        """Pop every bucket that ended more than the grace period ago, as rollup rows per tier"""
+        cutoff = now.timestamp() - CLOSE_GRACE_SECONDS
+        closed: Dict[str, List[tuple]] = {}
+        for tier in self.tiers:
+            open_buckets = self._open[tier.name]
+            due = [start for start in open_buckets if start + tier.seconds <= cutoff]
+            rows = []
+            for start in sorted(due):
+                bucket_start = datetime.fromtimestamp(start)
+                for device_id, bucket in open_buckets.pop(start).items():
+                    row = bucket.as_row(device_id, bucket_start)
+                    rows.append(row)
+                    recent = self._recent[tier.name].get(device_id)
+                    if recent is None:
+                        recent = self._recent[tier.name][device_id] = deque(maxlen=tier.recent_buckets)
+                    recent.append(row)
+            if rows:
+                closed[tier.name] = rows
+        return closed
+
+    async def flush(self, now: Optional[datetime] = None) -> None:
+        for name, rows in self.close_due(now or datetime.now()).items():
+            tier = next(t for t in self.tiers if t.name == name)
+            try:
+                await asyncio.to_thread(self.writer.upsert_rollups, tier.table, rows)
+                self.buckets_written += len(rows)
+            except Exception as exc:
+                logging.error(f"Rollup flush to {tier.table} failed for {len(rows)} buckets: {exc}")
+
+    async def expire(self, now: datetime, raw_retention_days: int) -> List[str]:
+        """Drop raw partitions past retention and trim the rollup tiers"""
+        await asyncio.to_thread(self.writer.ensure_partitions, now.date())
+        dropped = await asyncio.to_thread(self.writer.drop_expired_partitions, now.date(), raw_retention_days)
+        for tier in self.tiers:
+            if tier.retention is not None:
+                await asyncio.to_thread(self.writer.delete_rollups_before, tier.table, now - tier.retention)
+        return dropped
+
+    def tier_for_range(self, start: datetime, end: datetime) -> Optional[RollupTier]:
+        """Coarsest suitable tier for a range; None means raw samples"""
+        span = end - start
+        if span <= RAW_MAX_RANGE:
+            return None
+        for tier in self.tiers:
+            limit = TIER_MAX_RANGE[tier.name]
+            if limit is None or span <= limit:
+                return tier
+        return self.tiers[-1]
+
+    def history(self, device_id: str, start: datetime, end: datetime) -> Tuple[str, List[tuple]]:
+        """(tier name, rollup rows) for a device over [start, end)"""
+        tier = self.tier_for_range(start, end)
+        if self.writer.dsn:
+            if tier is None:
+                return "raw", self.writer.fetch_raw(device_id, start, end)
+            return tier.name, self.writer.fetch_rollups(tier.table, device_id, start, end)
+
+        # No database: serve the in-memory tier, closed buckets plus the still-open ones
+        tier = tier or self.tiers[0]
+        rows = list(self._recent[tier.name].get(device_id, ()))
+        for bucket_start, devices in sorted(self._open[tier.name].items()):
+            bucket = devices.get(device_id)
+            if bucket is not None:
+                rows.append(bucket.as_row(device_id, datetime.fromtimestamp(bucket_start)))
+        return tier.name, [row for row in rows if start <= row[1] < end]
@@ -0,0 +1,292 @@
+"""
+Buffered bulk ingestion of ONT signal readings into ont_signal_history.
+
+Readings are appended to an in-memory buffer and flushed with a single
+COPY per batch, either when the buffer reaches `max_rows` or when the
+oldest pending reading is `max_delay` seconds old. A failed batch goes
+back in front of the buffer and is retried, keeping at most `max_pending`
+rows while the database is away. The writer also owns
+the daily raw partitions and the downsampled rollup tables.
+
+ont_signal_history has no DEFAULT partition, so a reading is only
+accepted when its day has (or is about to get) a partition: from
+PARTITION_DAYS_BEHIND days ago to PARTITION_DAYS_AHEAD days ahead.
+Anything else is counted as rejected rather than written.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+from datetime import date, datetime, time as day_start, timedelta
+import asyncio
+import csv
+import io
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+# (device_id, rx_power_dbm, tx_power_dbm, temperature_c, measured_at)
+SignalRow = Tuple[str, float, Optional[float], Optional[float], datetime]
+
+COPY_SIGNAL_HISTORY = (
+    "COPY ont_signal_history (device_id, rx_power_dbm, tx_power_dbm, temperature_c, measured_at) "
+    "FROM STDIN WITH (FORMAT csv)"
+)
+
+ROLLUP_COLUMNS = (
+    "device_id, bucket_start, samples, rx_min, rx_max, rx_avg, "
+    "tx_min, tx_max, tx_avg, temp_min, temp_max, temp_avg"
+)
+
+# Late samples for an already-written bucket merge into it with sample-weighted averages
+UPSERT_ROLLUP = (
+    "INSERT INTO {table} AS t (" + ROLLUP_COLUMNS + ") VALUES %s "
+    "ON CONFLICT (device_id, bucket_start) DO UPDATE SET "
+    "samples = t.samples + EXCLUDED.samples, "
+    "rx_min = LEAST(t.rx_min, EXCLUDED.rx_min), rx_max = GREATEST(t.rx_max, EXCLUDED.rx_max), "
+    "rx_avg = (t.rx_avg * t.samples + EXCLUDED.rx_avg * EXCLUDED.samples) / (t.samples + EXCLUDED.samples), "
+    "tx_min = LEAST(t.tx_min, EXCLUDED.tx_min), tx_max = GREATEST(t.tx_max, EXCLUDED.tx_max), "
+    "tx_avg = COALESCE((t.tx_avg * t.samples + EXCLUDED.tx_avg * EXCLUDED.samples) / (t.samples + EXCLUDED.samples), t.tx_avg, EXCLUDED.tx_avg), "
+    "temp_min = LEAST(t.temp_min, EXCLUDED.temp_min), temp_max = GREATEST(t.temp_max, EXCLUDED.temp_max), "
+    "temp_avg = COALESCE((t.temp_avg * t.samples + EXCLUDED.temp_avg * EXCLUDED.samples) / (t.samples + EXCLUDED.samples), t.temp_avg, EXCLUDED.temp_avg)"
+)
+
+PARTITION_PREFIX = "ont_signal_history_p"
+PARTITION_DAYS_BEHIND = 1 # Late readings from yesterday still land in a partition
+PARTITION_DAYS_AHEAD = 3
+
+
+def partition_window(today: date) -> Tuple[float, float]:
+    """Epoch seconds bounding the readings ensure_partitions() has a partition for"""
+    first = datetime.combine(today - timedelta(days=PARTITION_DAYS_BEHIND), day_start())
+    last = datetime.combine(today + timedelta(days=PARTITION_DAYS_AHEAD + 1), day_start())
+    return first.timestamp(), last.timestamp()
+
+
+class SignalHistoryWriter:
+    """Writes batches of readings to Postgres with COPY; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+        # One connection shared by flushes and maintenance running in worker threads
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn
+
+    def copy_rows(self, rows: Sequence[SignalRow]) -> None:
+        if not self.dsn:
+            logging.debug(f"ont_signal_history (mock): {len(rows)} rows")
+            return
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for device_id, rx, tx, temp, measured_at in rows:
+            writer.writerow((device_id, rx, "" if tx is None else tx, "" if temp is None else temp,
+                             measured_at.isoformat()))
+        buf.seek(0)
+        self._execute(lambda cur: cur.copy_expert(COPY_SIGNAL_HISTORY, buf))
+
+    def _execute(self, work):
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn.cursor() as cur:
+                    result = work(cur)
+                conn.commit()
+                return result
+            except Exception:
+                conn.rollback()
+                raise
+
+    def upsert_rollups(self, table: str, rows: Sequence[tuple]) -> None:
+        if not self.dsn or not rows:
+            return
+        from psycopg2.extras import execute_values
+        self._execute(lambda cur: execute_values(cur, UPSERT_ROLLUP.format(table=table), rows, page_size=1000))
+
+    def fetch_rollups(self, table: str, device_id: str, start: datetime, end: datetime) -> List[tuple]:
+        sql = (f"SELECT {ROLLUP_COLUMNS} FROM {table} "
+               "WHERE device_id = %s AND bucket_start >= %s AND bucket_start < %s ORDER BY bucket_start")
+        return self._fetch(sql, (device_id, start, end))
+
+    def fetch_raw(self, device_id: str, start: datetime, end: datetime) -> List[tuple]:
+        sql = ("SELECT measured_at, rx_power_dbm, tx_power_dbm, temperature_c FROM ont_signal_history "
+               "WHERE device_id = %s AND measured_at >= %s AND measured_at < %s ORDER BY measured_at")
+        return self._fetch(sql, (device_id, start, end))
+
+    def _fetch(self, sql: str, params: tuple) -> List[tuple]:
+        def query(cur):
+            cur.execute(sql, params)
+            return cur.fetchall()
+        return self._execute(query)
+
+    def ensure_partitions(self, today: date) -> List[str]:
+        """Create the daily raw partitions covering partition_window(); returns days that failed"""
+        if not self.dsn:
+            return []
+        failed = []
+        for offset in range(-PARTITION_DAYS_BEHIND, PARTITION_DAYS_AHEAD + 1):
+            day = today + timedelta(days=offset)
+            # One transaction per day so a bad day cannot hold back the others
+            try:
+                self._execute(lambda cur: cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {PARTITION_PREFIX}{day:%Y%m%d} PARTITION OF ont_signal_history "
+                    "FOR VALUES FROM (%s) TO (%s)", (day, day + timedelta(days=1))
+                ))
+            except Exception as exc:
+                logging.error(f"Could not create signal partition for {day}: {exc}")
+                failed.append(str(day))
+        return failed
+
+    def drop_expired_partitions(self, today: date, retention_days: int) -> List[str]:
+        """Drop whole raw partitions older than the retention window"""
+        if not self.dsn:
+            return []
+        cutoff = f"{PARTITION_PREFIX}{today - timedelta(days=retention_days):%Y%m%d}"
+
+        def drop(cur):
+            cur.execute(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'ont_signal_history' "
+                "AND c.relname LIKE %s AND c.relname < %s", (PARTITION_PREFIX + "%", cutoff)
+            )
+            expired = [row[0] for row in cur.fetchall()]
+            for name in expired:
+                cur.execute(f"DROP TABLE IF EXISTS {name}")
+            return expired
+        return self._execute(drop)
+
+    def delete_rollups_before(self, table: str, cutoff: datetime) -> None:
+        if self.dsn:
+            self._execute(lambda cur: cur.execute(f"DELETE FROM {table} WHERE bucket_start < %s", (cutoff,)))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+
+class TelemetryBuffer:
+    """Size- or time-triggered batching in front of a SignalHistoryWriter."""
+
+    def __init__(self, writer: SignalHistoryWriter, max_rows: int = 5000, max_delay: float = 1.0,
+                 max_pending: int = 500000):
+        self.writer = writer
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._pending: List[SignalRow] = []
+        self._oldest: Optional[float] = None
+        # After a failed flush, size-triggered flushes wait for the periodic retry
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.started_at = time.monotonic()
+        self.rows_received = 0
+        self.rows_flushed = 0
+        self.rows_failed = 0
+        self.rows_rejected = 0
+        self.flushes = 0
+        self.last_flush_rows = 0
+        self.last_flush_ms = 0.0
+
+    def reject(self, count: int, reason: str = "measured outside the partition window") -> None:
+        self.rows_received += count
+        self.rows_rejected += count
+        logging.warning(f"Rejected {count} signal readings {reason}")
+
+    def screen(self, epoch_seconds: np.ndarray) -> np.ndarray:
+        """Mask of the readings add() will take, for columnar callers; the rest are counted as rejected"""
+        first, last = partition_window(date.today())
+        accepted = (epoch_seconds >= first) & (epoch_seconds < last)
+        rejected = len(accepted) - int(accepted.sum())
+        if rejected:
+            self.reject(rejected)
+        return accepted
+
+    async def add(self, rows: Sequence[SignalRow]) -> List[SignalRow]:
+        """Buffer the rows inside the partition window; returns those, the rest are counted as rejected"""
+        if not rows:
+            return []
+        first, last = partition_window(date.today())
+        accepted = [row for row in rows if first <= row[4].timestamp() < last]
+        if len(accepted) < len(rows):
+            self.reject(len(rows) - len(accepted))
+        if not accepted:
+            return accepted
+        self.rows_received += len(accepted)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._pending.extend(accepted)
+        self._trim()
+        if len(self._pending) >= self.max_rows and time.monotonic() >= self._retry_at:
+            await self.flush()
+        return accepted
+
+    def _trim(self) -> None:
+        """Drop the oldest rows beyond max_pending"""
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            self.rows_failed += overflow
+            logging.error(f"Signal history buffer full, dropped the {overflow} oldest readings")
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending, self._oldest = self._pending, [], None
+            started = time.perf_counter()
+            try:
+                # COPY blocks on the socket, keep it off the event loop
+                await asyncio.to_thread(self.writer.copy_rows, batch)
+            except Exception as exc:
+                # Back in front of anything added meanwhile, for the periodic flush to retry
+                self._pending[:0] = batch
+                self._oldest = time.monotonic()
+                self._retry_at = self._oldest + self.max_delay
+                self._trim()
+                logging.error(f"Signal history flush of {len(batch)} rows failed, will retry: {exc}")
+                return
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.last_flush_rows = len(batch)
+            self.rows_flushed += len(batch)
+            self.flushes += 1
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay / 2)
+            if self._oldest is not None and time.monotonic() - self._oldest >= self.max_delay:
+                await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self.started_at
+        return {
+            "rows_received": self.rows_received,
+            "rows_flushed": self.rows_flushed,
+            "rows_failed": self.rows_failed,
+            "rows_rejected": self.rows_rejected,
+            "rows_pending": len(self._pending),
+            "flushes": self.flushes,
+            "avg_rows_per_flush": round(self.rows_flushed / self.flushes, 1) if self.flushes else 0.0,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "last_flush_rows_per_sec": round(self.last_flush_rows / (self.last_flush_ms / 1000), 1) if self.last_flush_ms else None,
+            "ingest_rows_per_sec": round(self.rows_received / uptime, 1) if uptime else 0.0
+        }
@@ -1,9 +1,23 @@
-from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks, Query, Request, Response
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
 import logging
+import math
+import os
+
+import numpy as np
+
+from .ingest import SignalHistoryWriter, TelemetryBuffer
+from .downsample import SignalDownsampler
+from .signal_state import SignalStateTable, SEVERITY_RANK, DEFAULT_WINDOW
+from .wire import decode_signal_batch, unique_devices, usable_readings, measured_epoch_seconds
+from .wire import to_signal_rows as wire_signal_rows
+from .directory import DeviceDirectory, DeviceInfo
+from .at_risk import AtRiskIndex, encode_cursor, decode_cursor
+from .commands import CommandDispatcher, CommandStore, DeviceSimulator, COMMAND_TYPES
 
 app = FastAPI(title="CoreConnect IoT Service", version="0.1.0")
 
@@ -29,6 +43,17 @@ class CommandRequest(BaseModel):
     command_type: str # REBOOT, TOGGLE_POWER
     payload: Optional[Dict] = {}
 
+class BulkCommandRequest(BaseModel):
+    command_type: str # REBOOT, TOGGLE_POWER
+    payload: Optional[Dict] = {}
+    region: Optional[str] = None
+    fno: Optional[str] = None
+    device_ids: Optional[List[uuid.UUID]] = None
+
+MAX_BATCH_READINGS = 20000
+MAX_BULK_COMMAND_TARGETS = 100000
+MAX_BINARY_READINGS = 200000
+
 # --- IAM Middleware (Stub) ---
 async def get_current_tenant_id():
     return uuid.UUID("00000000-0000-0000-0000-000000000000")
@@ -39,26 +64,131 @@ class SignalTelemetry(BaseModel):
     tx_power_dbm: Optional[float]
     temp_c: Optional[float]
 
+    def is_usable(self) -> bool:
+        # JSON NaN/Infinity parse as floats, and would stay in the rolling state for good
+        return all(value is None or math.isfinite(value) for value in (self.rx_power_dbm, self.tx_power_dbm, self.temp_c))
+    measured_at: Optional[datetime] = None
+
+class SignalTelemetryBatch(BaseModel):
+    readings: List[SignalTelemetry]
+
+class DeviceDirectoryEntry(BaseModel):
+    device_id: uuid.UUID
+    customer_name: Optional[str]
+    region: Optional[str]
+    fno: Optional[str]
+    olt: Optional[str] = None
+
+# --- Bulk Ingestion ---
+telemetry_buffer = TelemetryBuffer(
+    SignalHistoryWriter(),
+    max_rows=int(os.getenv("SIGNAL_FLUSH_ROWS", 5000)),
+    max_delay=float(os.getenv("SIGNAL_FLUSH_SECONDS", 1.0)),
+    max_pending=int(os.getenv("SIGNAL_MAX_PENDING_ROWS", 500000))
+)
+
+downsampler = SignalDownsampler(telemetry_buffer.writer)
+ROLLUP_FLUSH_SECONDS = float(os.getenv("SIGNAL_ROLLUP_FLUSH_SECONDS", 15))
+RAW_RETENTION_DAYS = int(os.getenv("SIGNAL_RAW_RETENTION_DAYS", 14))
+RETENTION_SWEEP_SECONDS = 3600
+
+async def ingest_rows(rows: list) -> list:
+    """Buffer and downsample the rows inside the partition window; returns those rows"""
+    accepted = await telemetry_buffer.add(rows)
+    downsampler.add(accepted)
+    return accepted
+
+async def run_signal_maintenance():
+    """Close finished rollup buckets frequently; create/drop raw partitions hourly"""
+    last_sweep = None
+    while True:
+        now = datetime.now()
+        await downsampler.flush(now)
+        if last_sweep is None or (now - last_sweep).total_seconds() >= RETENTION_SWEEP_SECONDS:
+            try:
+                dropped = await downsampler.expire(now, RAW_RETENTION_DAYS)
+                if dropped:
+                    logging.info(f"Dropped expired signal partitions: {', '.join(dropped)}")
+            except Exception as exc:
+                logging.error(f"Signal retention sweep failed: {exc}")
+            last_sweep = now
+        await asyncio.sleep(ROLLUP_FLUSH_SECONDS)
+
+def to_signal_rows(readings: List[SignalTelemetry]) -> list:
+    now = datetime.now()
+    return [
+        (str(r.device_id), r.rx_power_dbm, r.tx_power_dbm, r.temp_c, r.measured_at or now)
+        for r in readings
+    ]
+
 # --- Proactive Logic ---
-async def analyze_fiber_signal(device_id: uuid.UUID, rx_power: float):
-    """Analyze signal and trigger proactive maintenance if thresholds are breached"""
-    THRESHOLD_CRITICAL = -28.0
-    THRESHOLD_WARNING = -25.0
+signal_states = SignalStateTable(window=int(os.getenv("SIGNAL_WINDOW", DEFAULT_WINDOW)))
+at_risk_index = AtRiskIndex(DeviceDirectory())
+
+# --- Command Dispatch ---
+# In reality, send() would go to the TR-069 ACS / MQTT broker. Until that is wired in, the simulator
+# is the only sender and it reaches no device, so it has to be switched on explicitly (dev/test only);
+# without it commands are refused rather than recorded as EXECUTED
+COMMAND_SIMULATOR = os.getenv("IOT_COMMAND_SIMULATOR", "0") == "1"
+device_simulator = DeviceSimulator()
+command_dispatcher = CommandDispatcher(
+    device_simulator.send,
+    CommandStore(),
+    workers=int(os.getenv("IOT_COMMAND_WORKERS", 64)),
+    per_target_limit=int(os.getenv("IOT_COMMAND_PER_TARGET", 8)),
+    timeout=float(os.getenv("IOT_COMMAND_TIMEOUT_SECONDS", 30))
+)
+
+def require_command_sender() -> None:
+    if not COMMAND_SIMULATOR:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="No device management plane is configured for commands")
+
+def dispatch_target(device_id: str) -> str:
+    """Commands are throttled per OLT, or per FNO when the OLT is unknown"""
+    info = at_risk_index.directory.get(device_id)
+    if info is None:
+        return "unassigned"
+    return info.olt or info.fno or "unassigned"
+
+async def analyze_fiber_signal(device_id: uuid.UUID, rx_power: float, measured_at: Optional[datetime] = None):
+    """Fold a reading into the device's rolling state and alert only when its severity escalates"""
+    state, transition = signal_states.observe(str(device_id), rx_power, measured_at)
+    result = {
+        "alert_triggered": False,
+        "severity": state.severity,
+        "rolling_mean_dbm": round(state.mean, 2),
+        "trend_db_per_reading": round(state.slope, 3)
+    }
+    if transition is None:
+        return result
     
-    severity = None
-    if rx_power <= THRESHOLD_CRITICAL:
-        severity = "CRITICAL"
-    elif rx_power <= THRESHOLD_WARNING:
-        severity = "WARNING"
-        
-    if severity:
-        logging.warning(f"PROACTIVE ALERT: Device {device_id} signal degraded to {rx_power} dBm ({severity})")
+    previous, severity = transition
+    result["alert_triggered"] = handle_transition(str(device_id), previous, severity, state.mean)
+    return result
+
+def handle_transition(device_id: str, previous: Optional[str], severity: Optional[str], rx_mean: float) -> bool:
+    """Update the at-risk index for a severity change; returns True when an alert was raised"""
+    at_risk_index.apply(device_id, severity, signal_states.get(device_id).alert_since)
+    if SEVERITY_RANK[severity] > SEVERITY_RANK[previous]:
+        logging.warning(f"PROACTIVE ALERT: Device {device_id} signal degraded to {rx_mean:.2f} dBm rolling mean ({severity})")
         # In reality, this would:
-        # 1. Check if an open ticket already exists for this device
-        # 2. Create a PROACTIVE maintenance ticket via the Support Service
-        # 3. Notify the NOC via Slack/Webhooks
-        return {"alert_triggered": True, "severity": severity}
-    return {"alert_triggered": False}
+        # 1. Create a PROACTIVE maintenance ticket via the Support Service
+        # 2. Notify the NOC via Slack/Webhooks
+        # The rolling state already de-duplicates, so no lookup for an open alert is needed
+        return True
+    logging.info(f"Signal recovering: Device {device_id} {previous} -> {severity or 'OK'} ({rx_mean:.2f} dBm)")
+    return False
+
+async def analyze_signal_arrays(device_ids: List[str], rx: np.ndarray, epoch_seconds: np.ndarray,
+                                codes: Optional[np.ndarray] = None) -> int:
+    """Vectorised analysis of a batch; per-device Python work only for severity changes"""
+    # Async so background tasks run it on the loop, never the threadpool: the signal
+    # state table and at-risk index are shared with the request handlers, unlocked
+    alerts = 0
+    for device_id, previous, severity in signal_states.observe_many(device_ids, rx, epoch_seconds, codes):
+        alerts += handle_transition(device_id, previous, severity, signal_states.get(device_id).mean)
+    return alerts
 
 # --- Routes ---
 @app.get("/")
@@ -69,25 +199,236 @@ async def root():
 async def ingest_signal_telemetry(data: SignalTelemetry, background_tasks: BackgroundTasks):
     """Real-time signal ingestion from ONTs/OLTs"""
     logging.info(f"Signal Update: {data.device_id} | RX: {data.rx_power_dbm} dBm")
+    if not data.is_usable():
+        telemetry_buffer.reject(1, "with a non-finite reading")
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Readings must be finite numbers")
     
-    # Store in ont_signal_history (Mock)
-    background_tasks.add_task(analyze_fiber_signal, data.device_id, data.rx_power_dbm)
+    if not await ingest_rows(to_signal_rows([data])):
+        return {"status": "rejected", "accepted": 0, "rejected": 1}
+    background_tasks.add_task(analyze_fiber_signal, data.device_id, data.rx_power_dbm, data.measured_at)
     
-    return {"status": "ingested"}
+    return {"status": "ingested", "accepted": 1, "rejected": 0}
+
+async def analyze_signal_rows(rows: list):
+    await analyze_signal_arrays(
+        [row[0] for row in rows],
+        np.array([row[1] for row in rows], dtype=np.float32),
+        np.array([row[4].timestamp() for row in rows])
+    )
+
+@app.post("/telemetry/signal/batch", status_code=status.HTTP_202_ACCEPTED)
+async def ingest_signal_batch(batch: SignalTelemetryBatch, background_tasks: BackgroundTasks):
+    """Bulk signal ingestion: buffered and flushed to ont_signal_history with COPY"""
+    if len(batch.readings) > MAX_BATCH_READINGS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BATCH_READINGS} readings per batch")
+    readings = [r for r in batch.readings if r.is_usable()]
+    if len(readings) < len(batch.readings):
+        telemetry_buffer.reject(len(batch.readings) - len(readings), "with a non-finite reading")
+    accepted = await ingest_rows(to_signal_rows(readings))
+    if accepted:
+        background_tasks.add_task(analyze_signal_rows, accepted)
+    return {"status": "ingested", "accepted": len(accepted), "rejected": len(batch.readings) - len(accepted)}
+
+@app.post("/telemetry/signal/binary", status_code=status.HTTP_202_ACCEPTED)
+async def ingest_signal_binary(request: Request, background_tasks: BackgroundTasks):
+    """High-volume signal ingestion in the packed binary format (see wire.py), no JSON or pydantic per reading"""
+    payload = await request.body()
+    try:
+        records = decode_signal_batch(payload)
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
+    if len(records) > MAX_BINARY_READINGS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BINARY_READINGS} readings per batch")
+    if not len(records):
+        return {"status": "ingested", "accepted": 0, "rejected": 0}
+    
+    usable = usable_readings(records)
+    unusable = len(records) - int(usable.sum())
+    if unusable:
+        records = records[usable]
+        telemetry_buffer.reject(unusable, "with a non-finite reading")
+    epoch_seconds = measured_epoch_seconds(records, datetime.now())
+    in_window = telemetry_buffer.screen(epoch_seconds)
+    rejected = unusable + len(records) - int(in_window.sum())
+    if rejected > unusable:
+        records, epoch_seconds = records[in_window], epoch_seconds[in_window]
+    if not len(records):
+        return {"status": "ingested", "accepted": 0, "rejected": rejected}
+    device_ids, codes = unique_devices(records)
+    await telemetry_buffer.add(wire_signal_rows(records, device_ids, codes, epoch_seconds))
+    downsampler.add_columns(device_ids, codes, records["rx_power_dbm"], records["tx_power_dbm"],
+                            records["temperature_c"], epoch_seconds)
+    background_tasks.add_task(analyze_signal_arrays, device_ids, records["rx_power_dbm"], epoch_seconds, codes)
+    return {"status": "ingested", "accepted": len(records), "rejected": rejected}
+
+@app.get("/telemetry/stats")
+async def get_ingest_stats():
+    """Ingest throughput and flush statistics for the signal history buffer"""
+    return telemetry_buffer.stats()
+
+@app.get("/devices/{device_id}/signal-history")
+async def get_signal_history(
+    device_id: uuid.UUID,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    """Signal history for charts, read from the coarsest tier that suits the range"""
+    end = end or datetime.now()
+    start = start or end - timedelta(hours=24)
+    if start >= end:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="start must be before end")
+    
+    tier, rows = await asyncio.to_thread(downsampler.history, str(device_id), start, end)
+    if tier == "raw":
+        points = [
+            {"measured_at": r[0], "rx_power_dbm": r[1], "tx_power_dbm": r[2], "temperature_c": r[3]}
+            for r in rows
+        ]
+    else:
+        points = [
+            {
+                "bucket_start": r[1], "samples": r[2],
+                "rx_min": r[3], "rx_max": r[4], "rx_avg": r[5],
+                "tx_min": r[6], "tx_max": r[7], "tx_avg": r[8],
+                "temp_min": r[9], "temp_max": r[10], "temp_avg": r[11]
+            }
+            for r in rows
+        ]
+    return {"device_id": device_id, "tier": tier, "start": start, "end": end, "points": points}
+
+_maintenance_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_telemetry_buffer():
+    global _maintenance_task
+    try:
+        await asyncio.to_thread(at_risk_index.directory.load)
+    except Exception as exc:
+        logging.error(f"Device directory load failed, at-risk report will lack customer details: {exc}")
+    telemetry_buffer.start()
+    if COMMAND_SIMULATOR:
+        logging.warning("Device commands go to the simulator (IOT_COMMAND_SIMULATOR=1); no device is contacted")
+        command_dispatcher.start()
+        try:
+            resumed = await command_dispatcher.resume(dispatch_target)
+            if resumed:
+                logging.info(f"Re-queued {resumed} unfinished device commands")
+        except Exception as exc:
+            logging.error(f"Could not re-queue unfinished device commands: {exc}")
+    else:
+        logging.warning("No device management plane configured; device commands are disabled")
+    _maintenance_task = asyncio.create_task(run_signal_maintenance())
+
+@app.on_event("shutdown")
+async def stop_telemetry_buffer():
+    if _maintenance_task is not None:
+        _maintenance_task.cancel()
+    # Close every open bucket; partial buckets merge with later data through the upsert
+    await downsampler.flush(datetime.now() + timedelta(days=2))
+    await telemetry_buffer.stop()
+    await command_dispatcher.stop()
+
+@app.post("/commands", status_code=status.HTTP_202_ACCEPTED)
+async def send_command(command: CommandRequest):
+    """Queue a command for a single device"""
+    require_command_sender()
+    if command.command_type not in COMMAND_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown command type {command.command_type}")
+    device_id = str(command.device_id)
+    batch = await command_dispatcher.submit(command.command_type, [(device_id, dispatch_target(device_id))],
+                                            command.payload or {}, {"device_ids": 1})
+    return batch.progress()
+
+@app.post("/commands/bulk", status_code=status.HTTP_202_ACCEPTED)
+async def send_bulk_command(request: BulkCommandRequest):
+    """Fan a command out to every device in a region, behind an FNO, or in an explicit list"""
+    require_command_sender()
+    if request.command_type not in COMMAND_TYPES:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown command type {request.command_type}")
+    if request.device_ids is None and request.region is None and request.fno is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Select devices by region, fno or device_ids")
+    
+    if request.device_ids is not None:
+        device_ids = list(dict.fromkeys(str(d) for d in request.device_ids))
+        selector = {"device_ids": len(device_ids)}
+    else:
+        device_ids = sorted(at_risk_index.directory.select(region=request.region, fno=request.fno))
+        selector = {"region": request.region, "fno": request.fno}
+    if len(device_ids) > MAX_BULK_COMMAND_TARGETS:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_BULK_COMMAND_TARGETS} devices per bulk command")
+    
+    batch = await command_dispatcher.submit(
+        request.command_type,
+        [(device_id, dispatch_target(device_id)) for device_id in device_ids],
+        request.payload or {},
+        selector
+    )
+    logging.info(f"Bulk {request.command_type} {batch.id} queued for {batch.total} devices")
+    return batch.progress()
+
+@app.get("/commands/bulk/{batch_id}")
+async def get_bulk_command_progress(batch_id: uuid.UUID):
+    batch = command_dispatcher.batches.get(str(batch_id))
+    if batch is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Command batch not found")
+    return batch.progress()
+
+@app.get("/commands/queue")
+async def get_command_queue():
+    """Commands waiting per dispatch target (OLT/FNO)"""
+    return {"targets": command_dispatcher.queue_depth()}
+
+@app.post("/devices/directory")
+async def sync_device_directory(entries: List[DeviceDirectoryEntry]):
+    """Push customer, region, FNO and OLT details for devices (e.g. from CRM on install or move)"""
+    for entry in entries:
+        at_risk_index.update_directory(str(entry.device_id), DeviceInfo(entry.customer_name, entry.region, entry.fno, entry.olt))
+    return {"updated": len(entries), "devices": len(at_risk_index.directory)}
 
 @app.get("/reports/at-risk-signals")
-async def get_at_risk_customers():
-    """Return list of customers with degrading fiber signals"""
-    return [
-        {
-            "customer_name": "Lerato Khumalo",
-            "device_id": uuid.uuid4(),
-            "rx_power": -27.2,
+async def get_at_risk_customers(
+    response: Response,
+    region: Optional[str] = None,
+    fno: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    """Return list of customers with degrading fiber signals, most severe first.
+
+    Reads the at-risk index only; pass the X-Next-Cursor header back as `cursor` for the next page.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    
+    results = []
+    last_key = None
+    for key in at_risk_index.scan(region=region, fno=fno, after=after):
+        if len(results) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(last_key)
+            break
+        device_id = key[2]
+        state = signal_states.get(device_id)
+        info = at_risk_index.directory.get(device_id)
+        results.append({
+            "customer_name": info.customer_name if info else None,
+            "device_id": device_id,
+            "rx_power": round(state.last_rx, 2),
+            "rolling_mean_dbm": round(state.mean, 2),
+            "severity": state.severity,
             "status": "SIGNAL_DEGRADATION",
-            "region": "Cape Town",
-            "fno": "Vumatel"
-        }
-    ]
+            "alert_since": state.alert_since,
+            "region": info.region if info else None,
+            "fno": info.fno if info else None
+        })
+        last_key = key
+    
+    response.headers["X-At-Risk-Total"] = str(len(at_risk_index))
+    return results
 
 if __name__ == "__main__":
     import uvicorn
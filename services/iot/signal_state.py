@@ -0,0 +1,219 @@
+"""
+Rolling per-device optical signal state for proactive alerting.
+
+Each device keeps its last `window` RX readings in a row of a float32
+ring-buffer matrix together with running sums, so the rolling mean and
+the least-squares trend slope update in O(1) per reading. State is held
+column-wise in NumPy arrays so a whole batch of readings is folded in
+with array operations. Alert severity moves with hysteresis: it
+escalates as soon as the rolling mean crosses a threshold, but only
+clears once the mean has recovered past the threshold by `HYSTERESIS_DB`.
+An alert is emitted only on a severity transition.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from datetime import datetime
+
+import numpy as np
+
+THRESHOLD_WARNING = -25.0
+THRESHOLD_CRITICAL = -28.0
+HYSTERESIS_DB = 1.0
+DEFAULT_WINDOW = 10
+
+SEVERITY_RANK = {None: 0, "WARNING": 1, "CRITICAL": 2}
+SEVERITIES = (None, "WARNING", "CRITICAL")
+
+Transition = Tuple[Optional[str], Optional[str]]
+
+
+def severity_for(rx_mean: float, current: Optional[str]) -> Optional[str]:
+    """Target severity for a rolling mean, holding the current level inside the hysteresis band"""
+    code = severity_codes(np.array([rx_mean]), np.array([SEVERITY_RANK[current]], dtype=np.int8))
+    return SEVERITIES[code[0]]
+
+
+def severity_codes(rx_mean: np.ndarray, current: np.ndarray) -> np.ndarray:
+    """Vectorised severity_for over severity codes (0 = OK, 1 = WARNING, 2 = CRITICAL)"""
+    critical = (rx_mean <= THRESHOLD_CRITICAL) | ((current == 2) & (rx_mean <= THRESHOLD_CRITICAL + HYSTERESIS_DB))
+    warning = (rx_mean <= THRESHOLD_WARNING) | ((current > 0) & (rx_mean <= THRESHOLD_WARNING + HYSTERESIS_DB))
+    return np.where(critical, 2, np.where(warning, 1, 0)).astype(np.int8)
+
+
+class DeviceSignalState:
+    """Read-only view of one device's row in a SignalStateTable."""
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: "SignalStateTable", row: int):
+        self.table = table
+        self.row = row
+
+    @property
+    def severity(self) -> Optional[str]:
+        return SEVERITIES[self.table.severity[self.row]]
+
+    @property
+    def count(self) -> int:
+        return int(self.table.count[self.row])
+
+    @property
+    def last_rx(self) -> float:
+        return float(self.table.last_rx[self.row])
+
+    @property
+    def mean(self) -> float:
+        count = self.table.count[self.row]
+        return float(self.table.sum_y[self.row] / count) if count else 0.0
+
+    @property
+    def slope(self) -> float:
+        """Least-squares trend in dBm per reading over the window (negative = degrading)"""
+        return float(self.table.slopes(np.array([self.row]))[0])
+
+    @property
+    def updated_at(self) -> Optional[datetime]:
+        return _to_datetime(self.table.updated_at[self.row])
+
+    @property
+    def alert_since(self) -> Optional[datetime]:
+        return _to_datetime(self.table.alert_since[self.row])
+
+
+def _to_datetime(timestamp: float) -> Optional[datetime]:
+    return None if np.isnan(timestamp) else datetime.fromtimestamp(timestamp)
+
+
+class SignalStateTable:
+    """Device id -> row of column-wise rolling signal state."""
+
+    def __init__(self, window: int = DEFAULT_WINDOW, capacity: int = 1024):
+        self.window = window
+        self._rows: Dict[str, int] = {}
+        self.device_ids: List[str] = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        def grow(name, shape, dtype, fill=0):
+            column = np.full(shape, fill, dtype=dtype)
+            current = getattr(self, name, None)
+            if current is not None:
+                column[:len(current)] = current
+            setattr(self, name, column)
+
+        grow("samples", (capacity, self.window), np.float32)
+        grow("head", capacity, np.int32)
+        grow("count", capacity, np.int32)
+        grow("sum_y", capacity, np.float64)
+        # Sum of i * y_i with i = 0 for the oldest sample in the window
+        grow("sum_iy", capacity, np.float64)
+        grow("severity", capacity, np.int8)
+        grow("last_rx", capacity, np.float32)
+        grow("updated_at", capacity, np.float64, np.nan)
+        grow("alert_since", capacity, np.float64, np.nan)
+
+    def __len__(self) -> int:
+        return len(self.device_ids)
+
+    def get(self, device_id: str) -> Optional[DeviceSignalState]:
+        row = self._rows.get(device_id)
+        return None if row is None else DeviceSignalState(self, row)
+
+    def rows_for(self, device_ids: Sequence[str]) -> np.ndarray:
+        """Row index per device id, allocating rows for devices seen for the first time"""
+        rows = np.empty(len(device_ids), dtype=np.int64)
+        lookup = self._rows
+        for position, device_id in enumerate(device_ids):
+            row = lookup.get(device_id)
+            if row is None:
+                row = lookup[device_id] = len(self.device_ids)
+                self.device_ids.append(device_id)
+            rows[position] = row
+        if len(self.device_ids) > len(self.head):
+            self._allocate(max(len(self.device_ids), 2 * len(self.head)))
+        return rows
+
+    def slopes(self, rows: np.ndarray) -> np.ndarray:
+        n = self.count[rows].astype(np.float64)
+        sum_x = n * (n - 1) / 2
+        sum_xx = (n - 1) * n * (2 * n - 1) / 6
+        denominator = n * sum_xx - sum_x * sum_x
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (n * self.sum_iy[rows] - sum_x * self.sum_y[rows]) / denominator
+        return np.where(n >= 2, slope, 0.0)
+
+    def _push(self, rows: np.ndarray, rx: np.ndarray, at: np.ndarray) -> np.ndarray:
+        """Fold one reading into each of `rows` (no row repeated); returns the previous severity codes"""
+        window = self.window
+        head = self.head[rows]
+        oldest = self.samples[rows, head].astype(np.float64)
+        self.samples[rows, head] = rx
+        y = self.samples[rows, head].astype(np.float64)  # rounded to float32, keeps the sums consistent
+        count = self.count[rows]
+        full = count >= window
+        sum_y = self.sum_y[rows]
+        # Once full, every remaining sample shifts down one position and the new one lands at window - 1
+        self.sum_iy[rows] = np.where(full, self.sum_iy[rows] + (window - 1) * y - (sum_y - oldest),
+                                     self.sum_iy[rows] + count * y)
+        self.sum_y[rows] = np.where(full, sum_y + y - oldest, sum_y + y)
+        self.count[rows] = np.where(full, count, count + 1)
+        self.head[rows] = (head + 1) % window
+        self.last_rx[rows] = rx
+        self.updated_at[rows] = at
+
+        previous = self.severity[rows]
+        target = severity_codes(self.sum_y[rows] / self.count[rows], previous)
+        self.severity[rows] = target
+        self.alert_since[rows] = np.where(target == 0, np.nan,
+                                          np.where(previous == 0, at, self.alert_since[rows]))
+        return previous
+
+    def observe_many(self, device_ids: Sequence[str], rx: np.ndarray, at: np.ndarray,
+                     codes: Optional[np.ndarray] = None) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """Fold a batch of readings (in arrival order per device) into the table.
+
+        `at` holds epoch seconds. With `codes`, `device_ids` are the distinct devices and
+        codes[i] is the device of reading i. Returns (device id, previous, new) for every
+        severity change.
+        """
+        rows = self.rows_for(device_ids)
+        if codes is not None:
+            rows = rows[codes]
+        rx = np.asarray(rx, dtype=np.float32)
+        at = np.asarray(at, dtype=np.float64)
+        # A NaN or inf would stay in the rolling sums for good; such readings are skipped
+        finite = np.isfinite(rx)
+        if not finite.all():
+            rows, rx, at = rows[finite], rx[finite], at[finite]
+
+        # Readings for the same device are applied in rounds, each round touching a device once
+        order = np.argsort(rows, kind="stable")
+        sorted_rows = rows[order]
+        group_starts = np.flatnonzero(np.r_[True, sorted_rows[1:] != sorted_rows[:-1]])
+        sizes = np.diff(np.r_[group_starts, len(rows)])
+        occurrence = np.arange(len(rows)) - np.repeat(group_starts, sizes)
+
+        transitions = []
+        by_round = order[np.argsort(occurrence, kind="stable")]
+        round_sizes = np.bincount(occurrence)
+        offset = 0
+        for size in round_sizes:
+            batch = by_round[offset:offset + size]
+            offset += size
+            batch_rows = rows[batch]
+            previous = self._push(batch_rows, rx[batch], at[batch])
+            changed = np.flatnonzero(previous != self.severity[batch_rows])
+            for position in changed:
+                row = batch_rows[position]
+                transitions.append((self.device_ids[row], SEVERITIES[previous[position]], SEVERITIES[self.severity[row]]))
+        return transitions
+
+    def observe(self, device_id: str, rx: float, at: Optional[datetime] = None) -> Tuple[DeviceSignalState, Optional[Transition]]:
+        """Fold one reading into the device state.
+
+        Returns the state and, only when the severity changed, a (previous, new) transition.
+        """
+        timestamp = (at or datetime.now()).timestamp()
+        transitions = self.observe_many([device_id], np.array([rx]), np.array([timestamp]))
+        state = DeviceSignalState(self, self._rows[device_id])
+        return state, (transitions[0][1:] if transitions else None)
@@ -0,0 +1,94 @@
+"""
+Compact binary wire format for high-volume ONT/OLT signal telemetry.
+
+A payload is an 8 byte header (magic b"SIG1", little-endian uint32
+record count) followed by fixed-width 36 byte little-endian records:
+
+    device_id     16 bytes  UUID in network byte order (uuid.UUID.bytes)
+    rx_power_dbm  float32
+    tx_power_dbm  float32   NaN when not reported
+    temperature_c float32   NaN when not reported
+    measured_at   int64     epoch milliseconds, 0 = time of receipt
+
+Payloads are decoded with np.frombuffer, i.e. without copying, into a
+structured array that the ingest path works on column by column.
+"""
+
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+import uuid
+
+import numpy as np
+
+SIGNAL_MAGIC = b"SIG1"
+SIGNAL_HEADER = np.dtype([("magic", "S4"), ("count", "<u4")])
+SIGNAL_RECORD = np.dtype([
+    ("device_id", "V16"),
+    ("rx_power_dbm", "<f4"),
+    ("tx_power_dbm", "<f4"),
+    ("temperature_c", "<f4"),
+    ("measured_at", "<i8"),
+])
+CONTENT_TYPE = "application/vnd.coreconnect.signal+octet-stream"
+
+
+def decode_signal_batch(payload: bytes) -> np.ndarray:
+    """Structured array view over the records of a payload; raises ValueError if malformed"""
+    if len(payload) < SIGNAL_HEADER.itemsize:
+        raise ValueError("Payload shorter than header")
+    header = np.frombuffer(payload, dtype=SIGNAL_HEADER, count=1)[0]
+    if header["magic"] != SIGNAL_MAGIC:
+        raise ValueError("Unknown payload magic")
+    count = int(header["count"])
+    expected = SIGNAL_HEADER.itemsize + count * SIGNAL_RECORD.itemsize
+    if len(payload) != expected:
+        raise ValueError(f"Header declares {count} records ({expected} bytes), got {len(payload)} bytes")
+    return np.frombuffer(payload, dtype=SIGNAL_RECORD, count=count, offset=SIGNAL_HEADER.itemsize)
+
+
+def encode_signal_batch(device_ids: Sequence[uuid.UUID], rx: Sequence[float],
+                        tx: Optional[Sequence[float]] = None, temperature: Optional[Sequence[float]] = None,
+                        measured_at: Optional[Sequence[datetime]] = None) -> bytes:
+    """Client-side encoder (used by collectors and load tests)"""
+    records = np.zeros(len(device_ids), dtype=SIGNAL_RECORD)
+    records["device_id"] = np.frombuffer(b"".join(d.bytes for d in device_ids), dtype="V16")
+    records["rx_power_dbm"] = rx
+    records["tx_power_dbm"] = np.nan if tx is None else tx
+    records["temperature_c"] = np.nan if temperature is None else temperature
+    if measured_at is not None:
+        records["measured_at"] = [int(at.timestamp() * 1000) for at in measured_at]
+    header = np.array([(SIGNAL_MAGIC, len(records))], dtype=SIGNAL_HEADER)
+    return header.tobytes() + records.tobytes()
+
+
+def usable_readings(records: np.ndarray) -> np.ndarray:
+    """Mask of records with a finite rx and no infinite tx/temperature (NaN there means not reported)"""
+    return (np.isfinite(records["rx_power_dbm"]) & ~np.isinf(records["tx_power_dbm"])
+            & ~np.isinf(records["temperature_c"]))
+
+
+def unique_devices(records: np.ndarray) -> Tuple[List[str], np.ndarray]:
+    """Distinct device ids as canonical UUID strings, plus each record's index into them"""
+    unique, codes = np.unique(records["device_id"], return_inverse=True)
+    digits = unique.tobytes().hex()
+    device_ids = [
+        f"{digits[i:i + 8]}-{digits[i + 8:i + 12]}-{digits[i + 12:i + 16]}-{digits[i + 16:i + 20]}-{digits[i + 20:i + 32]}"
+        for i in range(0, len(digits), 32)
+    ]
+    return device_ids, codes.reshape(-1)
+
+
+def measured_epoch_seconds(records: np.ndarray, received_at: datetime) -> np.ndarray:
+    millis = records["measured_at"]
+    return np.where(millis > 0, millis / 1000.0, received_at.timestamp())
+
+
+def to_signal_rows(records: np.ndarray, device_ids: List[str], codes: np.ndarray, epoch_seconds: np.ndarray) -> list:
+    """SignalRow tuples for the history buffer; NaN becomes None"""
+    def optional(column):
+        return [None if value != value else value for value in records[column].tolist()]
+    # Collectors usually stamp a whole batch with a handful of distinct times
+    stamps = epoch_seconds.tolist()
+    moments = {at: datetime.fromtimestamp(at) for at in set(stamps)}
+    return list(zip([device_ids[code] for code in codes.tolist()], records["rx_power_dbm"].tolist(),
+                    optional("tx_power_dbm"), optional("temperature_c"), [moments[at] for at in stamps]))
@@ -0,0 +1,324 @@
+"""
+RADIUS accounting ingestion into radacct.
+
+FreeRADIUS forwards Start, Interim-Update and Stop records as they
+arrive. Records are coalesced per acctuniqueid inside a flush window, so
+a session that sends several interim updates in one window costs a
+single row in the flush. Each flush is one multi-row
+INSERT ... ON CONFLICT (acctuniqueid) DO UPDATE, and the merge rules in
+the upsert make the result independent of the order records arrive in.
+The same statement adds each session's counter growth to the per-username
+daily rollups in usage_daily.
+
+A flush that fails is put back, merged with whatever arrived for the same
+sessions since, and retried on the next timer tick; a lost Stop or NAS
+reset would otherwise leave sessions open in radacct indefinitely.
+"""
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+ACCT_START = "Start"
+ACCT_INTERIM = "Interim-Update"
+ACCT_STOP = "Stop"
+ACCT_ON = "Accounting-On"
+ACCT_OFF = "Accounting-Off"
+
+RADACCT_COLUMNS = (
+    "acctsessionid", "acctuniqueid", "username", "realm", "nasipaddress", "nasportid", "nasporttype",
+    "acctstarttime", "acctupdatetime", "acctstoptime", "acctinterval", "acctsessiontime", "acctauthentic",
+    "connectinfo_start", "connectinfo_stop", "acctinputoctets", "acctoutputoctets", "calledstationid",
+    "callingstationid", "acctterminatecause", "servicetype", "framedprotocol", "framedipaddress",
+)
+
+RADACCT_TYPES = (
+    "text", "text", "text", "text", "inet", "text", "text",
+    "timestamptz", "timestamptz", "timestamptz", "integer", "bigint", "text",
+    "text", "text", "bigint", "bigint", "text",
+    "text", "text", "text", "text", "inet",
+)
+# Explicit casts: a VALUES column that is NULL in every row would otherwise be typed text
+RADACCT_TEMPLATE = "(" + ", ".join(f"%s::{t}" for t in RADACCT_TYPES) + ")"
+
+# Counters and times only move forward; start/stop details are kept from whichever record carried them.
+# The octets each upsert adds on top of the stored counters are folded into usage_daily in the same
+# statement, so the daily rollups never need a rescan of radacct.
+UPSERT_RADACCT = (
+    "WITH incoming (" + ", ".join(RADACCT_COLUMNS) + ") AS (VALUES %s), "
+    "previous AS (SELECT acctuniqueid, acctinputoctets, acctoutputoctets FROM radacct "
+    "WHERE acctuniqueid IN (SELECT acctuniqueid FROM incoming) ORDER BY acctuniqueid FOR UPDATE), "
+    "upserted AS (INSERT INTO radacct AS r (" + ", ".join(RADACCT_COLUMNS) + ") SELECT * FROM incoming "
+    "ON CONFLICT (acctuniqueid) DO UPDATE SET "
+    "acctstarttime = LEAST(r.acctstarttime, EXCLUDED.acctstarttime), "
+    "acctupdatetime = GREATEST(r.acctupdatetime, EXCLUDED.acctupdatetime), "
+    "acctstoptime = COALESCE(r.acctstoptime, EXCLUDED.acctstoptime), "
+    "acctinterval = COALESCE(EXCLUDED.acctinterval, r.acctinterval), "
+    "acctsessiontime = GREATEST(r.acctsessiontime, EXCLUDED.acctsessiontime), "
+    "acctinputoctets = GREATEST(r.acctinputoctets, EXCLUDED.acctinputoctets), "
+    "acctoutputoctets = GREATEST(r.acctoutputoctets, EXCLUDED.acctoutputoctets), "
+    "connectinfo_start = COALESCE(r.connectinfo_start, EXCLUDED.connectinfo_start), "
+    "connectinfo_stop = COALESCE(EXCLUDED.connectinfo_stop, r.connectinfo_stop), "
+    "acctterminatecause = COALESCE(EXCLUDED.acctterminatecause, r.acctterminatecause), "
+    "framedipaddress = COALESCE(EXCLUDED.framedipaddress, r.framedipaddress) "
+    "RETURNING r.acctuniqueid, r.username, r.acctupdatetime, r.acctinputoctets, r.acctoutputoctets), "
+    "deltas AS (SELECT u.username, u.acctupdatetime::date AS usage_date, "
+    "SUM(GREATEST(COALESCE(u.acctinputoctets, 0) - COALESCE(p.acctinputoctets, 0), 0)) AS input_octets, "
+    "SUM(GREATEST(COALESCE(u.acctoutputoctets, 0) - COALESCE(p.acctoutputoctets, 0), 0)) AS output_octets "
+    "FROM upserted u LEFT JOIN previous p USING (acctuniqueid) GROUP BY 1, 2) "
+    "INSERT INTO usage_daily AS d (username, usage_date, input_octets, output_octets) "
+    "SELECT username, usage_date, input_octets, output_octets FROM deltas "
+    "WHERE input_octets > 0 OR output_octets > 0 "
+    "ON CONFLICT (username, usage_date) DO UPDATE SET "
+    "input_octets = d.input_octets + EXCLUDED.input_octets, "
+    "output_octets = d.output_octets + EXCLUDED.output_octets, updated_at = CURRENT_TIMESTAMP"
+)
+
+CLOSE_NAS_SESSIONS = (
+    "UPDATE radacct SET acctstoptime = %s, acctterminatecause = %s, "
+    "acctsessiontime = GREATEST(acctsessiontime, EXTRACT(EPOCH FROM (%s - acctstarttime))::bigint) "
+    "WHERE nasipaddress = %s AND acctstoptime IS NULL AND acctstarttime <= %s"
+)
+
+
+def acct_unique_id(username: str, session_id: str, nas_ip: str, nas_port_id: Optional[str]) -> str:
+    """Same role as FreeRADIUS' acct_unique policy when the NAS record does not carry one"""
+    return hashlib.md5(f"{username},{session_id},{nas_ip},{nas_port_id or ''}".encode()).hexdigest()
+
+
+def local_time(moment: Optional[datetime]) -> Optional[datetime]:
+    """Naive local time, as used throughout the service, for timezone-aware inputs"""
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone().replace(tzinfo=None)
+
+
+def record_unique_id(record) -> str:
+    return record.acct_unique_id or acct_unique_id(
+        record.username, record.acct_session_id, record.nas_ip_address, record.nas_port_id)
+
+
+def octets(low: Optional[int], gigawords: Optional[int]) -> Optional[int]:
+    if low is None:
+        return None
+    return (gigawords or 0) * 2 ** 32 + low
+
+
+class SessionUpdate:
+    """All accounting seen for one acctuniqueid within the current flush window."""
+
+    __slots__ = ("session_id", "unique_id", "username", "realm", "nas_ip", "nas_port_id", "nas_port_type",
+                 "start_time", "update_time", "stop_time", "interval", "session_time", "authentic",
+                 "connect_info_start", "connect_info_stop", "input_octets", "output_octets",
+                 "called_station_id", "calling_station_id", "terminate_cause", "service_type",
+                 "framed_protocol", "framed_ip", "records")
+
+    def __init__(self, unique_id: str, session_id: str, username: str, nas_ip: str):
+        self.unique_id = unique_id
+        self.session_id = session_id
+        self.username = username
+        self.nas_ip = nas_ip
+        self.realm = ""
+        self.nas_port_id = self.nas_port_type = None
+        self.start_time = self.update_time = self.stop_time = None
+        self.interval = self.session_time = None
+        self.authentic = self.connect_info_start = self.connect_info_stop = None
+        self.input_octets = self.output_octets = None
+        self.called_station_id = self.calling_station_id = None
+        self.terminate_cause = self.service_type = self.framed_protocol = self.framed_ip = None
+        self.records = 0
+
+    def merge(self, record) -> None:
+        """Fold one accounting record in, with the same rules as the upsert"""
+        self.records += 1
+        event_time = record.event_time
+        session_time = record.session_time or 0
+        start_time = event_time - timedelta(seconds=session_time)
+        self.start_time = start_time if self.start_time is None else min(self.start_time, start_time)
+        self.update_time = event_time if self.update_time is None else max(self.update_time, event_time)
+        self.session_time = session_time if self.session_time is None else max(self.session_time, session_time)
+
+        for field, value in (("input_octets", octets(record.input_octets, record.input_gigawords)),
+                             ("output_octets", octets(record.output_octets, record.output_gigawords))):
+            if value is not None:
+                current = getattr(self, field)
+                setattr(self, field, value if current is None else max(current, value))
+
+        self.realm = record.realm or self.realm
+        self.nas_port_id = record.nas_port_id or self.nas_port_id
+        self.nas_port_type = record.nas_port_type or self.nas_port_type
+        self.interval = record.interim_interval or self.interval
+        self.authentic = record.authentic or self.authentic
+        self.called_station_id = record.called_station_id or self.called_station_id
+        self.calling_station_id = record.calling_station_id or self.calling_station_id
+        self.service_type = record.service_type or self.service_type
+        self.framed_protocol = record.framed_protocol or self.framed_protocol
+        self.framed_ip = record.framed_ip_address or self.framed_ip
+        if record.status_type == ACCT_START:
+            self.connect_info_start = record.connect_info or self.connect_info_start
+        elif record.status_type == ACCT_STOP:
+            self.stop_time = event_time if self.stop_time is None else min(self.stop_time, event_time)
+            self.connect_info_stop = record.connect_info or self.connect_info_stop
+            self.terminate_cause = record.terminate_cause or self.terminate_cause
+
+    def absorb(self, earlier: "SessionUpdate") -> None:
+        """Fold in an earlier window's update for the same session (one whose flush failed)"""
+        self.records += earlier.records
+        for field, pick in (("start_time", min), ("update_time", max), ("stop_time", min),
+                            ("session_time", max), ("input_octets", max), ("output_octets", max)):
+            mine, theirs = getattr(self, field), getattr(earlier, field)
+            setattr(self, field, theirs if mine is None else mine if theirs is None else pick(mine, theirs))
+        # Anything else: this window's value where it has one, as merge() does for a later record
+        for field in ("realm", "nas_port_id", "nas_port_type", "interval", "authentic", "connect_info_start",
+                      "connect_info_stop", "called_station_id", "calling_station_id", "terminate_cause",
+                      "service_type", "framed_protocol", "framed_ip"):
+            setattr(self, field, getattr(self, field) or getattr(earlier, field))
+
+    def as_row(self) -> tuple:
+        return (
+            self.session_id, self.unique_id, self.username, self.realm, self.nas_ip, self.nas_port_id,
+            self.nas_port_type, self.start_time, self.update_time, self.stop_time, self.interval,
+            self.session_time, self.authentic, self.connect_info_start, self.connect_info_stop,
+            self.input_octets, self.output_octets, self.called_station_id, self.calling_station_id,
+            self.terminate_cause, self.service_type, self.framed_protocol, self.framed_ip,
+        )
+
+
+class RadacctWriter:
+    """Upserts coalesced sessions into radacct; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn
+
+    def write(self, sessions: Sequence[SessionUpdate], nas_resets: Sequence[Tuple[str, datetime, str]]) -> None:
+        if not self.dsn:
+            logging.debug(f"radacct (mock): {len(sessions)} sessions upserted, {len(nas_resets)} NAS resets")
+            return
+        from psycopg2.extras import execute_values
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                # Sorted keys keep row lock order stable across concurrent flushes
+                rows = sorted((session.as_row() for session in sessions), key=lambda row: row[1])
+                if rows:
+                    execute_values(cur, UPSERT_RADACCT, rows, template=RADACCT_TEMPLATE, page_size=1000)
+                for nas_ip, event_time, cause in nas_resets:
+                    cur.execute(CLOSE_NAS_SESSIONS, (event_time, cause, event_time, nas_ip, event_time))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+
+
+class AccountingBuffer:
+    """Coalesces accounting per session and flushes on size or age of the window."""
+
+    def __init__(self, writer: RadacctWriter, max_sessions: int = 5000, max_delay: float = 2.0):
+        self.writer = writer
+        self.max_sessions = max_sessions
+        self.max_delay = max_delay
+        self._pending: Dict[str, SessionUpdate] = {}
+        self._nas_resets: List[Tuple[str, datetime, str]] = []
+        self._opened: Optional[float] = None
+        # After a failed flush, size-triggered flushes wait for the periodic retry
+        self._retry_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.records_received = 0
+        self.sessions_flushed = 0
+        self.flush_failures = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+
+    async def add(self, records: Sequence) -> None:
+        for record in records:
+            if record.status_type in (ACCT_ON, ACCT_OFF):
+                # NAS rebooted: every session it still has open in radacct is over
+                self._nas_resets.append((record.nas_ip_address, record.event_time, "NAS-Reboot"))
+                continue
+            unique_id = record_unique_id(record)
+            session = self._pending.get(unique_id)
+            if session is None:
+                session = self._pending[unique_id] = SessionUpdate(
+                    unique_id, record.acct_session_id, record.username, record.nas_ip_address)
+            session.merge(record)
+        self.records_received += len(records)
+        if self._opened is None:
+            self._opened = time.monotonic()
+        if len(self._pending) >= self.max_sessions and time.monotonic() >= self._retry_at:
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending and not self._nas_resets:
+                return
+            sessions, self._pending = list(self._pending.values()), {}
+            resets, self._nas_resets = self._nas_resets, []
+            self._opened = None
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.writer.write, sessions, resets)
+            except Exception as exc:
+                self._requeue(sessions, resets)
+                self.flush_failures += 1
+                logging.error(f"radacct flush of {len(sessions)} sessions failed, will retry: {exc}")
+                return
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+            self.sessions_flushed += len(sessions)
+            self.flushes += 1
+
+    def _requeue(self, sessions: List[SessionUpdate], resets: List[Tuple[str, datetime, str]]) -> None:
+        """Put a failed window back, merged with the records that arrived since"""
+        for session in sessions:
+            newer = self._pending.get(session.unique_id)
+            if newer is None:
+                self._pending[session.unique_id] = session
+            else:
+                newer.absorb(session)
+        self._nas_resets[:0] = resets
+        self._opened = time.monotonic()
+        self._retry_at = self._opened + self.max_delay
+
+    async def _flush_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.max_delay / 2)
+            if self._opened is not None and time.monotonic() - self._opened >= self.max_delay:
+                await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        self.writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "records_received": self.records_received,
+            "flush_failures": self.flush_failures,
+            "nas_resets_pending": len(self._nas_resets),
+            "sessions_pending": len(self._pending),
+            "sessions_flushed": self.sessions_flushed,
+            "flushes": self.flushes,
+            "records_per_row_written": round(self.records_received / self.sessions_flushed, 2) if self.sessions_flushed else None,
+            "last_flush_ms": round(self.last_flush_ms, 2)
+        }
@@ -1,29 +1,69 @@
 from .base import FNOAdapter
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import httpx
 import logging
 
+def http2_available() -> bool:
+    """httpx needs the h2 package (httpx[http2]) for HTTP/2; without it every client would fail"""
+    try:
+        import h2
+    except ImportError:
+        logging.warning("h2 is not installed; FNO API clients fall back to HTTP/1.1")
+        return False
+    return True
+
 class APIFNOAdapter(FNOAdapter):
     """Adapter for FNOs that provide a REST API"""
     
-    def __init__(self, fno_name: str, api_key: str, base_url: str):
+    def __init__(self, fno_name: str, api_key: str, base_url: str,
+                 client: Optional[httpx.AsyncClient] = None, mock: bool = True):
         self.fno_name = fno_name
         self.api_key = api_key
         self.base_url = base_url
+        self.mock = mock
+        # Long-lived pooled client (keep-alive, HTTP/2) owned by the adapter registry; a mock adapter needs none
+        self.client = client
+        if self.client is None and not mock:
+            self.client = httpx.AsyncClient(
+                base_url=base_url, headers={"Authorization": f"Bearer {api_key}"}, http2=http2_available()
+            )
 
     async def check_availability(self, address: str) -> Dict[str, Any]:
         logging.info(f"Checking API for {self.fno_name} at {address}")
-        # Mock API call
+        if self.mock:
+            # Mock API call
+            return {
+                "fno": self.fno_name,
+                "available": True,
+                "provider_type": "API",
+                "technologies": ["GPON", "XGS-PON"]
+            }
+        
+        response = await self.client.get("/v1/availability", params={"address": address})
+        response.raise_for_status()
+        data = response.json()
         return {
             "fno": self.fno_name,
-            "available": True,
+            "available": bool(data.get("available")),
             "provider_type": "API",
-            "technologies": ["GPON", "XGS-PON"]
+            "technologies": data.get("technologies", [])
         }
 
     async def place_order(self, customer_data: Dict[str, Any], plan_id: str) -> Dict[str, Any]:
-        # Mock API Order
-        return {"status": "SUCCESS", "order_id": f"API-{self.fno_name}-123"}
+        if self.mock:
+            # Mock API Order
+            return {"status": "SUCCESS", "order_id": f"API-{self.fno_name}-123"}
+        
+        response = await self.client.post("/v1/orders", json={"customer": customer_data, "plan_id": plan_id})
+        response.raise_for_status()
+        return {"status": "SUCCESS", "order_id": response.json().get("order_id")}
 
     async def cancel_order(self, order_id: str) -> Dict[str, Any]:
+        if not self.mock:
+            response = await self.client.delete(f"/v1/orders/{order_id}")
+            response.raise_for_status()
         return {"status": "CANCELLED"}
+
+    async def aclose(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
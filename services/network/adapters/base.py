@@ -18,3 +18,7 @@ class FNOAdapter(ABC):
     async def cancel_order(self, order_id: str) -> Dict[str, Any]:
         """Cancel an existing order or service"""
         pass
+
+    async def aclose(self) -> None:
+        """Release pooled resources (connections, browser sessions) when the adapter is evicted"""
+        pass
@@ -1,35 +1,111 @@
 from .base import FNOAdapter
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import logging
 import asyncio
+import time
 
-class BrowserFNOAdapter(FNOAdapter):
-    """Adapter for FNOs requiring Browser Automation (Portals)"""
-    
-    def __init__(self, fno_name: str, portal_url: str, credentials: Dict[str, str]):
-        self.fno_name = fno_name
-        self.portal_url = portal_url
-        self.credentials = credentials
+# Mock timings: logging in dominates, the search itself is quick once authenticated
+LOGIN_SECONDS = 1.5
+SCRAPE_SECONDS = 0.5
+
+class PortalSession:
+    """One authenticated FNO portal session (a Playwright browser context in production)"""
+
+    def __init__(self, owner: "BrowserFNOAdapter"):
+        self.owner = owner
+        self.logged_in_at: Optional[float] = None
+        self.last_used = 0.0
+        self.jobs = 0
+
+    @property
+    def logged_in(self) -> bool:
+        return self.logged_in_at is not None
+
+    def expired(self, ttl: float) -> bool:
+        return not self.logged_in or time.monotonic() - self.logged_in_at > ttl
+
+    async def login(self) -> None:
+        logging.info(f"Logging into {self.owner.fno_name} portal as {self.owner.credentials.get('user')}")
+        # In reality, this would launch a Playwright context, goto portal_url and submit the login form
+        await asyncio.sleep(LOGIN_SECONDS)
+        self.logged_in_at = self.last_used = time.monotonic()
+
+    async def keepalive(self) -> None:
+        # In reality, this would reload a cheap portal page so the server-side session does not time out
+        await asyncio.sleep(0.05)
+        self.last_used = time.monotonic()
 
     async def check_availability(self, address: str) -> Dict[str, Any]:
-        logging.info(f"Launching Browser Agent for {self.fno_name} portal...")
-        # In a real scenario, this would use Playwright to:
-        # 1. Goto portal_url
-        # 2. Login with credentials
-        # 3. Enter address in search field
-        # 4. Scrape the result
-        await asyncio.sleep(2) # Mock browser delay
-        
+        # In reality, this would enter the address in the search field and scrape the result
+        await asyncio.sleep(SCRAPE_SECONDS)
+        self.jobs += 1
+        self.last_used = time.monotonic()
         return {
-            "fno": self.fno_name,
+            "fno": self.owner.fno_name,
             "available": True,
             "provider_type": "BROWSER_AUTOMATION",
             "message": "Coverage confirmed via Portal Scraping"
         }
 
     async def place_order(self, customer_data: Dict[str, Any], plan_id: str) -> Dict[str, Any]:
-        logging.info(f"Automating order placement on {self.fno_name} portal")
-        return {"status": "QUEUED_ON_PORTAL", "job_id": f"BROWSER-{self.fno_name}-999"}
+        logging.info(f"Automating order placement on {self.owner.fno_name} portal")
+        self.jobs += 1
+        self.last_used = time.monotonic()
+        return {"status": "QUEUED_ON_PORTAL", "job_id": f"BROWSER-{self.owner.fno_name}-999"}
 
     async def cancel_order(self, order_id: str) -> Dict[str, Any]:
+        self.jobs += 1
+        self.last_used = time.monotonic()
         return {"status": "CANCELLATION_SUBMITTED_TO_PORTAL"}
+
+    async def close(self) -> None:
+        # In reality, this would close the browser context
+        self.logged_in_at = None
+
+class BrowserFNOAdapter(FNOAdapter):
+    """Adapter for FNOs requiring Browser Automation (Portals)"""
+
+    def __init__(self, fno_name: str, portal_url: str, credentials: Dict[str, str],
+                 pool=None, max_sessions: Optional[int] = None):
+        self.fno_name = fno_name
+        self.portal_url = portal_url
+        self.credentials = credentials
+        # Shared BrowserWorkerPool; without one every call logs in on its own
+        self.pool = pool
+        self.max_sessions = max_sessions
+
+    @property
+    def pool_key(self) -> str:
+        """Portal sessions are bound to one login, so pool lanes are per FNO account"""
+        return f"{self.fno_name}:{self.credentials.get('user', '')}"
+
+    def new_session(self) -> PortalSession:
+        return PortalSession(self)
+
+    def submit(self, action: str, **kwargs):
+        """Queue a portal action on the pool and return its BrowserJob without waiting"""
+        return self.pool.submit(self, action, kwargs)
+
+    async def _run(self, action: str, **kwargs) -> Dict[str, Any]:
+        if self.pool is not None:
+            return await self.pool.run(self, action, kwargs)
+        session = self.new_session()
+        await session.login()
+        try:
+            return await getattr(session, action)(**kwargs)
+        finally:
+            await session.close()
+
+    async def check_availability(self, address: str) -> Dict[str, Any]:
+        logging.info(f"Browser availability check on {self.fno_name} portal for {address}")
+        return await self._run("check_availability", address=address)
+
+    async def place_order(self, customer_data: Dict[str, Any], plan_id: str) -> Dict[str, Any]:
+        return await self._run("place_order", customer_data=customer_data, plan_id=plan_id)
+
+    async def cancel_order(self, order_id: str) -> Dict[str, Any]:
+        return await self._run("cancel_order", order_id=order_id)
+
+    async def aclose(self) -> None:
+        if self.pool is not None:
+            await self.pool.close_lane(self)
@@ -0,0 +1,196 @@
+"""
+Browser automation worker pool for FNO portals.
+
+Each FNO portal account gets its own lane: a bounded job queue and a
+fixed number of workers. A worker logs in once and keeps its portal
+session warm across jobs, pinging it while idle and logging in again only
+when the session expires, fails, or the credentials change. The worker
+count is the lane's concurrency cap, so a slow portal can never hold
+more browser sessions than configured, and API requests only enqueue.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+import uuid
+
+JOB_QUEUED = "QUEUED"
+JOB_RUNNING = "RUNNING"
+JOB_COMPLETED = "COMPLETED"
+JOB_FAILED = "FAILED"
+
+
+class BrowserJob:
+    __slots__ = ("id", "lane", "action", "kwargs", "status", "result", "error",
+                 "created_at", "started_at", "finished_at", "future")
+
+    def __init__(self, lane: str, action: str, kwargs: Dict[str, Any]):
+        self.id = str(uuid.uuid4())
+        self.lane = lane
+        self.action = action
+        self.kwargs = kwargs
+        self.status = JOB_QUEUED
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def finish(self, result: Optional[Dict[str, Any]], error: Optional[str] = None) -> None:
+        self.status = JOB_FAILED if error else JOB_COMPLETED
+        self.result = result
+        self.error = error
+        self.finished_at = datetime.now()
+        if not self.future.done():
+            if error:
+                self.future.set_exception(RuntimeError(error))
+                # Fire-and-forget jobs never await the future; keep asyncio from logging it
+                self.future.exception()
+            else:
+                self.future.set_result(result)
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "action": self.action,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class PoolLane:
+    """Queue, workers and counters for one FNO portal account."""
+
+    def __init__(self, adapter, workers: int, queue_limit: int):
+        self.adapter = adapter
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_limit)
+        self.tasks: List[asyncio.Task] = []
+        self.busy = 0
+        self.logins = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "fno": self.adapter.fno_name,
+            "workers": self.workers,
+            "busy": self.busy,
+            "queued": self.queue.qsize(),
+            "logins": self.logins,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_queue_wait_ms": round(self.wait_seconds / finished * 1000, 1) if finished else None
+        }
+
+
+class BrowserWorkerPool:
+    """Per-account portal lanes with warm, reused sessions."""
+
+    def __init__(self, workers_per_fno: int = 2, queue_limit: int = 500, session_ttl: float = 1800.0,
+                 keepalive_seconds: float = 120.0, job_timeout: float = 60.0, history: int = 10000):
+        self.workers_per_fno = workers_per_fno
+        self.queue_limit = queue_limit
+        self.session_ttl = session_ttl
+        self.keepalive_seconds = keepalive_seconds
+        self.job_timeout = job_timeout
+        self.history = history
+        self.jobs: "OrderedDict[str, BrowserJob]" = OrderedDict()
+        self._lanes: Dict[str, PoolLane] = {}
+
+    def _lane(self, adapter) -> PoolLane:
+        lane = self._lanes.get(adapter.pool_key)
+        if lane is None:
+            lane = self._lanes[adapter.pool_key] = PoolLane(
+                adapter, adapter.max_sessions or self.workers_per_fno, self.queue_limit)
+            lane.tasks = [asyncio.create_task(self._worker(lane)) for _ in range(lane.workers)]
+            logging.info(f"Started {lane.workers} browser workers for {adapter.pool_key}")
+        else:
+            # Newer adapter (e.g. rotated password); workers log in again with it
+            lane.adapter = adapter
+        return lane
+
+    def submit(self, adapter, action: str, kwargs: Dict[str, Any]) -> BrowserJob:
+        """Queue a job; raises asyncio.QueueFull when the lane's backlog is at its limit"""
+        lane = self._lane(adapter)
+        job = BrowserJob(adapter.pool_key, action, kwargs)
+        lane.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.history:
+            self.jobs.popitem(last=False)
+        return job
+
+    async def run(self, adapter, action: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.submit(adapter, action, kwargs).future
+
+    async def _worker(self, lane: PoolLane) -> None:
+        session = None
+        while True:
+            try:
+                job = await asyncio.wait_for(lane.queue.get(), self.keepalive_seconds)
+            except asyncio.TimeoutError:
+                if session is not None and not session.expired(self.session_ttl):
+                    try:
+                        await session.keepalive()
+                    except Exception as exc:
+                        logging.warning(f"Portal keepalive for {lane.adapter.pool_key} failed: {exc}")
+                        session = None
+                continue
+
+            lane.busy += 1
+            job.status = JOB_RUNNING
+            job.started_at = datetime.now()
+            lane.wait_seconds += (job.started_at - job.created_at).total_seconds()
+            try:
+                if session is None or session.owner is not lane.adapter or session.expired(self.session_ttl):
+                    if session is not None:
+                        await session.close()
+                    session = lane.adapter.new_session()
+                    lane.logins += 1
+                    await asyncio.wait_for(session.login(), self.job_timeout)
+                result = await asyncio.wait_for(getattr(session, job.action)(**job.kwargs), self.job_timeout)
+            except asyncio.CancelledError:
+                job.finish(None, "Browser pool stopped")
+                raise
+            except Exception as exc:
+                lane.failed += 1
+                job.finish(None, str(exc) or type(exc).__name__)
+                logging.error(f"Portal {job.action} on {lane.adapter.pool_key} failed: {job.error}")
+                # The page may be in an unknown state; start the next job from a fresh login
+                if session is not None:
+                    await session.close()
+                session = None
+            else:
+                lane.completed += 1
+                job.finish(result)
+            finally:
+                lane.busy -= 1
+                lane.queue.task_done()
+
+    async def close_lane(self, adapter) -> None:
+        """Stop a lane's workers, unless a newer adapter has taken it over"""
+        lane = self._lanes.get(adapter.pool_key)
+        if lane is None or lane.adapter is not adapter:
+            return
+        del self._lanes[adapter.pool_key]
+        for task in lane.tasks:
+            task.cancel()
+        await asyncio.gather(*lane.tasks, return_exceptions=True)
+        while not lane.queue.empty():
+            lane.queue.get_nowait().finish(None, "Browser pool stopped")
+
+    async def close(self) -> None:
+        for lane in list(self._lanes.values()):
+            await self.close_lane(lane.adapter)
+
+    def stats(self) -> Dict[str, dict]:
+        return {key: lane.stats() for key, lane in self._lanes.items()}
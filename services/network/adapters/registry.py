@@ -0,0 +1,132 @@
+from .base import FNOAdapter
+from .api_adapter import http2_available
+from .factory import FNOFactory
+from typing import Dict, Any, Optional, Tuple, List
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import httpx
+
+class PoolSettings:
+    """Connection pool settings for FNO API clients (env configurable)"""
+
+    def __init__(self):
+        self.max_connections = int(os.getenv("FNO_HTTP_MAX_CONNECTIONS", 20))
+        self.max_keepalive = int(os.getenv("FNO_HTTP_MAX_KEEPALIVE", 10))
+        self.keepalive_expiry = float(os.getenv("FNO_HTTP_KEEPALIVE_SECONDS", 60))
+        self.timeout = float(os.getenv("FNO_HTTP_TIMEOUT_SECONDS", 10))
+        self.http2 = os.getenv("FNO_HTTP2", "1") == "1" and http2_available()
+        # Idle adapters (and their pools) are closed after this long; must exceed the request timeout
+        self.idle_seconds = float(os.getenv("FNO_ADAPTER_IDLE_SECONDS", 600))
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+class AdapterEntry:
+    __slots__ = ("adapter", "fingerprint", "created_at", "last_used", "uses")
+
+    def __init__(self, adapter: FNOAdapter, fingerprint: str):
+        self.adapter = adapter
+        self.fingerprint = fingerprint
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.uses = 0
+
+def config_fingerprint(config: Dict[str, Any]) -> str:
+    """Changes when credentials or endpoints change, so rotated keys get a fresh adapter"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+class AdapterRegistry:
+    """Per-tenant, per-FNO adapters that keep their HTTP connection pools between requests"""
+
+    def __init__(self, settings: Optional[PoolSettings] = None, browser_pool=None):
+        self.settings = settings or PoolSettings()
+        self.browser_pool = browser_pool
+        self._entries: Dict[Tuple[str, str], AdapterEntry] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.created = 0
+        self.evicted = 0
+
+    def _client(self, config: Dict[str, Any]) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=config.get("base_url", ""),
+            headers={"Authorization": f"Bearer {config['api_key']}"},
+            http2=self.settings.http2,
+            limits=self.settings.limits(),
+            timeout=self.settings.timeout
+        )
+
+    def get(self, tenant_id, fno_name: str, config: Dict[str, Any]) -> FNOAdapter:
+        """Cached adapter for (tenant, FNO); built on first use or when the config changed"""
+        key = (str(tenant_id), fno_name)
+        fingerprint = config_fingerprint(config)
+        entry = self._entries.get(key)
+        if entry is None or entry.fingerprint != fingerprint:
+            # Mock API adapters never send a request, so they get no connection pool
+            client = self._client(config) if config.get("api_key") and not config.get("mock", True) else None
+            adapter = FNOFactory.get_adapter(fno_name, config, client=client, browser_pool=self.browser_pool)
+            if entry is not None:
+                # Let requests still using the old adapter finish before closing its pool
+                asyncio.get_running_loop().call_later(
+                    self.settings.timeout, lambda old=entry.adapter: asyncio.create_task(self._close(old)))
+            entry = self._entries[key] = AdapterEntry(adapter, fingerprint)
+            self.created += 1
+            logging.info(f"Created {type(adapter).__name__} for {fno_name} (tenant {key[0]})")
+        entry.last_used = time.monotonic()
+        entry.uses += 1
+        return entry.adapter
+
+    async def _close(self, adapter: FNOAdapter) -> None:
+        try:
+            await adapter.aclose()
+        except Exception as exc:
+            logging.warning(f"Closing {type(adapter).__name__} failed: {exc}")
+
+    async def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.settings.idle_seconds
+        idle = [key for key, entry in self._entries.items() if entry.last_used < cutoff]
+        for key in idle:
+            entry = self._entries.pop(key)
+            await self._close(entry.adapter)
+        self.evicted += len(idle)
+        return len(idle)
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.settings.idle_seconds / 4, 1))
+            evicted = await self.evict_idle()
+            if evicted:
+                logging.info(f"Evicted {evicted} idle FNO adapters")
+
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            await self._close(entry.adapter)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "tenant_id": tenant_id,
+                "fno": fno_name,
+                "adapter": type(entry.adapter).__name__,
+                "uses": entry.uses,
+                "age_seconds": round(now - entry.created_at, 1),
+                "idle_seconds": round(now - entry.last_used, 1)
+            }
+            for (tenant_id, fno_name), entry in self._entries.items()
+        ]
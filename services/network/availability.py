@@ -0,0 +1,151 @@
+"""
+Multi-FNO availability lookup for the Network Service.
+
+One lookup fans out to every configured FNO adapter at once, each under
+its own timeout, and merges the answers. Results are cached per
+(normalized address, FNO) with a TTL and LRU eviction, so a repeat lookup
+is answered from memory. A portal that misses its timeout keeps running
+in the background and its answer is cached when it arrives, and
+concurrent lookups for the same address share one in-flight check.
+"""
+
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+import logging
+import re
+import time
+
+AVAILABILITY_OK = "OK"
+AVAILABILITY_TIMEOUT = "TIMEOUT"
+AVAILABILITY_ERROR = "ERROR"
+
+_ABBREVIATIONS = {
+    "st": "street", "str": "street", "rd": "road", "ave": "avenue", "av": "avenue", "dr": "drive",
+    "cres": "crescent", "cr": "crescent", "ln": "lane", "cl": "close", "ct": "court", "pl": "place",
+    "blvd": "boulevard", "hwy": "highway", "ext": "extension", "nr": "number", "no": "number",
+}
+_COUNTRY_SUFFIXES = ("south africa", "rsa", "za")
+
+
+def normalize_address(address: str) -> str:
+    """Cache key for an address: case, punctuation, spacing and common abbreviations folded"""
+    words = re.sub(r"[^a-z0-9]+", " ", address.lower()).split()
+    words = [_ABBREVIATIONS.get(word, word) for word in words]
+    key = " ".join(words)
+    for suffix in _COUNTRY_SUFFIXES:
+        if key.endswith(" " + suffix):
+            key = key[:-len(suffix) - 1]
+    return key
+
+
+class AvailabilityCache:
+    """LRU of availability results with a per-entry expiry."""
+
+    def __init__(self, max_entries: int = 50000, ttl: float = 6 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Tuple[str, str], value: Dict[str, Any]) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, address_key: Optional[str] = None) -> int:
+        if address_key is None:
+            dropped = len(self._entries)
+            self._entries.clear()
+            return dropped
+        keys = [key for key in self._entries if key[0] == address_key]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "evictions": self.evictions
+        }
+
+
+class AvailabilityLookup:
+    """Concurrent fan-out to FNO adapters in front of an AvailabilityCache."""
+
+    def __init__(self, cache: AvailabilityCache):
+        self.cache = cache
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+    def _check(self, key: Tuple[str, str], adapter, address: str) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(adapter.check_availability(address))
+            task.add_done_callback(lambda done: self._store(key, done))
+        return task
+
+    def _store(self, key: Tuple[str, str], task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.warning(f"Availability check on {key[1]} failed: {task.exception()}")
+            return
+        self.cache.set(key, task.result())
+
+    async def _one(self, address_key: str, fno_name: str, adapter, address: str, timeout: float) -> Dict[str, Any]:
+        key = (address_key, fno_name)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return {**cached, "fno": fno_name, "status": AVAILABILITY_OK, "cached": True, "elapsed_ms": 0.0}
+        started = time.perf_counter()
+        try:
+            # Shielded so a timed-out check still finishes and fills the cache for the next lookup
+            result = await asyncio.wait_for(asyncio.shield(self._check(key, adapter, address)), timeout)
+            outcome = {**result, "fno": fno_name, "status": AVAILABILITY_OK, "cached": False}
+        except asyncio.TimeoutError:
+            outcome = {"fno": fno_name, "status": AVAILABILITY_TIMEOUT, "available": None,
+                       "error": f"No answer within {timeout:g}s"}
+        except Exception as exc:
+            outcome = {"fno": fno_name, "status": AVAILABILITY_ERROR, "available": None,
+                       "error": str(exc) or type(exc).__name__}
+        outcome["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return outcome
+
+    async def lookup(self, address: str, adapters: Dict[str, Tuple[Any, float]]) -> Dict[str, Any]:
+        """adapters maps FNO name to (adapter, timeout seconds)"""
+        started = time.perf_counter()
+        address_key = normalize_address(address)
+        results: List[Dict[str, Any]] = await asyncio.gather(*(
+            self._one(address_key, fno_name, adapter, address, timeout)
+            for fno_name, (adapter, timeout) in adapters.items()
+        ))
+        return {
+            "address": address,
+            "normalized_address": address_key,
+            "available_fnos": [r["fno"] for r in results if r.get("available")],
+            "complete": all(r["status"] == AVAILABILITY_OK for r in results),
+            "results": results,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
@@ -0,0 +1,83 @@
+"""
+Benchmark bulk RADIUS provisioning against the one-account-per-request path.
+
+Needs DATABASE_URL pointing at a database with config/master_schema.sql
+applied. Creates a throwaway tenant, contact and subscription, provisions
+N accounts one at a time (a transaction per account, as POST /radius/accounts
+does) and N accounts in bulk, then removes everything it created.
+
+    python -m services.network.benchmark_provisioning --accounts 5000
+"""
+
+from datetime import date
+import argparse
+import os
+import time
+import uuid
+
+from .provisioning import RadiusProvisioner
+
+
+class BenchAccount:
+    __slots__ = ("contact_id", "subscription_id", "username", "password", "profile_name")
+
+    def __init__(self, contact_id, subscription_id, username):
+        self.contact_id = contact_id
+        self.subscription_id = subscription_id
+        self.username = username
+        self.password = uuid.uuid4().hex[:12]
+        self.profile_name = "BENCH_50M"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    dsn = os.environ["DATABASE_URL"]
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    run = uuid.uuid4().hex[:8]
+    with conn, conn.cursor() as cur:
+        cur.execute("INSERT INTO tenants (name, subdomain) VALUES (%s, %s) RETURNING id", (f"bench {run}", f"bench-{run}"))
+        tenant_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO contacts (tenant_id, first_name, last_name) VALUES (%s, 'Bench', 'User') RETURNING id", (tenant_id,))
+        contact_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO subscriptions (tenant_id, contact_id, start_date) VALUES (%s, %s, %s) RETURNING id",
+                    (tenant_id, contact_id, date.today()))
+        subscription_id = cur.fetchone()[0]
+
+    def accounts(label):
+        return [BenchAccount(contact_id, subscription_id, f"bench-{run}-{label}-{i}@bench.local")
+                for i in range(args.accounts)]
+
+    try:
+        single = RadiusProvisioner(dsn, chunk_size=1)
+        started = time.perf_counter()
+        for account in accounts("single"):
+            single.provision_accounts(tenant_id, [account])
+        single_seconds = time.perf_counter() - started
+        single.close()
+
+        bulk = RadiusProvisioner(dsn, chunk_size=args.chunk_size)
+        started = time.perf_counter()
+        results = bulk.provision_accounts(tenant_id, accounts("bulk"))
+        bulk_seconds = time.perf_counter() - started
+        bulk.close()
+
+        failed = sum(1 for r in results if r["status"] != "PROVISIONED")
+        print(f"one at a time: {args.accounts / single_seconds:10.0f} accounts/s ({single_seconds:.2f}s)")
+        print(f"bulk (chunk {args.chunk_size}): {args.accounts / bulk_seconds:10.0f} accounts/s ({bulk_seconds:.2f}s), {failed} failed")
+        print(f"speed-up: {single_seconds / bulk_seconds:.1f}x")
+    finally:
+        with conn, conn.cursor() as cur:
+            pattern = f"bench-{run}-%"
+            cur.execute("DELETE FROM radcheck WHERE username LIKE %s", (pattern,))
+            cur.execute("DELETE FROM radusergroup WHERE username LIKE %s", (pattern,))
+            cur.execute("DELETE FROM tenants WHERE id = %s", (tenant_id,))
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
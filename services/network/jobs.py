@@ -0,0 +1,475 @@
+"""
+Durable FNO automation job queue backed by automation_jobs.
+
+Jobs are rows. Workers claim them with FOR UPDATE SKIP LOCKED, so any
+number of network-service replicas can share the table without handing
+out the same job twice. Each FNO has a token bucket, and a claim asks for
+at most as many jobs per FNO as it has tokens. Failures are retried with
+exponential backoff through run_after until max_attempts, then marked
+FAILED with the error kept in error_log. A job whose worker died is
+returned to PENDING once its lease runs out; completions, retries and
+failures only land while the worker still holds the lease (locked_by),
+so a worker that lost its lease cannot overwrite the job's next run.
+Status reads use their own
+connection and never wait on the workers. Without DATABASE_URL the same
+queue runs on an in-memory store.
+"""
+
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+JOB_PENDING = "PENDING"
+JOB_IN_PROGRESS = "IN_PROGRESS"
+JOB_COMPLETED = "COMPLETED"
+JOB_FAILED = "FAILED"
+
+# Payload keys each job type needs, checked before a job is accepted
+JOB_PAYLOAD_FIELDS = {
+    "FNO_AVAILABILITY": ("address",),
+    "FNO_ORDER": ("customer", "plan_id"),
+    "FNO_CANCELLATION": ("order_id",),
+}
+DEFAULT_MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 5.0
+RETRY_MAX_SECONDS = 600.0
+
+JOB_COLUMNS = ("id, tenant_id, job_type, fno_name, status, payload, result, error_log, attempts, max_attempts, "
+               "run_after, created_at, started_at, finished_at")
+
+INSERT_JOB = (
+    "INSERT INTO automation_jobs (id, tenant_id, job_type, fno_name, status, payload, max_attempts) "
+    "VALUES (%s, %s, %s, %s, 'PENDING', %s::jsonb, %s) RETURNING " + JOB_COLUMNS
+)
+# One round trip claims up to n due jobs per FNO; SKIP LOCKED lets replicas claim side by side
+CLAIM_JOBS = (
+    "UPDATE automation_jobs j SET status = 'IN_PROGRESS', attempts = j.attempts + 1, locked_by = %s, "
+    "locked_at = CURRENT_TIMESTAMP, started_at = COALESCE(j.started_at, CURRENT_TIMESTAMP), "
+    "updated_at = CURRENT_TIMESTAMP "
+    "FROM (SELECT c.id FROM unnest(%s::text[], %s::int[]) AS q(fno_name, n) CROSS JOIN LATERAL ("
+    "SELECT id FROM automation_jobs WHERE status = 'PENDING' AND run_after <= CURRENT_TIMESTAMP "
+    "AND fno_name = q.fno_name ORDER BY run_after LIMIT q.n FOR UPDATE SKIP LOCKED) c) picked "
+    "WHERE j.id = picked.id RETURNING " + ", ".join("j." + c.strip() for c in JOB_COLUMNS.split(","))
+)
+# Zero rows means the lease ran out and the job was recovered (and maybe claimed) elsewhere
+HELD_BY_WORKER = "WHERE id = %s AND status = 'IN_PROGRESS' AND locked_by = %s"
+COMPLETE_JOB = (
+    "UPDATE automation_jobs SET status = 'COMPLETED', result = %s::jsonb, error_log = NULL, locked_by = NULL, "
+    "finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP " + HELD_BY_WORKER
+)
+RETRY_JOB = (
+    "UPDATE automation_jobs SET status = 'PENDING', error_log = %s, locked_by = NULL, "
+    "run_after = CURRENT_TIMESTAMP + make_interval(secs => %s), updated_at = CURRENT_TIMESTAMP " + HELD_BY_WORKER
+)
+FAIL_JOB = (
+    "UPDATE automation_jobs SET status = 'FAILED', error_log = %s, locked_by = NULL, "
+    "finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP " + HELD_BY_WORKER
+)
+# Interrupted by a shutdown: not the job's fault, so the attempt is given back
+RELEASE_JOBS = (
+    "UPDATE automation_jobs SET status = 'PENDING', attempts = GREATEST(attempts - 1, 0), locked_by = NULL, "
+    "updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s::uuid[]) AND status = 'IN_PROGRESS' AND locked_by = %s"
+)
+RECOVER_STALE = (
+    "UPDATE automation_jobs SET status = 'PENDING', locked_by = NULL, run_after = CURRENT_TIMESTAMP, "
+    "updated_at = CURRENT_TIMESTAMP "
+    "WHERE status = 'IN_PROGRESS' AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => %s)"
+)
+PENDING_FNOS = "SELECT DISTINCT fno_name FROM automation_jobs WHERE status = 'PENDING'"
+SELECT_JOB = "SELECT " + JOB_COLUMNS + " FROM automation_jobs WHERE id = %s AND tenant_id = %s"
+STATUS_COUNTS = "SELECT fno_name, status, count(*) FROM automation_jobs GROUP BY fno_name, status"
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying cannot help (bad payload, unknown FNO)."""
+
+
+class AutomationJob:
+    __slots__ = ("id", "tenant_id", "job_type", "fno_name", "status", "payload", "result", "error",
+                 "attempts", "max_attempts", "run_after", "created_at", "started_at", "finished_at")
+
+    def __init__(self, id, tenant_id, job_type, fno_name, status, payload, result, error, attempts,
+                 max_attempts, run_after, created_at, started_at=None, finished_at=None):
+        self.id = str(id)
+        self.tenant_id = str(tenant_id) if tenant_id else None
+        self.job_type = job_type
+        self.fno_name = fno_name
+        self.status = status
+        self.payload = payload or {}
+        self.result = result
+        self.error = error
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.run_after = run_after
+        self.created_at = created_at
+        self.started_at = started_at
+        self.finished_at = finished_at
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "job_type": self.job_type,
+            "fno_name": self.fno_name,
+            "status": self.status,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "payload": self.payload,
+            "result": self.result,
+            "error": self.error,
+            "next_attempt_at": self.run_after if self.status == JOB_PENDING else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+def parse_rate_limits(spec: str) -> Dict[str, float]:
+    """"Vumatel=10,Openserve=0.5" -> jobs per second per FNO"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        fno_name, _, rate = item.partition("=")
+        limits[fno_name.strip()] = float(rate)
+    return limits
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter, capped at RETRY_MAX_SECONDS"""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class PostgresJobStore:
+    """automation_jobs in Postgres; one connection for workers, another for API enqueues and status reads."""
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._conns: Dict[str, Any] = {}
+        self._locks = {"work": threading.Lock(), "api": threading.Lock()}
+
+    def _run(self, role: str, sql: str, params: tuple, fetch: bool = False):
+        with self._locks[role]:
+            conn = self._conns.get(role)
+            if conn is None or conn.closed:
+                import psycopg2
+                conn = self._conns[role] = psycopg2.connect(self.dsn)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall() if fetch else cur.rowcount
+                conn.commit()
+                return rows
+            except Exception:
+                conn.rollback()
+                raise
+
+    def enqueue(self, tenant_id: str, job_type: str, fno_name: str, payload: dict, max_attempts: int) -> AutomationJob:
+        rows = self._run("api", INSERT_JOB, (str(uuid.uuid4()), tenant_id, job_type, fno_name,
+                                             json.dumps(payload), max_attempts), fetch=True)
+        return AutomationJob(*rows[0])
+
+    def claim(self, worker_id: str, quotas: Dict[str, int]) -> List[AutomationJob]:
+        fnos = list(quotas)
+        rows = self._run("work", CLAIM_JOBS, (worker_id, fnos, [quotas[f] for f in fnos]), fetch=True)
+        return [AutomationJob(*row) for row in rows]
+
+    # complete/retry/fail return False when worker_id no longer holds the job's lease
+    def complete(self, worker_id: str, job: AutomationJob, result: dict) -> bool:
+        return self._run("work", COMPLETE_JOB, (json.dumps(result, default=str), job.id, worker_id)) > 0
+
+    def retry(self, worker_id: str, job: AutomationJob, error: str, delay: float) -> bool:
+        return self._run("work", RETRY_JOB, (error, delay, job.id, worker_id)) > 0
+
+    def fail(self, worker_id: str, job: AutomationJob, error: str) -> bool:
+        return self._run("work", FAIL_JOB, (error, job.id, worker_id)) > 0
+
+    def release(self, worker_id: str, job_ids: Sequence[str]) -> None:
+        if job_ids:
+            self._run("work", RELEASE_JOBS, (list(job_ids), worker_id))
+
+    def recover_stale(self, lease_seconds: float) -> int:
+        return self._run("work", RECOVER_STALE, (lease_seconds,))
+
+    def pending_fnos(self) -> List[str]:
+        return [row[0] for row in self._run("work", PENDING_FNOS, (), fetch=True)]
+
+    def get(self, tenant_id: str, job_id: str) -> Optional[AutomationJob]:
+        rows = self._run("api", SELECT_JOB, (job_id, tenant_id), fetch=True)
+        return AutomationJob(*rows[0]) if rows else None
+
+    def status_counts(self) -> Dict[str, Dict[str, int]]:
+        counts: Dict[str, Dict[str, int]] = {}
+        for fno_name, job_status, count in self._run("api", STATUS_COUNTS, (), fetch=True):
+            counts.setdefault(fno_name, {})[job_status] = count
+        return counts
+
+    def close(self) -> None:
+        for conn in self._conns.values():
+            conn.close()
+
+
+class MemoryJobStore:
+    """Same interface as PostgresJobStore, for dev and tests; nothing survives a restart."""
+
+    def __init__(self):
+        self._jobs: Dict[str, AutomationJob] = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, tenant_id: str, job_type: str, fno_name: str, payload: dict, max_attempts: int) -> AutomationJob:
+        now = datetime.now()
+        job = AutomationJob(uuid.uuid4(), tenant_id, job_type, fno_name, JOB_PENDING, payload, None, None,
+                            0, max_attempts, now, now)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def claim(self, worker_id: str, quotas: Dict[str, int]) -> List[AutomationJob]:
+        now = datetime.now()
+        claimed = []
+        with self._lock:
+            due = sorted((job for job in self._jobs.values()
+                          if job.status == JOB_PENDING and job.run_after <= now and job.fno_name in quotas),
+                         key=lambda job: job.run_after)
+            taken: Dict[str, int] = {}
+            for job in due:
+                if taken.get(job.fno_name, 0) < quotas[job.fno_name]:
+                    taken[job.fno_name] = taken.get(job.fno_name, 0) + 1
+                    job.status = JOB_IN_PROGRESS
+                    job.attempts += 1
+                    job.started_at = job.started_at or now
+                    claimed.append(job)
+        return claimed
+
+    # Leases never run out in memory (see recover_stale), so a claimed job is always still held
+    def complete(self, worker_id: str, job: AutomationJob, result: dict) -> bool:
+        job.status, job.result, job.error, job.finished_at = JOB_COMPLETED, result, None, datetime.now()
+        return True
+
+    def retry(self, worker_id: str, job: AutomationJob, error: str, delay: float) -> bool:
+        job.status, job.error, job.run_after = JOB_PENDING, error, datetime.now() + timedelta(seconds=delay)
+        return True
+
+    def fail(self, worker_id: str, job: AutomationJob, error: str) -> bool:
+        job.status, job.error, job.finished_at = JOB_FAILED, error, datetime.now()
+        return True
+
+    def release(self, worker_id: str, job_ids: Sequence[str]) -> None:
+        with self._lock:
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None and job.status == JOB_IN_PROGRESS:
+                    job.status = JOB_PENDING
+                    job.attempts = max(job.attempts - 1, 0)
+
+    def recover_stale(self, lease_seconds: float) -> int:
+        # Workers share this process, so a job cannot outlive the worker that holds it
+        return 0
+
+    def pending_fnos(self) -> List[str]:
+        with self._lock:
+            return list({job.fno_name for job in self._jobs.values() if job.status == JOB_PENDING})
+
+    def get(self, tenant_id: str, job_id: str) -> Optional[AutomationJob]:
+        job = self._jobs.get(job_id)
+        return job if job is not None and job.tenant_id == tenant_id else None
+
+    def status_counts(self) -> Dict[str, Dict[str, int]]:
+        counts: Dict[str, Dict[str, int]] = {}
+        with self._lock:
+            for job in self._jobs.values():
+                by_status = counts.setdefault(job.fno_name, {})
+                by_status[job.status] = by_status.get(job.status, 0) + 1
+        return counts
+
+    def close(self) -> None:
+        pass
+
+
+class TokenBucket:
+    """Rate limit of `rate` jobs per second with bursts up to `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def available(self) -> int:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return int(self.tokens)
+
+    def take(self, count: int) -> None:
+        self.tokens -= count
+
+    def seconds_until_token(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+# handler(job) returns the result to store, raises to retry, raises PermanentJobError to fail at once
+JobHandler = Callable[[AutomationJob], Awaitable[dict]]
+
+
+class AutomationQueue:
+    """Claims due jobs within per-FNO rate limits and runs them on a bounded set of workers."""
+
+    def __init__(self, store, handler: JobHandler, workers: int = 32, rate_limits: Optional[Dict[str, float]] = None,
+                 default_rate: float = 5.0, job_timeout: float = 300.0, poll_seconds: float = 1.0,
+                 lease_seconds: float = 900.0):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.rate_limits = rate_limits or {}
+        self.default_rate = default_rate
+        self.job_timeout = job_timeout
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._fnos_refreshed = 0.0
+        self._recovered_at = 0.0
+        self._first_fno = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.leases_lost = 0
+
+    def _bucket(self, fno_name: str) -> TokenBucket:
+        bucket = self._buckets.get(fno_name)
+        if bucket is None:
+            rate = self.rate_limits.get(fno_name, self.default_rate)
+            bucket = self._buckets[fno_name] = TokenBucket(rate, max(1, int(rate)))
+        return bucket
+
+    async def enqueue(self, tenant_id: str, job_type: str, fno_name: str, payload: dict,
+                      max_attempts: int = DEFAULT_MAX_ATTEMPTS) -> AutomationJob:
+        job = await asyncio.to_thread(self.store.enqueue, tenant_id, job_type, fno_name, payload, max_attempts)
+        self._bucket(fno_name)
+        self._wake.set()
+        return job
+
+    async def _maintain(self) -> None:
+        now = time.monotonic()
+        if now - self._fnos_refreshed > 10 * self.poll_seconds:
+            # Jobs enqueued by other replicas for FNOs this process has not seen yet
+            for fno_name in await asyncio.to_thread(self.store.pending_fnos):
+                self._bucket(fno_name)
+            self._fnos_refreshed = now
+        if now - self._recovered_at > self.lease_seconds / 4:
+            recovered = await asyncio.to_thread(self.store.recover_stale, self.lease_seconds)
+            if recovered:
+                logging.warning(f"Re-queued {recovered} automation jobs whose worker stopped responding")
+            self._recovered_at = now
+
+    async def _dispatch(self) -> None:
+        while True:
+            wait = self.poll_seconds
+            try:
+                await self._maintain()
+                free = self.workers - len(self._running)
+                quotas = {}
+                # Quotas share the free workers between FNOs; the first pick rotates so no FNO always goes first
+                fnos = list(self._buckets)
+                self._first_fno = (self._first_fno + 1) % max(len(fnos), 1)
+                for fno_name in fnos[self._first_fno:] + fnos[:self._first_fno]:
+                    bucket = self._buckets[fno_name]
+                    tokens = min(bucket.available(), free)
+                    if tokens > 0:
+                        quotas[fno_name] = tokens
+                        free -= tokens
+                    elif free:
+                        wait = min(wait, bucket.seconds_until_token())
+                jobs = await asyncio.to_thread(self.store.claim, self.worker_id, quotas) if quotas else []
+                for job in jobs:
+                    self._bucket(job.fno_name).take(1)
+                    self._running[job.id] = asyncio.create_task(self._execute(job))
+                if jobs:
+                    # There may be more due work; go round again without sleeping
+                    continue
+            except Exception as exc:
+                logging.error(f"Automation job dispatch failed: {exc}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(wait, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job: AutomationJob) -> None:
+        try:
+            result = await asyncio.wait_for(self.handler(job), self.job_timeout)
+            if await asyncio.to_thread(self.store.complete, self.worker_id, job, result):
+                self.completed += 1
+            else:
+                self._lease_lost(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            error = str(exc) or type(exc).__name__
+            if isinstance(exc, asyncio.TimeoutError):
+                error = f"Timed out after {self.job_timeout:g}s"
+            try:
+                if isinstance(exc, PermanentJobError) or job.attempts >= job.max_attempts:
+                    if await asyncio.to_thread(self.store.fail, self.worker_id, job, error):
+                        self.failed += 1
+                        logging.error(f"{job.job_type} {job.id} on {job.fno_name} failed after {job.attempts} attempts: {error}")
+                    else:
+                        self._lease_lost(job)
+                elif await asyncio.to_thread(self.store.retry, self.worker_id, job, error, retry_delay(job.attempts)):
+                    self.retried += 1
+                else:
+                    self._lease_lost(job)
+            except Exception as store_exc:
+                # The lease will bring it back if this write was lost
+                logging.error(f"Recording failure of automation job {job.id} failed: {store_exc}")
+        finally:
+            self._running.pop(job.id, None)
+            self._wake.set()
+
+    def _lease_lost(self, job: AutomationJob) -> None:
+        self.leases_lost += 1
+        logging.warning(f"{job.job_type} {job.id} on {job.fno_name} outlived its lease; its outcome was discarded "
+                        f"and the job is left to whichever worker re-claimed it")
+
+    async def get(self, tenant_id: str, job_id: str) -> Optional[AutomationJob]:
+        return await asyncio.to_thread(self.store.get, tenant_id, job_id)
+
+    async def stats(self) -> dict:
+        return {
+            "worker_id": self.worker_id,
+            "workers": self.workers,
+            "running": len(self._running),
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "leases_lost": self.leases_lost,
+            "rate_limits": {fno: bucket.rate for fno, bucket in self._buckets.items()},
+            "jobs_by_fno": await asyncio.to_thread(self.store.status_counts)
+        }
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        running = list(self._running)
+        for task in list(self._running.values()):
+            task.cancel()
+        try:
+            await asyncio.to_thread(self.store.release, self.worker_id, running)
+        except Exception as exc:
+            logging.error(f"Releasing {len(running)} automation jobs failed: {exc}")
+        self.store.close()
@@ -1,9 +1,11 @@
-from fastapi import FastAPI, Depends, HTTPException, status, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Response
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime
+import asyncio
 import logging
+import os
 
 app = FastAPI(title="CoreConnect Network Service", version="0.1.0")
 
@@ -22,79 +24,352 @@ class RadiusProfileCreate(BaseModel):
     upload_speed: str # e.g. "50M"
     mikrotik_rate_limit: Optional[str] = None # e.g. "50M/50M"
 
+class RadiusReprofile(BaseModel):
+    username: str
+    profile_name: str
+
+class RadiusReprofileRequest(BaseModel):
+    changes: Optional[List[RadiusReprofile]] = None # Explicit users...
+    from_profile: Optional[str] = None # ...or a whole speed tier
+    to_profile: Optional[str] = None
+
+class AccountingRecord(BaseModel):
+    """FreeRADIUS accounting request (rlm_rest JSON, attribute names flattened)"""
+    status_type: str # Start, Interim-Update, Stop, Accounting-On, Accounting-Off
+    acct_session_id: str = ""
+    acct_unique_id: Optional[str] = None
+    username: str = ""
+    realm: Optional[str] = None
+    nas_ip_address: str
+    nas_port_id: Optional[str] = None
+    nas_port_type: Optional[str] = None
+    event_time: Optional[datetime] = None
+    session_time: Optional[int] = None
+    interim_interval: Optional[int] = None
+    input_octets: Optional[int] = None
+    output_octets: Optional[int] = None
+    input_gigawords: Optional[int] = None
+    output_gigawords: Optional[int] = None
+    authentic: Optional[str] = None
+    connect_info: Optional[str] = None
+    called_station_id: Optional[str] = None
+    calling_station_id: Optional[str] = None
+    terminate_cause: Optional[str] = None
+    service_type: Optional[str] = None
+    framed_protocol: Optional[str] = None
+    framed_ip_address: Optional[str] = None
+
 class AutomationJobCreate(BaseModel):
-    job_type: str # FNO_AVAILABILITY, FNO_ORDER
+    job_type: str # FNO_AVAILABILITY, FNO_ORDER, FNO_CANCELLATION
     fno_name: str
     payload: Dict
+    max_attempts: int = 5
 
 # --- IAM Middleware (Stub) ---
 async def get_current_tenant_id():
     return uuid.UUID("00000000-0000-0000-0000-000000000000")
 
-from .adapters.factory import FNOFactory
+from .adapters.registry import AdapterRegistry
+from .adapters.browser_adapter import BrowserFNOAdapter
+from .adapters.browser_pool import BrowserWorkerPool
+from .availability import AvailabilityCache, AvailabilityLookup, normalize_address
+from .jobs import (AutomationQueue, AutomationJob, MemoryJobStore, PostgresJobStore, PermanentJobError,
+                   JOB_PAYLOAD_FIELDS, parse_rate_limits)
+from .accounting import AccountingBuffer, RadacctWriter, local_time, ACCT_START, ACCT_INTERIM, ACCT_STOP, ACCT_ON, ACCT_OFF
+from .sessions import LiveSessionTable
+from .provisioning import RadiusProvisioner
+from .profile_changes import ProfileChangeConsumer
+
+MAX_PROVISIONING_BATCH = 50000
+provisioner = RadiusProvisioner()
+profile_changes = ProfileChangeConsumer(
+    provisioner,
+    batch_size=int(os.getenv("PROFILE_CHANGE_BATCH_SIZE", 1000)),
+    interval=float(os.getenv("PROFILE_CHANGE_POLL_SECONDS", 5))
+)
+
+def bulk_summary(results: List[dict], ok_status: str) -> dict:
+    succeeded = sum(1 for r in results if r["status"] == ok_status)
+    return {"total": len(results), "succeeded": succeeded, "failed": len(results) - succeeded,
+            "results": results}
+
+def check_batch_size(rows: list):
+    if len(rows) > MAX_PROVISIONING_BATCH:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_PROVISIONING_BATCH} rows per request")
+
+ACCT_STATUS_TYPES = (ACCT_START, ACCT_INTERIM, ACCT_STOP, ACCT_ON, ACCT_OFF)
+MAX_ACCOUNTING_BATCH = 10000
+
+accounting_buffer = AccountingBuffer(
+    RadacctWriter(),
+    max_sessions=int(os.getenv("RADACCT_FLUSH_SESSIONS", 5000)),
+    max_delay=float(os.getenv("RADACCT_FLUSH_SECONDS", 2.0))
+)
+live_sessions = LiveSessionTable()
+STALE_SWEEP_SECONDS = 60
+browser_pool = BrowserWorkerPool(
+    workers_per_fno=int(os.getenv("BROWSER_WORKERS_PER_FNO", 2)),
+    queue_limit=int(os.getenv("BROWSER_QUEUE_LIMIT", 500)),
+    session_ttl=float(os.getenv("BROWSER_SESSION_TTL_SECONDS", 1800)),
+    keepalive_seconds=float(os.getenv("BROWSER_KEEPALIVE_SECONDS", 120)),
+    job_timeout=float(os.getenv("BROWSER_JOB_TIMEOUT_SECONDS", 60))
+)
+adapter_registry = AdapterRegistry(browser_pool=browser_pool)
+availability_cache = AvailabilityCache(
+    max_entries=int(os.getenv("AVAILABILITY_CACHE_SIZE", 50000)),
+    ttl=float(os.getenv("AVAILABILITY_CACHE_TTL_SECONDS", 6 * 3600))
+)
+availability_lookup = AvailabilityLookup(availability_cache)
+AVAILABILITY_API_TIMEOUT = float(os.getenv("AVAILABILITY_API_TIMEOUT_SECONDS", 3))
+AVAILABILITY_PORTAL_TIMEOUT = float(os.getenv("AVAILABILITY_PORTAL_TIMEOUT_SECONDS", 8))
 
 # --- RADIUS Logic ---
 @app.post("/radius/profiles", status_code=status.HTTP_201_CREATED)
 async def create_profile(profile: RadiusProfileCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
     """Configure speed profiles in radgroupreply"""
     logging.info(f"Configuring RADIUS Profile: {profile.name} with rate limit {profile.mikrotik_rate_limit}")
-    # In reality, this would insert into radgroupreply:
-    # INSERT INTO radgroupreply (groupname, attribute, op, value) VALUES (profile.name, 'Mikrotik-Rate-Limit', '=', profile.mikrotik_rate_limit)
+    result = (await asyncio.to_thread(provisioner.provision_profiles, [profile]))[0]
+    if result["status"] != "CONFIGURED":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result.get("error"))
     return {"status": "CONFIGURED", "profile": profile.name}
 
+@app.post("/radius/profiles/bulk")
+async def create_profiles_bulk(profiles: List[RadiusProfileCreate], tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Create or replace many speed profiles; one result per input row"""
+    check_batch_size(profiles)
+    results = await asyncio.to_thread(provisioner.provision_profiles, profiles)
+    return bulk_summary(results, "CONFIGURED")
+
 @app.post("/radius/accounts", status_code=status.HTTP_201_CREATED)
 async def create_radius_account(acc: RadiusAccountCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
     """Provision a new RADIUS account in radcheck/radusergroup"""
     logging.info(f"Provisioning RADIUS Account: {acc.username}")
-    # 1. Insert into radcheck (Cleartext-Password)
-    # 2. Insert into radusergroup (Link to speed profile)
+    result = (await asyncio.to_thread(provisioner.provision_accounts, tenant_id, [acc]))[0]
+    if result["status"] == "CONFLICT":
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=result["error"])
+    if result["status"] != "PROVISIONED":
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=result.get("error"))
     return {
-        "id": uuid.uuid4(),
+        "id": result.get("id") or uuid.uuid4(),
         "username": acc.username,
         "status": "ACTIVE",
         "created_at": datetime.now()
     }
 
+@app.post("/radius/accounts/bulk")
+async def create_radius_accounts_bulk(accounts: List[RadiusAccountCreate], tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Provision many accounts (e.g. an FNO base migration) in batched transactions"""
+    check_batch_size(accounts)
+    results = await asyncio.to_thread(provisioner.provision_accounts, tenant_id, accounts)
+    summary = bulk_summary(results, "PROVISIONED")
+    logging.info(f"Bulk provisioning: {summary['succeeded']} of {summary['total']} accounts provisioned")
+    return summary
+
+@app.post("/radius/reprofile")
+async def reprofile_accounts(request: RadiusReprofileRequest, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Move users to a new speed profile, either listed individually or a whole tier at once"""
+    if request.changes is not None:
+        check_batch_size(request.changes)
+        results = await asyncio.to_thread(
+            provisioner.reprofile_users, [(c.username, c.profile_name) for c in request.changes])
+        summary = bulk_summary(results, "REPROFILED")
+    elif request.from_profile and request.to_profile:
+        moved = await asyncio.to_thread(provisioner.reprofile_tier, request.from_profile, request.to_profile)
+        summary = {"from_profile": request.from_profile, "to_profile": request.to_profile, "total": moved,
+                   "succeeded": moved, "failed": 0}
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Provide changes, or from_profile and to_profile")
+    # In reality, this would also send CoA requests so live sessions pick up the new rate limit
+    return summary
+
+@app.get("/radius/profile-changes")
+async def get_profile_change_stats():
+    """Queued profile moves (e.g. dunning suspensions) applied by this worker"""
+    return profile_changes.stats()
+
 @app.get("/radius/sessions")
-async def get_active_sessions(tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
-    """Query radacct for live sessions"""
-    return [
-        {
-            "username": "thabo@CoreConnect.net",
-            "nas_ip": "154.22.8.5",
-            "uptime": "14h 22m",
-            "input_octets": 4523000,
-            "output_octets": 12500000
-        }
-    ]
+async def get_active_sessions(
+    response: Response,
+    username: Optional[str] = None,
+    nas_ip: Optional[str] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    """Live sessions from the in-memory table fed by accounting (radacct is not queried)"""
+    total, sessions = live_sessions.page(username=username, nas_ip=nas_ip, offset=offset, limit=limit)
+    response.headers["X-Total-Count"] = str(total)
+    now = datetime.now()
+    return [session.as_dict(now) for session in sessions]
+
+@app.get("/radius/sessions/nas")
+async def get_nas_session_totals():
+    """Open session count and byte counters per NAS"""
+    return live_sessions.all_nas_totals()
+
+@app.get("/radius/sessions/nas/{nas_ip}")
+async def get_nas_sessions_summary(nas_ip: str):
+    return {"nas_ip": nas_ip, **live_sessions.nas_totals(nas_ip)}
+
+async def ingest_accounting(records: List[AccountingRecord]):
+    received_at = datetime.now()
+    for record in records:
+        if record.status_type not in ACCT_STATUS_TYPES:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Unknown Acct-Status-Type {record.status_type}")
+        record.event_time = local_time(record.event_time) or received_at
+    live_sessions.apply(records)
+    await accounting_buffer.add(records)
+
+@app.post("/radius/accounting", status_code=status.HTTP_202_ACCEPTED)
+async def post_accounting(record: AccountingRecord):
+    """Accounting endpoint for FreeRADIUS rlm_rest; written to radacct in coalesced batches"""
+    await ingest_accounting([record])
+    return {"status": "accepted"}
+
+@app.post("/radius/accounting/batch", status_code=status.HTTP_202_ACCEPTED)
+async def post_accounting_batch(records: List[AccountingRecord]):
+    """Bulk accounting (e.g. from a buffered detail-file reader)"""
+    if len(records) > MAX_ACCOUNTING_BATCH:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {MAX_ACCOUNTING_BATCH} records per batch")
+    await ingest_accounting(records)
+    return {"status": "accepted", "accepted": len(records)}
+
+@app.get("/radius/accounting/stats")
+async def get_accounting_stats():
+    return accounting_buffer.stats()
+
+async def expire_stale_sessions():
+    while True:
+        await asyncio.sleep(STALE_SWEEP_SECONDS)
+        dropped = live_sessions.expire_stale(datetime.now())
+        if dropped:
+            logging.warning(f"Dropped {dropped} live sessions with no accounting (missing Stop)")
+
+_session_sweeper: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_accounting_buffer():
+    global _session_sweeper
+    try:
+        await asyncio.to_thread(live_sessions.load)
+    except Exception as exc:
+        logging.error(f"Could not warm live sessions from radacct: {exc}")
+    accounting_buffer.start()
+    _session_sweeper = asyncio.create_task(expire_stale_sessions())
+    adapter_registry.start()
+    automation_queue.start()
+    profile_changes.start()
+
+@app.on_event("shutdown")
+async def stop_accounting_buffer():
+    if _session_sweeper is not None:
+        _session_sweeper.cancel()
+    await accounting_buffer.stop()
+    await automation_queue.stop()
+    await profile_changes.stop()
+    await adapter_registry.close()
+    await browser_pool.close()
 
 # --- FNO Automation Routes ---
-@app.post("/automation/jobs", status_code=status.HTTP_202_ACCEPTED)
-async def start_automation_job(job: AutomationJobCreate, background_tasks: BackgroundTasks, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
-    """Trigger a fluid FNO interaction (API or Browser)"""
-    fno_configs = {
-        "Vumatel": {"api_key": "vuma_secret_123", "base_url": "https://api.vumatel.co.za"},
-        "Openserve": {"portal_url": "https://portal.openserve.co.za", "credentials": {"user": "admin", "pass": "secret"}}
+def get_fno_configs(tenant_id: uuid.UUID) -> Dict[str, Dict[str, Any]]:
+    # In reality, this would load the tenant's FNO integrations from the database
+    return {
+        "Vumatel": {"api_key": "vuma_secret_123", "base_url": "https://api.vumatel.co.za",
+                    "mock": os.getenv("FNO_API_MOCK", "1") == "1"},
+        "Openserve": {"portal_url": "https://portal.openserve.co.za", "credentials": {"user": "admin", "pass": "secret"},
+                      "max_sessions": 3}
     }
-    
-    config = fno_configs.get(job.fno_name, {})
-    adapter = FNOFactory.get_adapter(job.fno_name, config)
-    
-    job_id = uuid.uuid4()
-    logging.info(f"Dispatched {job.job_type} for {job.fno_name} via {type(adapter).__name__}")
-    
+
+@app.get("/availability")
+async def check_availability(address: str = Query(..., min_length=3), tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Coverage at an address across every configured FNO, checked concurrently"""
+    adapters = {}
+    for fno_name, config in get_fno_configs(tenant_id).items():
+        adapter = adapter_registry.get(tenant_id, fno_name, config)
+        default_timeout = AVAILABILITY_PORTAL_TIMEOUT if isinstance(adapter, BrowserFNOAdapter) else AVAILABILITY_API_TIMEOUT
+        adapters[fno_name] = (adapter, config.get("availability_timeout", default_timeout))
+    return await availability_lookup.lookup(address, adapters)
+
+@app.get("/availability/cache")
+async def get_availability_cache_stats():
+    return availability_cache.stats()
+
+@app.delete("/availability/cache")
+async def clear_availability_cache(address: Optional[str] = None):
+    """Drop cached coverage for one address (e.g. after an FNO build-out), or all of it"""
+    dropped = availability_cache.invalidate(normalize_address(address) if address else None)
+    return {"dropped": dropped}
+
+async def run_automation_job(job: AutomationJob) -> dict:
+    """Queue handler: run one job on the tenant's cached FNO adapter"""
+    config = get_fno_configs(job.tenant_id).get(job.fno_name)
+    if config is None:
+        raise PermanentJobError(f"No {job.fno_name} integration configured")
+    adapter = adapter_registry.get(job.tenant_id, job.fno_name, config)
+    payload = job.payload
     if job.job_type == "FNO_AVAILABILITY":
-        background_tasks.add_task(adapter.check_availability, job.payload.get("address"))
+        return await adapter.check_availability(payload["address"])
+    if job.job_type == "FNO_ORDER":
+        return await adapter.place_order(payload["customer"], payload["plan_id"])
+    if job.job_type == "FNO_CANCELLATION":
+        return await adapter.cancel_order(payload["order_id"])
+    raise PermanentJobError(f"Unsupported job type {job.job_type}")
+
+automation_queue = AutomationQueue(
+    PostgresJobStore(os.environ["DATABASE_URL"]) if os.getenv("DATABASE_URL") else MemoryJobStore(),
+    run_automation_job,
+    workers=int(os.getenv("AUTOMATION_WORKERS", 32)),
+    rate_limits=parse_rate_limits(os.getenv("AUTOMATION_RATE_LIMITS", "")),
+    default_rate=float(os.getenv("AUTOMATION_DEFAULT_RATE", 5)),
+    job_timeout=float(os.getenv("AUTOMATION_JOB_TIMEOUT_SECONDS", 300))
+)
+
+@app.post("/automation/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def start_automation_job(job: AutomationJobCreate, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Queue a fluid FNO interaction (API or Browser); workers pick it up from automation_jobs"""
+    required = JOB_PAYLOAD_FIELDS.get(job.job_type)
+    if required is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"job_type must be one of {', '.join(JOB_PAYLOAD_FIELDS)}")
+    missing = [field for field in required if field not in job.payload]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"payload is missing {', '.join(missing)}")
+    if job.fno_name not in get_fno_configs(tenant_id):
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"No {job.fno_name} integration configured")
     
-    return {
-        "id": job_id,
-        "status": "PROCESSING",
-        "created_at": datetime.now()
-    }
+    queued = await automation_queue.enqueue(str(tenant_id), job.job_type, job.fno_name, job.payload,
+                                            max(1, job.max_attempts))
+    logging.info(f"Queued {job.job_type} {queued.id} for {job.fno_name}")
+    return {"id": queued.id, "status": queued.status, "created_at": queued.created_at}
+
+@app.get("/automation/adapters")
+async def get_adapter_pool_stats():
+    """Cached FNO adapters and how often each has been reused"""
+    return {"created": adapter_registry.created, "evicted": adapter_registry.evicted,
+            "adapters": adapter_registry.stats()}
+
+@app.get("/automation/browser-pool")
+async def get_browser_pool_stats():
+    """Per-portal workers, queue depth and how many logins the warm sessions saved"""
+    return browser_pool.stats()
+
+@app.get("/automation/queue")
+async def get_automation_queue_stats():
+    """Job counts per FNO and status, plus this worker's throughput"""
+    return await automation_queue.stats()
 
 @app.get("/automation/jobs/{job_id}")
-async def get_job_status(job_id: uuid.UUID):
-    return {"id": job_id, "status": "IN_PROGRESS", "progress": "Logging into Openserve Portal..."}
+async def get_job_status(job_id: uuid.UUID, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    job = await automation_queue.get(str(tenant_id), str(job_id))
+    if job is None:
+        raise HTTPException(status_code=404, detail="Automation job not found")
+    return job.as_dict()
 
 if __name__ == "__main__":
     import uvicorn
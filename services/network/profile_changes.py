@@ -0,0 +1,108 @@
+"""
+Applies RADIUS profile moves queued by other services (radius_profile_changes).
+
+The billing service's dunning sweep queues a move to the suspended
+profile for every account it suspends, and a move back once the account
+is settled. Changes are claimed oldest first with SKIP LOCKED and held
+locked while the provisioner re-profiles them, so several network
+workers can share the queue. Only the newest pending change per username
+in a batch is applied; older ones are marked SUPERSEDED.
+"""
+
+from typing import Optional
+import asyncio
+import logging
+
+CLAIM_CHANGES = (
+    "SELECT id, username, to_profile FROM radius_profile_changes WHERE status = 'PENDING' "
+    "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED"
+)
+FINISH_CHANGES = (
+    "UPDATE radius_profile_changes c SET status = v.status, error = v.error, applied_at = CURRENT_TIMESTAMP "
+    "FROM (VALUES %s) AS v(id, status, error) WHERE c.id = v.id"
+)
+
+
+class ProfileChangeConsumer:
+    """Polls radius_profile_changes and applies them through the RADIUS provisioner."""
+
+    def __init__(self, provisioner, batch_size: int = 1000, interval: float = 5.0):
+        self.provisioner = provisioner
+        self.batch_size = batch_size
+        self.interval = interval
+        self._conn = None
+        self._task: Optional[asyncio.Task] = None
+        self.applied = 0
+        self.superseded = 0
+        self.failed = 0
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.provisioner.dsn)
+        return self._conn
+
+    def apply_batch(self) -> int:
+        """Claim, apply and settle one batch; returns how many changes it took"""
+        from psycopg2.extras import execute_values
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(CLAIM_CHANGES, (self.batch_size,))
+                claimed = cur.fetchall()
+                if not claimed:
+                    conn.commit()
+                    return 0
+                latest = {}
+                for change_id, username, profile in claimed:
+                    latest[username] = (change_id, profile)
+                outcomes = {}
+                for change_id, username, _ in claimed:
+                    if latest[username][0] != change_id:
+                        outcomes[change_id] = ("SUPERSEDED", None)
+                pending = list(latest.items())
+                results = self.provisioner.reprofile_users([(username, profile) for username, (_, profile) in pending])
+                for (_, (change_id, _)), result in zip(pending, results):
+                    if result["status"] == "REPROFILED":
+                        outcomes[change_id] = ("APPLIED", None)
+                    else:
+                        outcomes[change_id] = ("FAILED", result.get("error"))
+                execute_values(cur, FINISH_CHANGES, [(change_id, s, e) for change_id, (s, e) in outcomes.items()],
+                               template="(%s::bigint, %s, %s)", page_size=self.batch_size)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        statuses = [s for s, _ in outcomes.values()]
+        self.applied += statuses.count("APPLIED")
+        self.superseded += statuses.count("SUPERSEDED")
+        self.failed += statuses.count("FAILED")
+        if statuses.count("FAILED"):
+            logging.warning(f"{statuses.count('FAILED')} queued RADIUS profile changes could not be applied")
+        # In reality, this would also send CoA requests so live sessions pick up the new profile
+        return len(claimed)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if await asyncio.to_thread(self.apply_batch) == self.batch_size:
+                    continue
+            except Exception as exc:
+                logging.error(f"Applying queued RADIUS profile changes failed: {exc}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        # Nothing is queued without a database to queue it in
+        if self.provisioner.dsn and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._conn is not None:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        return {"applied": self.applied, "superseded": self.superseded, "failed": self.failed,
+                "running": self._task is not None}
@@ -0,0 +1,243 @@
+"""
+Batched RADIUS provisioning for the Network Service.
+
+Accounts, re-profiles and speed profiles are written in chunks, one
+transaction per chunk, with multi-row statements for radius_accounts,
+radcheck, radusergroup and radgroupreply. Every input row gets its own
+result. If a chunk fails as a whole (e.g. a foreign key), it is replayed
+row by row under savepoints so only the offending rows are reported as
+failed.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import os
+import re
+import threading
+
+CHUNK_SIZE = 1000
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9._%+-]+(@[A-Za-z0-9.-]+)?$")
+
+INSERT_ACCOUNTS = (
+    "INSERT INTO radius_accounts (tenant_id, contact_id, subscription_id, username, password, profile_name) "
+    "VALUES %s ON CONFLICT (username) DO NOTHING RETURNING id, username"
+)
+INSERT_RADCHECK = "INSERT INTO radcheck (username, attribute, op, value) VALUES %s"
+INSERT_RADUSERGROUP = "INSERT INTO radusergroup (username, groupname, priority) VALUES %s"
+INSERT_RADGROUPREPLY = "INSERT INTO radgroupreply (groupname, attribute, op, value) VALUES %s"
+DELETE_PROFILE_REPLIES = "DELETE FROM radgroupreply WHERE groupname = ANY(%s) AND attribute = ANY(%s)"
+REPROFILE_USERS = (
+    "UPDATE radusergroup g SET groupname = v.groupname FROM (VALUES %s) AS v(username, groupname) "
+    "WHERE g.username = v.username RETURNING g.username"
+)
+REPROFILE_ACCOUNTS = (
+    "UPDATE radius_accounts a SET profile_name = v.groupname FROM (VALUES %s) AS v(username, groupname) "
+    "WHERE a.username = v.username"
+)
+REPROFILE_TIER_USERS = "UPDATE radusergroup SET groupname = %s WHERE groupname = %s RETURNING username"
+REPROFILE_TIER_ACCOUNTS = "UPDATE radius_accounts SET profile_name = %s WHERE profile_name = %s"
+
+
+def row_result(index: int, key: str, status: str, error: Optional[str] = None, **extra) -> dict:
+    result = {"index": index, "key": key, "status": status, **extra}
+    if error:
+        result["error"] = error
+    return result
+
+
+def profile_replies(profile) -> List[Tuple[str, str, str, str]]:
+    """radgroupreply rows for a speed profile"""
+    rate_limit = profile.mikrotik_rate_limit or f"{profile.upload_speed}/{profile.download_speed}"
+    return [(profile.name, "Mikrotik-Rate-Limit", "=", rate_limit)]
+
+
+class RadiusProvisioner:
+    """Bulk writes to the FreeRADIUS tables; logs only when no DATABASE_URL is set."""
+
+    def __init__(self, dsn: Optional[str] = None, chunk_size: int = CHUNK_SIZE):
+        self.dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        self.chunk_size = chunk_size
+        self._conn = None
+        # Requests run in worker threads and share one connection
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._conn.closed:
+            import psycopg2
+            self._conn = psycopg2.connect(self.dsn)
+        return self._conn
+
+    def _chunks(self, rows: Sequence) -> List[Sequence]:
+        return [rows[start:start + self.chunk_size] for start in range(0, len(rows), self.chunk_size)]
+
+    def _run_chunk(self, chunk: List[Tuple[int, object]], write_chunk, results: Dict[int, dict]) -> None:
+        """One transaction for the chunk; on failure, replay it row by row under savepoints"""
+        with self._lock:
+            self._run_chunk_locked(chunk, write_chunk, results)
+
+    def _run_chunk_locked(self, chunk: List[Tuple[int, object]], write_chunk, results: Dict[int, dict]) -> None:
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                results.update(write_chunk(cur, chunk))
+            conn.commit()
+            return
+        except Exception as exc:
+            conn.rollback()
+            logging.warning(f"Provisioning chunk of {len(chunk)} failed ({exc}); retrying row by row")
+
+        with conn.cursor() as cur:
+            for item in chunk:
+                cur.execute("SAVEPOINT provision_row")
+                try:
+                    results.update(write_chunk(cur, [item]))
+                    cur.execute("RELEASE SAVEPOINT provision_row")
+                except Exception as exc:
+                    cur.execute("ROLLBACK TO SAVEPOINT provision_row")
+                    index, row = item
+                    results[index] = row_result(index, self._key(row), "FAILED", str(exc).strip().splitlines()[0])
+        conn.commit()
+
+    @staticmethod
+    def _key(row) -> str:
+        if isinstance(row, tuple):
+            return row[0]
+        return getattr(row, "username", None) or getattr(row, "name", "")
+
+    # --- Accounts ---
+    def provision_accounts(self, tenant_id, accounts: Sequence) -> List[dict]:
+        results: Dict[int, dict] = {}
+        valid: List[Tuple[int, object]] = []
+        seen = set()
+        for index, account in enumerate(accounts):
+            if not USERNAME_PATTERN.match(account.username):
+                results[index] = row_result(index, account.username, "INVALID", "Malformed username")
+            elif account.username in seen:
+                results[index] = row_result(index, account.username, "INVALID", "Duplicate username in request")
+            elif not account.password:
+                results[index] = row_result(index, account.username, "INVALID", "Password is required")
+            else:
+                seen.add(account.username)
+                valid.append((index, account))
+
+        if not self.dsn:
+            logging.info(f"radius provisioning (mock): {len(valid)} accounts")
+            for index, account in valid:
+                results[index] = row_result(index, account.username, "PROVISIONED")
+        else:
+            def write_chunk(cur, chunk):
+                return self._write_accounts(cur, tenant_id, chunk)
+            for chunk in self._chunks(valid):
+                self._run_chunk(chunk, write_chunk, results)
+        return [results[index] for index in range(len(accounts))]
+
+    def _write_accounts(self, cur, tenant_id, chunk: List[Tuple[int, object]]) -> Dict[int, dict]:
+        from psycopg2.extras import execute_values
+        created = dict((username, account_id) for account_id, username in execute_values(
+            cur, INSERT_ACCOUNTS,
+            [(str(tenant_id), str(a.contact_id), str(a.subscription_id), a.username, a.password, a.profile_name)
+             for _, a in chunk],
+            page_size=self.chunk_size, fetch=True))
+        new = [(index, a) for index, a in chunk if a.username in created]
+        if new:
+            execute_values(cur, INSERT_RADCHECK,
+                           [(a.username, "Cleartext-Password", ":=", a.password) for _, a in new],
+                           page_size=self.chunk_size)
+            execute_values(cur, INSERT_RADUSERGROUP, [(a.username, a.profile_name, 1) for _, a in new],
+                           page_size=self.chunk_size)
+        results = {}
+        for index, account in chunk:
+            if account.username in created:
+                results[index] = row_result(index, account.username, "PROVISIONED", id=str(created[account.username]))
+            else:
+                results[index] = row_result(index, account.username, "CONFLICT", "Username already exists")
+        return results
+
+    # --- Re-profiling ---
+    def reprofile_users(self, changes: Sequence[Tuple[str, str]]) -> List[dict]:
+        """Move (username, new profile) pairs to their new radusergroup group"""
+        results: Dict[int, dict] = {}
+        items = []
+        seen = set()
+        for index, (username, profile) in enumerate(changes):
+            if username in seen:
+                results[index] = row_result(index, username, "INVALID", "Duplicate username in request")
+            else:
+                seen.add(username)
+                items.append((index, (username, profile)))
+
+        if not self.dsn:
+            logging.info(f"radius re-profile (mock): {len(items)} users")
+            for index, (username, profile) in items:
+                results[index] = row_result(index, username, "REPROFILED", profile=profile)
+            return [results[index] for index in range(len(changes))]
+
+        def write_chunk(cur, chunk):
+            from psycopg2.extras import execute_values
+            pairs = [change for _, change in chunk]
+            moved = {row[0] for row in execute_values(cur, REPROFILE_USERS, pairs, page_size=self.chunk_size, fetch=True)}
+            execute_values(cur, REPROFILE_ACCOUNTS, pairs, page_size=self.chunk_size)
+            return {
+                index: row_result(index, username, "REPROFILED", profile=profile) if username in moved
+                else row_result(index, username, "NOT_FOUND", "No radusergroup entry for username")
+                for index, (username, profile) in chunk
+            }
+
+        for chunk in self._chunks(items):
+            self._run_chunk(chunk, write_chunk, results)
+        return [results[index] for index in range(len(changes))]
+
+    def reprofile_tier(self, from_profile: str, to_profile: str) -> int:
+        """Move every user on one speed profile to another in a single transaction"""
+        if not self.dsn:
+            logging.info(f"radius re-profile (mock): {from_profile} -> {to_profile}")
+            return 0
+        with self._lock:
+            return self._reprofile_tier_locked(from_profile, to_profile)
+
+    def _reprofile_tier_locked(self, from_profile: str, to_profile: str) -> int:
+        conn = self._connect()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REPROFILE_TIER_USERS, (to_profile, from_profile))
+                moved = cur.rowcount
+                cur.execute(REPROFILE_TIER_ACCOUNTS, (to_profile, from_profile))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return moved
+
+    # --- Profiles ---
+    def provision_profiles(self, profiles: Sequence) -> List[dict]:
+        """Create or replace speed profiles in radgroupreply"""
+        results: Dict[int, dict] = {}
+        valid = []
+        seen = set()
+        for index, profile in enumerate(profiles):
+            if profile.name in seen:
+                results[index] = row_result(index, profile.name, "INVALID", "Duplicate profile in request")
+            else:
+                seen.add(profile.name)
+                valid.append((index, profile))
+
+        if not self.dsn:
+            logging.info(f"radius profiles (mock): {len(valid)} profiles")
+            for index, profile in valid:
+                results[index] = row_result(index, profile.name, "CONFIGURED")
+            return [results[index] for index in range(len(profiles))]
+
+        def write_chunk(cur, chunk):
+            from psycopg2.extras import execute_values
+            replies = [reply for _, profile in chunk for reply in profile_replies(profile)]
+            cur.execute(DELETE_PROFILE_REPLIES, ([p.name for _, p in chunk], sorted({r[1] for r in replies})))
+            execute_values(cur, INSERT_RADGROUPREPLY, replies, page_size=self.chunk_size)
+            return {index: row_result(index, profile.name, "CONFIGURED") for index, profile in chunk}
+
+        for chunk in self._chunks(valid):
+            self._run_chunk(chunk, write_chunk, results)
+        return [results[index] for index in range(len(profiles))]
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
@@ -0,0 +1,213 @@
+"""
+In-memory live session table for the Network Service.
+
+Fed by the accounting stream, it holds every open session keyed by
+acctuniqueid with secondary indexes by username and by NAS IP, and keeps
+per-NAS session counts and byte totals up to date by applying deltas.
+Dashboard reads never touch radacct; Postgres is only read once at
+startup to warm the table from the open sessions in idx_radacct_active.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Dict, Iterable, List, Optional, Tuple
+import logging
+import os
+
+from .accounting import ACCT_START, ACCT_STOP, ACCT_ON, ACCT_OFF, local_time, octets, record_unique_id
+
+OPEN_SESSIONS_QUERY = (
+    "SELECT acctuniqueid, acctsessionid, username, host(nasipaddress), nasportid, host(framedipaddress), "
+    "acctstarttime, COALESCE(acctupdatetime, acctstarttime), acctinputoctets, acctoutputoctets "
+    "FROM radacct WHERE acctstoptime IS NULL"
+)
+
+# Sessions with no accounting for this long are treated as lost (NAS died without a Stop)
+STALE_AFTER = timedelta(seconds=int(os.getenv("RADIUS_SESSION_STALE_SECONDS", 3 * 3600)))
+# Recently stopped sessions remembered so a late interim update does not reopen them
+MAX_STOPPED = 200000
+
+
+class LiveSession:
+    __slots__ = ("unique_id", "session_id", "username", "nas_ip", "nas_port_id", "framed_ip",
+                 "start_time", "update_time", "input_octets", "output_octets")
+
+    def __init__(self, unique_id: str, session_id: str, username: str, nas_ip: str, start_time: datetime):
+        self.unique_id = unique_id
+        self.session_id = session_id
+        self.username = username
+        self.nas_ip = nas_ip
+        self.nas_port_id: Optional[str] = None
+        self.framed_ip: Optional[str] = None
+        self.start_time = start_time
+        self.update_time = start_time
+        self.input_octets = 0
+        self.output_octets = 0
+
+    def as_dict(self, now: datetime) -> dict:
+        uptime = int((now - self.start_time).total_seconds())
+        return {
+            "username": self.username,
+            "nas_ip": self.nas_ip,
+            "nas_port_id": self.nas_port_id,
+            "framed_ip": self.framed_ip,
+            "acct_session_id": self.session_id,
+            "started_at": self.start_time,
+            "last_update": self.update_time,
+            "uptime": f"{uptime // 3600}h {uptime % 3600 // 60}m",
+            "input_octets": self.input_octets,
+            "output_octets": self.output_octets
+        }
+
+
+class NasTotals:
+    __slots__ = ("sessions", "input_octets", "output_octets")
+
+    def __init__(self):
+        self.sessions = 0
+        self.input_octets = 0
+        self.output_octets = 0
+
+    def as_dict(self) -> dict:
+        return {"sessions": self.sessions, "input_octets": self.input_octets, "output_octets": self.output_octets}
+
+
+class LiveSessionTable:
+    """Open sessions by acctuniqueid, username and NAS, with O(1) per-NAS totals."""
+
+    def __init__(self):
+        # Ordered by last update, so stale sessions are always at the front
+        self._sessions: "OrderedDict[str, LiveSession]" = OrderedDict()
+        self._by_username: Dict[str, Dict[str, None]] = {}
+        self._by_nas: Dict[str, Dict[str, None]] = {}
+        self._nas_totals: Dict[str, NasTotals] = {}
+        self._stopped: "OrderedDict[str, None]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _add(self, session: LiveSession) -> None:
+        self._sessions[session.unique_id] = session
+        self._by_username.setdefault(session.username, {})[session.unique_id] = None
+        self._by_nas.setdefault(session.nas_ip, {})[session.unique_id] = None
+        totals = self._nas_totals.setdefault(session.nas_ip, NasTotals())
+        totals.sessions += 1
+        totals.input_octets += session.input_octets
+        totals.output_octets += session.output_octets
+
+    def _remove(self, unique_id: str) -> Optional[LiveSession]:
+        session = self._sessions.pop(unique_id, None)
+        if session is None:
+            return None
+        for index, key in ((self._by_username, session.username), (self._by_nas, session.nas_ip)):
+            members = index.get(key)
+            members.pop(unique_id, None)
+            if not members:
+                del index[key]
+        totals = self._nas_totals[session.nas_ip]
+        totals.sessions -= 1
+        totals.input_octets -= session.input_octets
+        totals.output_octets -= session.output_octets
+        if not totals.sessions:
+            del self._nas_totals[session.nas_ip]
+        return session
+
+    def _update_counters(self, session: LiveSession, input_octets: Optional[int], output_octets: Optional[int]) -> None:
+        totals = self._nas_totals[session.nas_ip]
+        # Counters are cumulative per session; an older record never moves them back
+        if input_octets is not None and input_octets > session.input_octets:
+            totals.input_octets += input_octets - session.input_octets
+            session.input_octets = input_octets
+        if output_octets is not None and output_octets > session.output_octets:
+            totals.output_octets += output_octets - session.output_octets
+            session.output_octets = output_octets
+
+    def apply(self, records: Iterable) -> None:
+        """Fold accounting records (event_time already set) into the table"""
+        for record in records:
+            if record.status_type in (ACCT_ON, ACCT_OFF):
+                self.close_nas(record.nas_ip_address)
+                continue
+            unique_id = record_unique_id(record)
+            if record.status_type == ACCT_STOP:
+                self._remove(unique_id)
+                self._stopped[unique_id] = None
+                if len(self._stopped) > MAX_STOPPED:
+                    self._stopped.popitem(last=False)
+                continue
+            if unique_id in self._stopped:
+                continue
+
+            session = self._sessions.get(unique_id)
+            if session is None:
+                start_time = record.event_time - timedelta(seconds=record.session_time or 0)
+                session = LiveSession(unique_id, record.acct_session_id, record.username,
+                                      record.nas_ip_address, start_time)
+                self._add(session)
+            elif record.status_type == ACCT_START:
+                session.start_time = record.event_time
+            session.nas_port_id = record.nas_port_id or session.nas_port_id
+            session.framed_ip = record.framed_ip_address or session.framed_ip
+            self._update_counters(session, octets(record.input_octets, record.input_gigawords),
+                                  octets(record.output_octets, record.output_gigawords))
+            if record.event_time >= session.update_time:
+                session.update_time = record.event_time
+                self._sessions.move_to_end(unique_id)
+
+    def close_nas(self, nas_ip: str) -> int:
+        unique_ids = list(self._by_nas.get(nas_ip, ()))
+        for unique_id in unique_ids:
+            self._remove(unique_id)
+        return len(unique_ids)
+
+    def expire_stale(self, now: datetime) -> int:
+        """Drop sessions without accounting for STALE_AFTER; cost is the number dropped"""
+        cutoff = now - STALE_AFTER
+        dropped = 0
+        while self._sessions:
+            unique_id, session = next(iter(self._sessions.items()))
+            if session.update_time >= cutoff:
+                break
+            self._remove(unique_id)
+            dropped += 1
+        return dropped
+
+    def nas_totals(self, nas_ip: str) -> dict:
+        totals = self._nas_totals.get(nas_ip)
+        return totals.as_dict() if totals else NasTotals().as_dict()
+
+    def all_nas_totals(self) -> Dict[str, dict]:
+        return {nas_ip: totals.as_dict() for nas_ip, totals in self._nas_totals.items()}
+
+    def page(self, username: Optional[str] = None, nas_ip: Optional[str] = None,
+             offset: int = 0, limit: int = 100) -> Tuple[int, List[LiveSession]]:
+        """(matching total, one page of sessions) from the narrowest index"""
+        if username is not None:
+            keys = self._by_username.get(username, {})
+            if nas_ip is not None:
+                keys = {k: None for k in keys if self._sessions[k].nas_ip == nas_ip}
+        elif nas_ip is not None:
+            keys = self._by_nas.get(nas_ip, {})
+        else:
+            keys = self._sessions
+        return len(keys), [self._sessions[k] for k in islice(keys, offset, offset + limit)]
+
+    def load(self, dsn: Optional[str] = None) -> int:
+        """Warm from radacct's open sessions; no-op without DATABASE_URL"""
+        dsn = dsn if dsn is not None else os.getenv("DATABASE_URL")
+        if not dsn:
+            return 0
+        import psycopg2
+        with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+            cur.execute(OPEN_SESSIONS_QUERY + " ORDER BY 8")
+            for unique_id, session_id, username, nas_ip, port, framed_ip, started, updated, rx, tx in cur:
+                session = LiveSession(unique_id, session_id, username, nas_ip, local_time(started or updated))
+                session.nas_port_id = port
+                session.framed_ip = framed_ip
+                session.update_time = local_time(updated)
+                session.input_octets = rx or 0
+                session.output_octets = tx or 0
+                self._add(session)
+        logging.info(f"Loaded {len(self._sessions)} open sessions from radacct")
+        return len(self._sessions)
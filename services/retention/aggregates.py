@@ -0,0 +1,100 @@
+"""
+Running churn aggregates for the Retention Service.
+
+Counters are adjusted by the delta of each prediction change, so the
+risk-segment and metrics endpoints never scan the prediction set.
+"""
+
+from collections import Counter
+from typing import Dict, List, Optional
+
+from .scoring import RISK_LEVELS, HOLDOUT_ACCURACY
+
+AT_RISK_LEVELS = ("critical", "high")
+
+
+class RiskAggregates:
+    """Per-tenant counts, score sums and churn reason histograms by risk level."""
+
+    def __init__(self):
+        self.reset()
+        self.customers_saved = 0
+        self.customers_churned = 0
+        self.revenue_preserved = 0.0
+
+    def reset(self) -> None:
+        """Clear prediction-derived counters; retention outcomes are kept"""
+        self.count: Dict[str, int] = {level: 0 for level in RISK_LEVELS}
+        self.score_sum: Dict[str, float] = {level: 0.0 for level in RISK_LEVELS}
+        self.reasons: Dict[str, Counter] = {level: Counter() for level in RISK_LEVELS}
+        self.lifetime_value_sum = 0.0
+
+    @property
+    def customers(self) -> int:
+        return sum(self.count.values())
+
+    @property
+    def at_risk_customers(self) -> int:
+        return sum(self.count[level] for level in AT_RISK_LEVELS)
+
+    def _apply(self, prediction, sign: int) -> None:
+        level = prediction.risk_level.value
+        self.count[level] += sign
+        self.score_sum[level] += sign * prediction.risk_score
+        self.reasons[level][prediction.primary_reason.value] += sign
+        self.lifetime_value_sum += sign * prediction.lifetime_value
+
+    def add(self, prediction) -> None:
+        self._apply(prediction, 1)
+
+    def remove(self, prediction) -> None:
+        self._apply(prediction, -1)
+
+    def replace(self, previous: Optional[object], prediction) -> None:
+        if previous is not None:
+            self.remove(previous)
+        self.add(prediction)
+
+    def _outcome(self, saved: bool, lifetime_value: float, sign: int) -> None:
+        if saved:
+            self.customers_saved += sign
+            self.revenue_preserved += sign * lifetime_value
+        else:
+            self.customers_churned += sign
+
+    def record_outcome(self, saved: bool, lifetime_value: float = 0.0) -> None:
+        """Count a closed retention case as saved (revenue preserved) or churned"""
+        self._outcome(saved, lifetime_value, 1)
+
+    def retract_outcome(self, saved: bool, lifetime_value: float = 0.0) -> None:
+        """Undo record_outcome for a case that was reopened or closed differently"""
+        self._outcome(saved, lifetime_value, -1)
+
+    def segment_summaries(self) -> List[dict]:
+        total = self.customers or 1
+        summaries = []
+        for level in reversed(RISK_LEVELS):
+            count = self.count[level]
+            summaries.append({
+                "segment": level,
+                "customer_count": count,
+                "percentage": round(count / total * 100, 1),
+                "avg_risk_score": round(self.score_sum[level] / count, 1) if count else 0.0,
+                "primary_reasons": {reason: n for reason, n in self.reasons[level].most_common() if n > 0}
+            })
+        return summaries
+
+    def metrics(self) -> dict:
+        """Current gauges plus outcome counters, which are running totals rather than per-period"""
+        customers = self.customers
+        churn_rate = self.customers_churned / (customers + self.customers_churned) * 100 if customers else 0.0
+        return {
+            "period": "all_time",
+            "churn_rate": round(churn_rate, 2),
+            "prediction_accuracy": HOLDOUT_ACCURACY,
+            "at_risk_customers": self.at_risk_customers,
+            "customers_saved": self.customers_saved,
+            "revenue_preserved": round(self.revenue_preserved, 2),
+            "retention_rate": round(100 - churn_rate, 2),
+            "avg_customer_lifetime_value": round(self.lifetime_value_sum / customers, 2) if customers else 0.0
+        }
@@ -0,0 +1,214 @@
+"""
+Event-sourced retention case store.
+
+Every change to a case is appended to an event log; the current state of
+each case is a materialised view derived from that log. The view keeps
+risk-ordered indexes on status, risk level and assignee so list queries
+slice an index instead of filtering every case.
+"""
+
+from bisect import bisect_right, insort
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+import json
+import os
+import uuid
+
+OPEN_STATUSES = ("pending", "contacted", "offer_sent", "escalated")
+CLOSED_STATUSES = ("saved", "churned")
+
+CaseKey = Tuple[float, str]
+
+
+class CaseEvent:
+    """One immutable entry in the case event log."""
+
+    __slots__ = ("sequence", "case_id", "event_type", "data", "occurred_at")
+
+    def __init__(self, sequence: int, case_id: str, event_type: str, data: dict, occurred_at: datetime):
+        self.sequence = sequence
+        self.case_id = case_id
+        self.event_type = event_type
+        self.data = data
+        self.occurred_at = occurred_at
+
+    def as_dict(self) -> dict:
+        return {
+            "sequence": self.sequence,
+            "case_id": self.case_id,
+            "event_type": self.event_type,
+            "data": self.data,
+            "occurred_at": self.occurred_at.isoformat()
+        }
+
+    @classmethod
+    def from_dict(cls, raw: dict) -> "CaseEvent":
+        return cls(raw["sequence"], raw["case_id"], raw["event_type"], raw["data"],
+                   datetime.fromisoformat(raw["occurred_at"]))
+
+
+class CaseEventLog:
+    """Append-only event list, mirrored to a JSON-lines file when a path is given."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._events: List[CaseEvent] = []
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def append(self, case_id: str, event_type: str, data: dict, occurred_at: Optional[datetime] = None) -> CaseEvent:
+        event = CaseEvent(len(self._events) + 1, case_id, event_type, data, occurred_at or datetime.now())
+        if self.path:
+            with open(self.path, "a") as fh:
+                fh.write(json.dumps(event.as_dict()) + "\n")
+        self._events.append(event)
+        return event
+
+    def replay(self) -> Iterator[CaseEvent]:
+        """Load events persisted by a previous process (once, at startup)"""
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as fh:
+            for line in fh:
+                if line.strip():
+                    event = CaseEvent.from_dict(json.loads(line))
+                    self._events.append(event)
+                    yield event
+
+    def events_for(self, positions: List[int]) -> List[CaseEvent]:
+        return [self._events[pos] for pos in positions]
+
+
+class RetentionCaseStore:
+    """Materialised current state of every case, fed only through the event log."""
+
+    def __init__(self, log: Optional[CaseEventLog] = None):
+        self.log = log if log is not None else CaseEventLog()
+        self._cases: Dict[str, dict] = {}
+        self._history: Dict[str, List[int]] = {}
+        self._open_by_customer: Dict[str, str] = {}
+        self._ranked: List[CaseKey] = []
+        self._open: List[CaseKey] = []
+        self._by_status: Dict[str, List[CaseKey]] = {}
+        self._by_risk_level: Dict[str, List[CaseKey]] = {}
+        self._by_assignee: Dict[str, List[CaseKey]] = {}
+        self._open_by_assignee: Dict[str, List[CaseKey]] = {}
+        for event in self.log.replay():
+            self._apply(event)
+
+    def __len__(self) -> int:
+        return len(self._cases)
+
+    @staticmethod
+    def _key(case: dict) -> CaseKey:
+        return (-case["risk_score"], case["id"])
+
+    def _indexes(self, case: dict) -> List[List[CaseKey]]:
+        indexes = [
+            self._ranked,
+            self._by_status.setdefault(case["status"], []),
+            self._by_risk_level.setdefault(case["risk_level"], []),
+        ]
+        if case["status"] in OPEN_STATUSES:
+            indexes.append(self._open)
+        if case["assigned_to"]:
+            indexes.append(self._by_assignee.setdefault(case["assigned_to"], []))
+            if case["status"] in OPEN_STATUSES:
+                indexes.append(self._open_by_assignee.setdefault(case["assigned_to"], []))
+        return indexes
+
+    def _unindex(self, case: dict) -> None:
+        key = self._key(case)
+        for index in self._indexes(case):
+            pos = bisect_right(index, key) - 1
+            if pos >= 0 and index[pos] == key:
+                del index[pos]
+
+    def _apply(self, event: CaseEvent) -> Tuple[Optional[str], dict]:
+        """Fold one event into the view, returning (previous status, new state)"""
+        previous = self._cases.get(event.case_id)
+        if event.event_type == "OPENED":
+            case = dict(event.data, id=event.case_id, notes=list(event.data.get("notes", [])),
+                        created_at=event.occurred_at)
+            previous_status = None
+        else:
+            self._unindex(previous)
+            case = dict(previous)
+            previous_status = previous["status"]
+            data = event.data
+            if data.get("status"):
+                case["status"] = data["status"]
+            if data.get("assigned_to"):
+                case["assigned_to"] = data["assigned_to"]
+            if data.get("notes"):
+                case["notes"] = case["notes"] + [data["notes"]]
+            case["last_action"] = data.get("action")
+        case["last_updated"] = event.occurred_at
+
+        self._cases[event.case_id] = case
+        self._history.setdefault(event.case_id, []).append(event.sequence - 1)
+        if case["status"] in OPEN_STATUSES:
+            self._open_by_customer[case["customer_id"]] = event.case_id
+        else:
+            self._open_by_customer.pop(case["customer_id"], None)
+        key = self._key(case)
+        for index in self._indexes(case):
+            insort(index, key)
+        return previous_status, case
+
+    def open_case(self, data: dict) -> dict:
+        case_id = str(uuid.uuid4())
+        return self._apply(self.log.append(case_id, "OPENED", dict(data, status="pending")))[1]
+
+    def record_action(self, case_id: str, action: str, notes: Optional[str] = None,
+                      status: Optional[str] = None, assigned_to: Optional[str] = None) -> Tuple[Optional[str], dict]:
+        if case_id not in self._cases:
+            raise KeyError(case_id)
+        data = {"action": action, "notes": notes, "status": status, "assigned_to": assigned_to}
+        return self._apply(self.log.append(case_id, "ACTION", data))
+
+    def get(self, case_id: str) -> Optional[dict]:
+        return self._cases.get(case_id)
+
+    def open_case_for(self, customer_id: str) -> Optional[dict]:
+        case_id = self._open_by_customer.get(customer_id)
+        return self._cases[case_id] if case_id else None
+
+    def history(self, case_id: str) -> List[CaseEvent]:
+        return self.log.events_for(self._history.get(case_id, []))
+
+    def query(self, status: Optional[str] = None, risk_level: Optional[str] = None,
+              assigned_to: Optional[str] = None, open_only: bool = False, limit: int = 50) -> List[dict]:
+        """Highest-risk cases matching every filter.
+
+        Scans the smallest applicable index; remaining filters are checked on
+        the rows of that index only.
+        """
+        candidates = [self._open if open_only else self._ranked]
+        if assigned_to and open_only:
+            candidates.append(self._open_by_assignee.get(assigned_to, []))
+        elif assigned_to:
+            candidates.append(self._by_assignee.get(assigned_to, []))
+        if status:
+            candidates.append(self._by_status.get(status, []))
+        if risk_level:
+            candidates.append(self._by_risk_level.get(risk_level, []))
+
+        index = min(candidates, key=len)
+        results = []
+        for key in index:
+            case = self._cases[key[1]]
+            if status and case["status"] != status:
+                continue
+            if risk_level and case["risk_level"] != risk_level:
+                continue
+            if assigned_to and case["assigned_to"] != assigned_to:
+                continue
+            if open_only and case["status"] not in OPEN_STATUSES:
+                continue
+            results.append(case)
+            if len(results) >= limit:
+                break
+        return results
+
@@ -5,12 +5,28 @@ Handles churn prediction, retention analytics, and customer risk scoring.
 
 from fastapi import FastAPI, Depends, HTTPException, status, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 from enum import Enum
-import random
+import json
+import os
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .scoring import (
+    ChurnScoringEngine, CustomerFeatureTable, ScoringResult,
+    SEGMENTS, RISK_LEVELS, CHURN_REASONS
+)
+from .store import PredictionStore, rank_key, encode_cursor, decode_cursor
+from .aggregates import RiskAggregates
+from .cases import RetentionCaseStore, CaseEventLog, CLOSED_STATUSES
+from .rollups import ChurnRollups
 
 app = FastAPI(
     title="OmniDome Retention Service",
@@ -82,6 +98,11 @@ class RetentionCase(BaseModel):
     created_at: datetime
     last_updated: datetime
 
+class RetentionCaseCreate(BaseModel):
+    customer_id: uuid.UUID
+    assigned_to: Optional[str] = "Retention Team"
+    notes: Optional[str] = None
+
 class RetentionCampaign(BaseModel):
     id: uuid.UUID
     name: str
@@ -96,7 +117,7 @@ class RetentionCampaign(BaseModel):
     is_active: bool
 
 class ChurnMetrics(BaseModel):
-    period: str
+    period: str # "all_time": outcome counters are running totals
     churn_rate: float
     prediction_accuracy: float
     at_risk_customers: int
@@ -112,43 +133,141 @@ class RiskSegmentSummary(BaseModel):
     avg_risk_score: float
     primary_reasons: Dict[str, int]
 
-# --- Mock Data Helpers ---
-def generate_mock_predictions(count: int = 50) -> List[ChurnPrediction]:
-    segments = ["Enterprise", "Business", "Premium", "Standard", "Basic"]
-    names = [
-        "Thabo Mokoena", "Lerato Mbeki", "Johan Pretorius", "Nomvula Dlamini",
-        "Sipho Nkosi", "Sarah van der Merwe", "David Smith", "Lindiwe Zulu",
-        "Peter Botha", "Grace Molefe", "Marcus du Plessis", "Andile Khumalo"
-    ]
+# --- Scoring Engine ---
+BASE_CUSTOMER_COUNT = 24847
+EXPORT_BATCH_SIZE = 500
+SCORING_WORKERS = int(os.getenv("RETENTION_SCORING_WORKERS", os.cpu_count() or 1))
+
+engine = ChurnScoringEngine()
+_feature_tables: Dict[uuid.UUID, CustomerFeatureTable] = {}
+_prediction_stores: Dict[uuid.UUID, PredictionStore] = {}
+_case_stores: Dict[uuid.UUID, RetentionCaseStore] = {}
+_rollups: Dict[uuid.UUID, ChurnRollups] = {}
+_process_pool: Optional[ProcessPoolExecutor] = None
+CASE_LOG_DIR = os.getenv("RETENTION_CASE_LOG_DIR")
+
+RECOMMENDED_ACTIONS = {
+    ChurnReason.PRICE_SENSITIVITY: "Offer loyalty discount or upgrade bundle",
+    ChurnReason.SERVICE_ISSUES: "Offer 20% discount + personal apology call",
+    ChurnReason.COMPETITOR_OFFER: "Match competitor pricing with a 12-month lock-in",
+    ChurnReason.RELOCATION: "Check coverage at new address and offer free relocation",
+    ChurnReason.NO_LONGER_NEEDED: "Offer downgrade to a lower tier instead of cancellation",
+    ChurnReason.PAYMENT_ISSUES: "Offer payment arrangement or debit order date change",
+}
+
+def get_feature_table(tenant_id: uuid.UUID) -> CustomerFeatureTable:
+    """Columnar customer features for a tenant (synthetic until the CRM export lands)"""
+    if tenant_id not in _feature_tables:
+        _feature_tables[tenant_id] = CustomerFeatureTable.synthetic(BASE_CUSTOMER_COUNT, datetime.now())
+    return _feature_tables[tenant_id]
+
+def load_tenant(tenant_id: uuid.UUID) -> None:
+    """Build a tenant's predictions and retention cases together, as each seeds the other
+
+    Cases are replayed from the event log, or seeded from critical predictions (one open case per
+    customer); outcomes come from the cases' current status, so a case closed, reopened and closed
+    again counts once.
+    """
+    table = get_feature_table(tenant_id)
+    store = PredictionStore(aggregates=RiskAggregates())
+    store.load(build_predictions(table, engine.score(table)))
+    path = os.path.join(CASE_LOG_DIR, f"{tenant_id}.jsonl") if CASE_LOG_DIR else None
+    cases = RetentionCaseStore(CaseEventLog(path))
+    if not len(cases):
+        for prediction in store.top(BASE_CUSTOMER_COUNT, risk_level=RiskLevel.CRITICAL):
+            if cases.open_case_for(str(prediction.customer_id)) is None:
+                cases.open_case(case_data(prediction, assigned_to="Retention Team"))
+    for outcome in CLOSED_STATUSES:
+        for case in cases.query(status=outcome, limit=len(cases)):
+            store.aggregates.record_outcome(saved=outcome == RetentionStatus.SAVED.value,
+                                            lifetime_value=case["lifetime_value"])
+    _prediction_stores[tenant_id] = store
+    _case_stores[tenant_id] = cases
+
+def get_prediction_store(tenant_id: uuid.UUID) -> PredictionStore:
+    """Latest scored predictions for a tenant, seeded with a full scoring run on first use"""
+    if tenant_id not in _prediction_stores:
+        load_tenant(tenant_id)
+    return _prediction_stores[tenant_id]
+
+def get_case_store(tenant_id: uuid.UUID) -> RetentionCaseStore:
+    """Retention cases for a tenant, replayed from the event log or seeded from critical predictions"""
+    if tenant_id not in _case_stores:
+        load_tenant(tenant_id)
+    return _case_stores[tenant_id]
+
+def get_rollups(tenant_id: uuid.UUID) -> ChurnRollups:
+    """Weekly/monthly churn rollups for a tenant, backfilled with synthetic history on first use"""
+    if tenant_id not in _rollups:
+        aggregates = get_prediction_store(tenant_id).aggregates
+        rollups = ChurnRollups(date.today())
+        rollups.backfill_synthetic(date.today(), aggregates.customers, aggregates.at_risk_customers)
+        rollups.record_prediction_run(date.today(), aggregates.at_risk_customers, aggregates.customers)
+        _rollups[tenant_id] = rollups
+    return _rollups[tenant_id]
+
+def case_data(prediction: ChurnPrediction, assigned_to: Optional[str], notes: Optional[str] = None) -> dict:
+    """Event payload for opening a case from a churn prediction"""
+    return {
+        "customer_id": str(prediction.customer_id),
+        "account_number": prediction.account_number,
+        "customer_name": prediction.customer_name,
+        "risk_score": prediction.risk_score,
+        "risk_level": prediction.risk_level.value,
+        "assigned_to": assigned_to,
+        "churn_reason": prediction.primary_reason.value,
+        "recommended_action": RECOMMENDED_ACTIONS[prediction.primary_reason],
+        "notes": [notes] if notes else [],
+        "lifetime_value": prediction.lifetime_value
+    }
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=SCORING_WORKERS)
+    return _process_pool
+
+def build_predictions(table: CustomerFeatureTable, result: ScoringResult,
+                      positions: Optional[np.ndarray] = None) -> List[ChurnPrediction]:
+    """Materialise scored rows as API models, converting each column to Python once"""
+    if positions is None:
+        positions = np.arange(len(result))
+    rows = result.rows[positions]
+    levels = [RiskLevel(v) for v in RISK_LEVELS]
+    reasons = [ChurnReason(v) for v in CHURN_REASONS]
+    scored_at = datetime.now()
     
-    predictions = []
-    for i in range(count):
-        risk_score = random.uniform(50, 98) if i < 10 else random.uniform(20, 70)
-        risk_level = (
-            RiskLevel.CRITICAL if risk_score >= 90 else
-            RiskLevel.HIGH if risk_score >= 70 else
-            RiskLevel.MEDIUM if risk_score >= 50 else
-            RiskLevel.LOW if risk_score >= 30 else
-            RiskLevel.LOYAL
+    return [
+        ChurnPrediction(
+            customer_id=customer_id,
+            account_number=account_number,
+            customer_name=customer_name,
+            segment=SEGMENTS[segment_code],
+            risk_score=risk_score,
+            risk_level=levels[level_code],
+            primary_reason=reasons[rank[0]],
+            secondary_reasons=[reasons[code] for code in rank[1:] if code >= 0],
+            tenure_months=int(tenure),
+            lifetime_value=lifetime_value,
+            last_interaction=last_interaction,
+            prediction_date=scored_at,
+            confidence_score=confidence
         )
-        
-        predictions.append(ChurnPrediction(
-            customer_id=uuid.uuid4(),
-            account_number=f"ACC-{random.randint(10000, 99999)}",
-            customer_name=random.choice(names),
-            segment=random.choice(segments),
-            risk_score=round(risk_score, 1),
-            risk_level=risk_level,
-            primary_reason=random.choice(list(ChurnReason)),
-            secondary_reasons=random.sample(list(ChurnReason), k=random.randint(0, 2)),
-            tenure_months=random.randint(1, 60),
-            lifetime_value=random.uniform(2000, 50000),
-            last_interaction=datetime.now() - timedelta(days=random.randint(1, 30)),
-            prediction_date=datetime.now(),
-            confidence_score=round(random.uniform(0.75, 0.95), 2)
-        ))
-    
-    return sorted(predictions, key=lambda x: x.risk_score, reverse=True)
+        for customer_id, account_number, customer_name, segment_code, risk_score, level_code,
+            rank, tenure, lifetime_value, last_interaction, confidence in zip(
+            table.customer_id[rows].tolist(),
+            table.account_number[rows].tolist(),
+            table.customer_name[rows].tolist(),
+            table.segment_code[rows].tolist(),
+            result.risk_score[positions].tolist(),
+            result.level_code[positions].tolist(),
+            result.reason_rank[positions].tolist(),
+            table.features[rows, 0].tolist(),
+            table.lifetime_value[rows].tolist(),
+            table.last_interaction[rows].tolist(),
+            result.confidence[positions].tolist()
+        )
+    ]
 
 # --- Tenant Context (Stub) ---
 async def get_current_tenant_id() -> uuid.UUID:
@@ -174,21 +293,9 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 @app.get("/metrics", response_model=ChurnMetrics)
-async def get_churn_metrics(
-    period: str = Query("monthly", description="Metrics period: weekly, monthly, quarterly"),
-    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
-):
-    """Get aggregated churn and retention metrics"""
-    return ChurnMetrics(
-        period=period,
-        churn_rate=2.1,
-        prediction_accuracy=87.3,
-        at_risk_customers=847,
-        customers_saved=343,
-        revenue_preserved=2100000.00,
-        retention_rate=97.9,
-        avg_customer_lifetime_value=18500.00
-    )
+async def get_churn_metrics(tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Get aggregated churn and retention metrics over all recorded outcomes (see /analytics for trends)"""
+    return get_prediction_store(tenant_id).aggregates.metrics()
 
 @app.get("/predictions", response_model=List[ChurnPrediction])
 async def get_churn_predictions(
@@ -199,16 +306,53 @@ async def get_churn_predictions(
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
     """Get AI-powered churn predictions for customers"""
-    predictions = generate_mock_predictions(limit)
+    store = get_prediction_store(tenant_id)
+    return store.top(limit, risk_level=risk_level, segment=segment, min_risk_score=min_risk_score)
+
+@app.get("/predictions/export")
+async def export_churn_predictions(
+    risk_level: Optional[RiskLevel] = None,
+    segment: Optional[str] = None,
+    min_risk_score: float = Query(0, ge=0, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor from a previous export"),
+    limit: Optional[int] = Query(None, ge=1, description="Stop after this many rows (default: all)"),
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    """Stream churn predictions as NDJSON in risk order, resumable via keyset cursor.
+
+    The final line is always {"next_cursor": ...}; it is null once the export is exhausted.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(exc))
     
-    if risk_level:
-        predictions = [p for p in predictions if p.risk_level == risk_level]
-    if segment:
-        predictions = [p for p in predictions if p.segment.lower() == segment.lower()]
-    if min_risk_score > 0:
-        predictions = [p for p in predictions if p.risk_score >= min_risk_score]
+    store = get_prediction_store(tenant_id)
+    
+    async def ndjson_rows():
+        remaining = limit
+        last = None
+        batches = store.scan(after, risk_level=risk_level, segment=segment,
+                             min_risk_score=min_risk_score, batch_size=EXPORT_BATCH_SIZE)
+        for batch in batches:
+            if remaining is not None:
+                batch = batch[:remaining]
+                remaining -= len(batch)
+            yield "".join(prediction.json() + "\n" for prediction in batch)
+            last = batch[-1]
+            if remaining == 0:
+                break
+        
+        # Only hand back a cursor when the scan stopped early and rows remain
+        next_cursor = None
+        if remaining == 0 and last is not None:
+            more = next(store.scan(rank_key(last), risk_level=risk_level, segment=segment,
+                                   min_risk_score=min_risk_score, batch_size=1), None)
+            if more:
+                next_cursor = encode_cursor(rank_key(last))
+        yield json.dumps({"next_cursor": next_cursor}) + "\n"
     
-    return predictions[:limit]
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
 
 @app.get("/predictions/{customer_id}", response_model=ChurnPrediction)
 async def get_customer_prediction(
@@ -216,128 +360,98 @@ async def get_customer_prediction(
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
     """Get detailed churn prediction for a specific customer"""
-    # Mock single customer prediction
-    return ChurnPrediction(
-        customer_id=customer_id,
-        account_number=f"ACC-{random.randint(10000, 99999)}",
-        customer_name="Thabo Mokoena",
-        segment="Premium",
-        risk_score=87.5,
-        risk_level=RiskLevel.HIGH,
-        primary_reason=ChurnReason.PRICE_SENSITIVITY,
-        secondary_reasons=[ChurnReason.SERVICE_ISSUES],
-        tenure_months=14,
-        lifetime_value=24800.00,
-        last_interaction=datetime.now() - timedelta(days=7),
-        prediction_date=datetime.now(),
-        confidence_score=0.89
-    )
+    prediction = get_prediction_store(tenant_id).get(customer_id)
+    if prediction is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No prediction for customer")
+    return prediction
 
 @app.get("/risk-segments", response_model=List[RiskSegmentSummary])
 async def get_risk_segments(tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
     """Get customer distribution by risk segment"""
-    return [
-        RiskSegmentSummary(
-            segment=RiskLevel.CRITICAL,
-            customer_count=124,
-            percentage=0.5,
-            avg_risk_score=93.2,
-            primary_reasons={"price_sensitivity": 45, "service_issues": 35, "competitor_offer": 44}
-        ),
-        RiskSegmentSummary(
-            segment=RiskLevel.HIGH,
-            customer_count=723,
-            percentage=2.9,
-            avg_risk_score=78.4,
-            primary_reasons={"price_sensitivity": 280, "service_issues": 210, "competitor_offer": 233}
-        ),
-        RiskSegmentSummary(
-            segment=RiskLevel.MEDIUM,
-            customer_count=2134,
-            percentage=8.6,
-            avg_risk_score=58.7,
-            primary_reasons={"service_issues": 640, "no_longer_needed": 534, "price_sensitivity": 960}
-        ),
-        RiskSegmentSummary(
-            segment=RiskLevel.LOW,
-            customer_count=8521,
-            percentage=34.2,
-            avg_risk_score=35.2,
-            primary_reasons={"no_engagement": 2556, "service_issues": 1704, "relocation": 4261}
-        ),
-        RiskSegmentSummary(
-            segment=RiskLevel.LOYAL,
-            customer_count=13345,
-            percentage=53.6,
-            avg_risk_score=12.8,
-            primary_reasons={}
-        )
-    ]
+    return get_prediction_store(tenant_id).aggregates.segment_summaries()
 
 @app.get("/cases", response_model=List[RetentionCase])
 async def get_retention_cases(
     status: Optional[RetentionStatus] = None,
     risk_level: Optional[RiskLevel] = None,
+    assigned_to: Optional[str] = None,
+    open_only: bool = False,
     limit: int = Query(50, le=200),
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
-    """Get active retention cases"""
-    cases = [
-        RetentionCase(
-            id=uuid.uuid4(),
-            customer_id=uuid.uuid4(),
-            account_number="ACC-78421",
-            customer_name="Lerato Mbeki",
-            risk_score=94.2,
-            risk_level=RiskLevel.CRITICAL,
-            status=RetentionStatus.CONTACTED,
-            assigned_to="Retention Team",
-            churn_reason=ChurnReason.SERVICE_ISSUES,
-            recommended_action="Offer 20% discount + personal apology call",
-            notes=["Customer reported slow speeds", "Field tech dispatched"],
-            created_at=datetime.now() - timedelta(days=2),
-            last_updated=datetime.now()
-        ),
-        RetentionCase(
-            id=uuid.uuid4(),
-            customer_id=uuid.uuid4(),
-            account_number="ACC-65892",
-            customer_name="Johan Pretorius",
-            risk_score=87.1,
-            risk_level=RiskLevel.HIGH,
-            status=RetentionStatus.OFFER_SENT,
-            assigned_to="Sales Rep",
-            churn_reason=ChurnReason.PRICE_SENSITIVITY,
-            recommended_action="Offer loyalty discount or upgrade bundle",
-            notes=["Customer comparing MTN prices"],
-            created_at=datetime.now() - timedelta(days=1),
-            last_updated=datetime.now() - timedelta(hours=4)
-        )
-    ]
-    
-    if status:
-        cases = [c for c in cases if c.status == status]
-    if risk_level:
-        cases = [c for c in cases if c.risk_level == risk_level]
-    
-    return cases[:limit]
+    """Get retention cases, highest risk first"""
+    cases = get_case_store(tenant_id).query(
+        status=status.value if status else None,
+        risk_level=risk_level.value if risk_level else None,
+        assigned_to=assigned_to,
+        open_only=open_only,
+        limit=limit
+    )
+    return [RetentionCase(**case) for case in cases]
+
+@app.post("/cases", response_model=RetentionCase, status_code=status.HTTP_201_CREATED)
+async def open_retention_case(
+    request: RetentionCaseCreate,
+    tenant_id: uuid.UUID = Depends(get_current_tenant_id)
+):
+    """Open a retention case for a customer from their latest churn prediction"""
+    prediction = get_prediction_store(tenant_id).get(request.customer_id)
+    if prediction is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No prediction for customer")
+    cases = get_case_store(tenant_id)
+    if cases.open_case_for(str(request.customer_id)):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Customer already has an open case")
+    return RetentionCase(**cases.open_case(case_data(prediction, request.assigned_to, request.notes)))
 
 @app.post("/cases/{case_id}/action")
 async def take_retention_action(
     case_id: uuid.UUID,
     action: str,
     notes: Optional[str] = None,
+    new_status: Optional[RetentionStatus] = Query(None, alias="status"),
+    assigned_to: Optional[str] = None,
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
     """Record a retention action taken on a case"""
+    try:
+        previous_status, case = get_case_store(tenant_id).record_action(
+            str(case_id), action, notes,
+            status=new_status.value if new_status else None,
+            assigned_to=assigned_to
+        )
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Case not found")
+    
+    if case["status"] != previous_status:
+        # Aggregates hold each case's final outcome: take back the old one before counting the new
+        aggregates = get_prediction_store(tenant_id).aggregates
+        if previous_status in CLOSED_STATUSES:
+            aggregates.retract_outcome(saved=previous_status == RetentionStatus.SAVED.value,
+                                       lifetime_value=case["lifetime_value"])
+        if case["status"] in CLOSED_STATUSES:
+            saved = case["status"] == RetentionStatus.SAVED.value
+            aggregates.record_outcome(saved=saved, lifetime_value=case["lifetime_value"])
+            if previous_status not in CLOSED_STATUSES:
+                get_rollups(tenant_id).record_outcome(date.today(), saved=saved, reason=case["churn_reason"])
+    
     return {
         "case_id": case_id,
         "action_taken": action,
         "notes": notes,
-        "timestamp": datetime.now().isoformat(),
+        "case_status": case["status"],
+        "assigned_to": case["assigned_to"],
+        "timestamp": case["last_updated"].isoformat(),
         "status": "recorded"
     }
 
+@app.get("/cases/{case_id}/events")
+async def get_case_events(case_id: uuid.UUID, tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
+    """Full event history of a retention case, oldest first"""
+    events = get_case_store(tenant_id).history(str(case_id))
+    if not events:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Case not found")
+    return [event.as_dict() for event in events]
+
 @app.get("/campaigns", response_model=List[RetentionCampaign])
 async def get_retention_campaigns(
     is_active: Optional[bool] = None,
@@ -396,24 +510,18 @@ async def get_churn_trend(
     months: int = Query(6, ge=1, le=24),
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
-    """Get historical churn rate trend"""
-    base_date = datetime.now()
-    trend = []
-    churn_rate = 3.5  # Starting rate
-    
-    for i in range(months, 0, -1):
-        month_date = base_date - timedelta(days=i * 30)
-        # Simulate improving churn rate
-        churn_rate = max(2.0, churn_rate - random.uniform(0.05, 0.25))
-        
-        trend.append({
-            "month": month_date.strftime("%b %Y"),
-            "churn_rate": round(churn_rate, 2),
-            "predicted_rate": round(churn_rate + random.uniform(-0.2, 0.3), 2),
-            "customers_churned": int(24847 * churn_rate / 100),
-            "customers_saved": random.randint(200, 400)
-        })
-    
+    """Get historical churn rate trend from the closed monthly rollups"""
+    rows = get_rollups(tenant_id).monthly.latest(months, date.today())
+    trend = [
+        {
+            "month": row.period_start.strftime("%b %Y"),
+            "churn_rate": row.churn_rate,
+            "predicted_rate": row.predicted_rate,
+            "customers_churned": row.churned,
+            "customers_saved": row.saved
+        }
+        for row in rows
+    ]
     return {"period": f"Last {months} months", "data": trend}
 
 @app.get("/analytics/churn-reasons")
@@ -421,18 +529,32 @@ async def get_churn_reasons_breakdown(
     period: str = Query("monthly", description="weekly, monthly, quarterly"),
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
-    """Get breakdown of churn reasons"""
-    return {
-        "period": period,
-        "total_churned": 521,
-        "reasons": [
-            {"reason": "Price Sensitivity", "count": 167, "percentage": 32.1},
-            {"reason": "Service Issues", "count": 130, "percentage": 25.0},
-            {"reason": "Competitor Offers", "count": 94, "percentage": 18.0},
-            {"reason": "Relocation", "count": 68, "percentage": 13.0},
-            {"reason": "No Longer Needed", "count": 62, "percentage": 11.9}
-        ]
-    }
+    """Get breakdown of churn reasons for the last closed period"""
+    rollups = get_rollups(tenant_id)
+    if period == "weekly":
+        rows = rollups.weekly.latest(1, date.today())
+    elif period == "monthly":
+        rows = rollups.monthly.latest(1, date.today())
+    elif period == "quarterly":
+        rows = rollups.monthly.latest(3, date.today())
+    else:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="period must be weekly, monthly or quarterly")
+    
+    counts = [sum(row.churned_by_reason[code] for row in rows) for code in range(len(CHURN_REASONS))]
+    total = sum(counts)
+    reasons = sorted(
+        (
+            {
+                "reason": CHURN_REASONS[code].replace("_", " ").title(),
+                "count": count,
+                "percentage": round(count / total * 100, 1) if total else 0.0
+            }
+            for code, count in enumerate(counts) if count
+        ),
+        key=lambda r: r["count"],
+        reverse=True
+    )
+    return {"period": period, "total_churned": total, "reasons": reasons}
 
 @app.get("/analytics/clv-by-segment")
 async def get_clv_by_segment(tenant_id: uuid.UUID = Depends(get_current_tenant_id)):
@@ -454,15 +576,35 @@ async def trigger_batch_prediction(
     segment: Optional[str] = None,
     tenant_id: uuid.UUID = Depends(get_current_tenant_id)
 ):
-    """Trigger batch churn prediction for all/segment customers"""
+    """Run batch churn prediction for all/segment customers across the scoring process pool"""
+    table = get_feature_table(tenant_id)
+    started = time.perf_counter()
+    result = await engine.score_parallel(table, get_process_pool(), table.rows_for_segment(segment))
+    
+    predictions = await asyncio.to_thread(build_predictions, table, result)
+    store = get_prediction_store(tenant_id)
+    if segment:
+        for prediction in predictions:
+            store.upsert(prediction)
+    else:
+        store.load(predictions)
+    get_rollups(tenant_id).record_prediction_run(date.today(), store.aggregates.at_risk_customers, store.aggregates.customers)
+    
     return {
         "job_id": str(uuid.uuid4()),
-        "status": "queued",
+        "status": "completed",
         "segment": segment or "all",
-        "estimated_customers": 24847 if not segment else random.randint(1000, 5000),
-        "estimated_completion": (datetime.now() + timedelta(minutes=15)).isoformat()
+        "customers_scored": len(result),
+        "risk_distribution": result.level_counts(),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+        "completed_at": datetime.now().isoformat()
     }
 
+@app.on_event("shutdown")
+async def shutdown_scoring_pool():
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8012)
@@ -0,0 +1,141 @@
+"""
+Materialised churn rollups for the Retention Service.
+
+Outcomes and prediction runs are added to the open weekly and monthly
+buckets as they happen. When a period ends its bucket is closed and
+appended to a bounded history, so trend and reason queries read a
+handful of pre-aggregated rows whatever window they ask for.
+"""
+
+from collections import deque
+from datetime import date, timedelta
+from typing import Deque, List, Optional
+
+import numpy as np
+
+from .scoring import CHURN_REASONS
+
+MAX_MONTHS = 24
+MAX_WEEKS = 104
+# Historical share of churn by reason, in CHURN_REASONS order
+REASON_MIX = [0.32, 0.25, 0.18, 0.13, 0.08, 0.04]
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(start: date) -> date:
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def week_start(day: date) -> date:
+    return day - timedelta(days=day.weekday())
+
+
+def next_week(start: date) -> date:
+    return start + timedelta(days=7)
+
+
+class RollupRow:
+    """Counts for one closed (or the currently open) period.
+
+    `predicted` is the at-risk (critical or high) customer count from the
+    period's latest scoring run, so predicted_rate is the at-risk share.
+    """
+
+    __slots__ = ("period_start", "churned", "saved", "predicted", "base", "churned_by_reason")
+
+    def __init__(self, period_start: date, base: int = 0, predicted: int = 0):
+        self.period_start = period_start
+        self.churned = 0
+        self.saved = 0
+        self.predicted = predicted
+        self.base = base
+        self.churned_by_reason = [0] * len(CHURN_REASONS)
+
+    @property
+    def churn_rate(self) -> float:
+        return round(self.churned / self.base * 100, 2) if self.base else 0.0
+
+    @property
+    def predicted_rate(self) -> float:
+        return round(self.predicted / self.base * 100, 2) if self.base else 0.0
+
+
+class PeriodRollup:
+    """One granularity (weekly or monthly): an open bucket plus a bounded closed history."""
+
+    def __init__(self, start_of, advance, max_periods: int, today: date):
+        self._start_of = start_of
+        self._advance = advance
+        self.closed: Deque[RollupRow] = deque(maxlen=max_periods)
+        self.open = RollupRow(start_of(today))
+
+    def current(self, day: date) -> RollupRow:
+        """Open bucket for `day`, closing any periods that have ended since the last event"""
+        start = self._start_of(day)
+        while self.open.period_start < start:
+            self.closed.append(self.open)
+            # Gauges carry over so an idle period still reports the last known base
+            self.open = RollupRow(self._advance(self.open.period_start), self.open.base, self.open.predicted)
+        return self.open
+
+    def latest(self, count: int, today: date) -> List[RollupRow]:
+        self.current(today)
+        return list(self.closed)[-count:]
+
+
+class ChurnRollups:
+    """Weekly and monthly churned/saved/predicted counts, broken down by churn reason."""
+
+    def __init__(self, today: date):
+        self.monthly = PeriodRollup(month_start, next_month, MAX_MONTHS, today)
+        self.weekly = PeriodRollup(week_start, next_week, MAX_WEEKS, today)
+
+    def _buckets(self, day: date) -> List[RollupRow]:
+        return [self.monthly.current(day), self.weekly.current(day)]
+
+    def record_outcomes(self, day: date, saved: int = 0, churned_by_reason: Optional[List[int]] = None) -> None:
+        for bucket in self._buckets(day):
+            bucket.saved += saved
+            if churned_by_reason:
+                bucket.churned += sum(churned_by_reason)
+                for code, count in enumerate(churned_by_reason):
+                    bucket.churned_by_reason[code] += count
+
+    def record_outcome(self, day: date, saved: bool, reason: str) -> None:
+        if saved:
+            self.record_outcomes(day, saved=1)
+        else:
+            churned = [0] * len(CHURN_REASONS)
+            churned[CHURN_REASONS.index(reason)] = 1
+            self.record_outcomes(day, churned_by_reason=churned)
+
+    def record_prediction_run(self, day: date, at_risk: int, base: int) -> None:
+        """Latest scoring run wins for the period's predicted and base gauges"""
+        for bucket in self._buckets(day):
+            bucket.predicted = at_risk
+            bucket.base = base
+
+    def backfill_synthetic(self, today: date, base: int, at_risk: int, days: int = MAX_MONTHS * 31,
+                           seed: Optional[int] = None) -> None:
+        """Replay a plausible daily churn history until the historical churn export is wired in
+
+        The at-risk gauge tracks the churn rate and ends near today's `at_risk`.
+        """
+        rng = np.random.default_rng(seed)
+        start = today - timedelta(days=days)
+        self.monthly = PeriodRollup(month_start, next_month, MAX_MONTHS, start)
+        self.weekly = PeriodRollup(week_start, next_week, MAX_WEEKS, start)
+
+        # Monthly churn easing from ~3.5% towards 2%, spread over days and reasons
+        monthly_rate = np.linspace(3.5, 2.0, days) + rng.normal(0, 0.1, days)
+        churned = rng.poisson(base * monthly_rate / 100 / 30)
+        by_reason = rng.multinomial(churned, REASON_MIX).tolist()
+        predicted = (at_risk * (monthly_rate + rng.uniform(-0.2, 0.3, days)) / 2.0).astype(int).tolist()
+        saved = rng.poisson(10, days).tolist()
+        for offset in range(days):
+            day = start + timedelta(days=offset)
+            self.record_prediction_run(day, predicted[offset], base)
+            self.record_outcomes(day, saved=saved[offset], churned_by_reason=by_reason[offset])
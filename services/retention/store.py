@@ -0,0 +1,141 @@
+"""
+Ranked in-memory store for the latest churn predictions.
+
+Every index is a list of (-risk_score, customer_id) keys kept in sorted
+order, so the highest risk customers always sit at the front and a
+filtered top-K query is a bisect plus a slice.
+"""
+
+import base64
+from bisect import bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import uuid
+
+from .aggregates import RiskAggregates
+
+RankKey = Tuple[float, str]
+
+# Sorts after every customer id string, so (-score, _MAX_ID) bounds a score range inclusively
+_MAX_ID = "\uffff"
+
+
+def rank_key(prediction) -> RankKey:
+    return (-prediction.risk_score, str(prediction.customer_id))
+
+
+def encode_cursor(key: RankKey) -> str:
+    """Opaque keyset cursor for the position after `key`"""
+    raw = f"{-key[0]}:{key[1]}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> RankKey:
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        risk_score, customer_id = raw.split(":", 1)
+        return (-float(risk_score), str(uuid.UUID(customer_id)))
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError(f"Invalid export cursor: {cursor}") from exc
+
+
+class PredictionStore:
+    """Latest prediction per customer with risk-ordered secondary indexes.
+
+    Holds any object exposing customer_id, risk_score, risk_level and segment.
+    When `aggregates` is given it is kept in step with every change.
+    """
+
+    def __init__(self, aggregates: Optional[RiskAggregates] = None):
+        self.aggregates = aggregates
+        self._reset()
+
+    def _reset(self) -> None:
+        self._rows: Dict[str, object] = {}
+        self._ranked: List[RankKey] = []
+        self._by_level: Dict[str, List[RankKey]] = {}
+        self._by_segment: Dict[str, List[RankKey]] = {}
+        self._by_level_segment: Dict[Tuple[str, str], List[RankKey]] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _index_lists(self, prediction) -> List[List[RankKey]]:
+        level = prediction.risk_level.value
+        segment = prediction.segment.lower()
+        return [
+            self._ranked,
+            self._by_level.setdefault(level, []),
+            self._by_segment.setdefault(segment, []),
+            self._by_level_segment.setdefault((level, segment), []),
+        ]
+
+    def load(self, predictions: Iterable) -> None:
+        """Replace the store contents with a full scoring run (one sort, no per-row inserts)"""
+        self._reset()
+        if self.aggregates is not None:
+            self.aggregates.reset()
+        keyed = sorted(((rank_key(p), p) for p in predictions), key=lambda item: item[0])
+        for key, prediction in keyed:
+            self._rows[key[1]] = prediction
+            for index in self._index_lists(prediction):
+                index.append(key)
+            if self.aggregates is not None:
+                self.aggregates.add(prediction)
+
+    def upsert(self, prediction) -> Optional[object]:
+        """Insert or replace one customer's prediction, returning the previous one"""
+        previous = self._rows.get(str(prediction.customer_id))
+        if previous is not None:
+            self._remove(previous)
+        key = rank_key(prediction)
+        self._rows[key[1]] = prediction
+        for index in self._index_lists(prediction):
+            insort(index, key)
+        if self.aggregates is not None:
+            self.aggregates.replace(previous, prediction)
+        return previous
+
+    def _remove(self, prediction) -> None:
+        key = rank_key(prediction)
+        for index in self._index_lists(prediction):
+            pos = bisect_right(index, key) - 1
+            if pos >= 0 and index[pos] == key:
+                del index[pos]
+
+    def get(self, customer_id: uuid.UUID) -> Optional[object]:
+        return self._rows.get(str(customer_id))
+
+    def _select_index(self, risk_level=None, segment: Optional[str] = None) -> List[RankKey]:
+        if risk_level and segment:
+            return self._by_level_segment.get((risk_level.value, segment.lower()), [])
+        if risk_level:
+            return self._by_level.get(risk_level.value, [])
+        if segment:
+            return self._by_segment.get(segment.lower(), [])
+        return self._ranked
+
+    def top(self, limit: int, risk_level=None, segment: Optional[str] = None,
+            min_risk_score: float = 0) -> List[object]:
+        """Highest-risk predictions matching the filters, in O(log n + limit)"""
+        index = self._select_index(risk_level, segment)
+        end = min(limit, bisect_right(index, (-min_risk_score, _MAX_ID)))
+        return [self._rows[key[1]] for key in index[:end]]
+
+    def scan(self, after: Optional[RankKey] = None, risk_level=None, segment: Optional[str] = None,
+             min_risk_score: float = 0, batch_size: int = 500) -> Iterator[List[object]]:
+        """Yield matching predictions in rank order, batch by batch, starting after a keyset cursor.
+
+        Each batch re-seeks the index from the last key returned, so the scan holds
+        at most one batch and tolerates upserts between batches.
+        """
+        bound = (-min_risk_score, _MAX_ID)
+        while True:
+            index = self._select_index(risk_level, segment)
+            start = bisect_right(index, after) if after is not None else 0
+            end = min(start + batch_size, bisect_right(index, bound))
+            if start >= end:
+                return
+            keys = index[start:end]
+            after = keys[-1]
+            yield [self._rows[key[1]] for key in keys]